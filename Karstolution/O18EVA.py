@@ -1,7 +1,7 @@
 from __future__ import division
 
 import math
-from . import evaporation, cmodel_frac, constants
+from . import cave_context
 try:
     from numba import jit
 except ImportError:
@@ -10,102 +10,160 @@ except ImportError:
     
 import numpy as np
 
-@jit
 def O18EVA(tmax, TC, pCO2, pCO2cave, h, v, R18_hco_ini, R18_h2o_ini, R18v, HCOMIX, h2o_new,tt):
 
     # Sourcecode to develope the evolution of the isotopic ratio of the oxygen
     # compostion of the oxygen isotopes 16O and 18O as a function of
     # temperature TC, supersaturation (pCO2), relative humidity (h) and wind
     # velocity (v). %(08.12.2010/m)
-
-    eva = evaporation.evaporation(TC, h, v)
-    e18_hco_caco, e18_hco_h2o, a18_m = cmodel_frac.cmodel_frac(TC)
-    TK = 273.15 + TC
+    #
+    # Returns the values at the end of the drip interval,
+    # (r_hco18, r_h2o18, HCO, hco, H2O, h2o), all NaN if the water layer
+    # evaporates completely
+    #
+    # Not compiled: the cave quantities come from Python caches, which numba
+    # cannot call.  The time stepping is done by the compiled O18EVA_kernel.
+
+    #quantities which depend only on the cave conditions, see cave_context
+    ctx = cave_context.cave_context(TC, pCO2, pCO2cave, h, v)
+    eva = ctx.eva
     #Tau precipitation (s); t=d/a (according to Baker 98)
-    alpha_p = (1.188e-011 * TC**3 - 1.29e-011 * TC**2 + 7.875e-009 * TC + 4.844e-008)
+    alpha_p = ctx.alpha
     #Tau buffering, after Dreybrodt and Scholz (2010)
-    T = 125715.87302 - 16243.30688*TC + 1005.61111*TC**2 - 32.71852*TC**3 + 0.43333*TC**4
-
-    #Concentrations and mol mass
-    outputcave = constants.constants(TC, pCO2cave)      #Concentrations of the spezies in the solution, with respect to cave pCO2
-    HCOCAVE = outputcave[2][2]/np.sqrt(0.8)    #HCO3- concentration, with respect to cave pCO2 (mol/l)
-
-    h2o_ini = h2o_new                          #Mol mass of the water, with respect to the volume of a single box (mol)
-    H20_ini = h2o_ini*18/1000.
-    hco_ini = HCOMIX*H20_ini                   #Mol mass of the HCO3-(soil), with respect to the volume of a single box (mol)
-    #hco_eq = HCOCAVE*H20_ini                   #Mol mass of the HCO3-(cave), with respect to the volume of a single box (mol)
+    T = ctx.T
+    HCOCAVE = ctx.HCOCAVE    #HCO3- concentration, with respect to cave pCO2 (mol/l)
 
     #Fractionation facors for oxygen isotope
-    eps_m = a18_m - 1
-    avl = ((-7356./TK + 15.38)/1000. + 1)
-    abl = 1/(e18_hco_h2o + 1)
-    a = 1/1.008*1.003
-    f = 1/6.
+    eps_m = ctx.eps_m
+    avl = ctx.avl
+    abl = ctx.abl
 
-    #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
-
-    #Calculation of the 18R
-
-    N_times = int(np.ceil(tmax + 1))
-    
-    #initialise arrays
-    init = np.empty(N_times)
-    init[:] = np.NaN
-    r_hco18 = init.copy()
-    r_h2o18 = init.copy()
-    HCO = init.copy()
-    hco = init.copy()
-    H2O = init.copy()
-    h2o = init.copy()
-
-    r_hco18[0] = R18_hco_ini
-    r_h2o18[0] = R18_h2o_ini
+    # the time stepping keeps only the present state, see O18EVA_kernel
+    return O18EVA_kernel(tmax, eva, alpha_p, T, eps_m, abl, avl, h, HCOCAVE,
+                         R18_hco_ini, R18_h2o_ini, R18v, HCOMIX, h2o_new)[:6]
 
 
+@jit
+def O18EVA_kernel(tmax, eva, alpha_p, T, eps_m, abl, avl, h, HCO_EQ,
+                  R18_hco_ini, R18_h2o_ini, R18v, HCOMIX, h2o_new):
+    """
+    Scalar-state version of the O18EVA/O18EVA_MEAN time stepping
+
+    The cave quantities which do not depend on the drip (evaporation rate,
+    precipitation/buffering time constants, fractionation factors and the
+    equilibrium HCO3- concentration) are passed in precomputed, so this can
+    be called repeatedly for the same cave conditions without repeating the
+    chemistry.  The explicit Euler scheme is the same as in O18EVA, but only
+    the present state is kept and the loss-weighted mean isotope ratios (as
+    computed from the O18EVA_MEAN time series in isotope_calcite) are
+    accumulated on the fly.
+
+    Inputs
+    ------
+        - *tmax*
+            drip interval (s)
+        - *eva*
+            evaporation rate (mol/s), see evaporation.evaporation
+        - *alpha_p*, *T*
+            precipitation rate constant (m/s) and buffering time (s)
+        - *eps_m*, *abl*, *avl*
+            fractionation factors, see isotope_calcite
+        - *h*
+            relative humidity (0--1)
+        - *HCO_EQ*
+            equilibrium HCO3- concentration with respect to cave pCO2 (mol/l)
+        - *R18_hco_ini*, *R18_h2o_ini*, *R18v*
+            initial 18O/16O ratios of HCO3- and H2O, and ratio of the vapour
+        - *HCOMIX*, *h2o_new*
+            initial HCO3- concentration (mol/l) and mol mass of water (mol)
+
+    Returns
+    -------
+        - *(r_hco18, r_h2o18, HCO, hco, H2O, h2o, r_hco18_mean, r_h2o18_mean, n_steps)*
+            the first six are the values at the end of the drip interval (as
+            returned by O18EVA), the next two are the mean isotope ratios of
+            the HCO3- and H2O lost during the drip interval, and n_steps is
+            the number of time steps taken.  Everything except n_steps (which
+            is zero) is NaN if the water layer evaporates completely.
+    """
+    nan = np.nan
+    h2o_ini = h2o_new
     if eva > 0 and tmax > np.floor(h2o_ini/eva):
-        tmax = int(np.floor(h2o_ini/eva))
-        #raise RuntimeError('DRIPINTERVALL IS TOO LONG, THE WATERLAYER EVAPORATES COMPLETLY FOR THE GIVEN d (tt={})'.format(tt))
-        return (np.NaN, np.NaN, np.NaN, np.NaN, np.NaN, np.NaN)
+        return (nan, nan, nan, nan, nan, nan, nan, nan, 0)
 
-    # adjust dt so that it's roughly 1 second, but divides evenly into tmax
-    t = np.linspace(0, tmax, N_times)
-    dt = t[1] - t[0]
+    H2O = h2o_ini*18/1000.
+    HCO = HCOMIX
+    hco = HCOMIX*H2O
+    h2o = h2o_new
+    r_hco18 = R18_hco_ini
+    r_h2o18 = R18_h2o_ini
+    hco_0 = hco
+    h2o_0 = h2o
 
-    HCO[0] = HCOMIX                                  #Konzentration von HCO3-
-    hco[0] = hco_ini                                 #Menge an HCO3-
-    H2O[0] = H20_ini
-    h2o[0] = h2o_new
-
-    #"Restwassermenge" und daher konstant
-    # "Residual water quantity" and therefore constant
-
-    HCO_EQ = HCOCAVE                       #Equilibriumconcentration
-
-    for ii in range(1, len(t)):
-
-        delta = (H2O[ii-1]/1000.)/0.001
-
-        # Update the state of aqueous solution to present timestep
-        h2o[ii] = (h2o[ii-1] - eva*dt)              #Water (mol)
-        d_h2o = -eva                              #Evaporationrate (mol/l)
-        H2O[ii] = (h2o[ii]*18*1e-3)               #Water (l)
-
-        #Evaporation
-        HCO_temp = (HCO[ii-1] - HCO_EQ) * np.exp(-dt/(delta/alpha_p)) + HCO_EQ          #HCO3- concentration after timeintervall dt
-        hco[ii] = (HCO_temp * H2O[ii-1])                                         #HCO3- mass (mol)
-
-        HCO[ii] = (HCO_temp * (H2O[ii-1]/H2O[ii]))      #HCO3- concentration after timeintervall dt and the evaporation of water
+    a = 1/1.008*1.003
+    f = 1/6.
+    d_h2o = -eva
 
-        r_hco18[ii] = (r_hco18[ii-1] + ((eps_m*(hco[ii]-hco[ii-1])/hco[ii]-1/T) * r_hco18[ii-1] + abl/T*r_h2o18[ii-1]) * dt)
-        r_h2o18[ii] = (r_h2o18[ii-1] + 
-                        ( ( hco[ii]/h2o[ii]/T 
-                            - f/abl/h2o[ii]*(hco[ii]-hco[ii-1]) * r_hco18[ii] 
-                            + ( d_h2o/h2o[ii]*(a*avl/(1-h)-1) - hco[ii]/h2o[ii]*abl/T) * r_h2o18[ii-1] 
-                            - a*h/(1-h)*R18v/h2o[ii]*d_h2o
+    # same time step as np.linspace(0, tmax, N_times) in O18EVA
+    N_times = int(np.ceil(tmax + 1))
+    dt = tmax/(N_times - 1)
+
+    # compensated (Neumaier) sums for the loss-weighted means
+    sum_b = 0.0
+    c_b = 0.0
+    sum_w = 0.0
+    c_w = 0.0
+
+    for ii in range(1, N_times):
+        delta = (H2O/1000.)/0.001
+
+        h2o_next = h2o - eva*dt
+        H2O_next = h2o_next*18*1e-3
+
+        HCO_temp = (HCO - HCO_EQ) * math.exp(-dt/(delta/alpha_p)) + HCO_EQ
+        hco_next = HCO_temp * H2O
+        HCO = HCO_temp * (H2O/H2O_next)
+
+        r_hco18_next = (r_hco18 + ((eps_m*(hco_next-hco)/hco_next-1/T) * r_hco18 + abl/T*r_h2o18) * dt)
+        r_h2o18_next = (r_h2o18 +
+                        ( ( hco_next/h2o_next/T
+                            - f/abl/h2o_next*(hco_next-hco) * r_hco18_next
+                            + ( d_h2o/h2o_next*(a*avl/(1-h)-1) - hco_next/h2o_next*abl/T) * r_h2o18
+                            - a*h/(1-h)*R18v/h2o_next*d_h2o
                             ) * dt
                         )
                         )
 
-    #assert np.isnan( np.array([r_hco18[-1], r_h2o18[-1], HCO[-1], hco[-1], H2O[-1], h2o[-1]])  ).sum() == 0
-
-    return (r_hco18[-1], r_h2o18[-1], HCO[-1], hco[-1], H2O[-1], h2o[-1])
+        # trapezoidal ratio, weighted by the amount lost during the step
+        term = (r_hco18 + (r_hco18_next - r_hco18)/2.) * (hco - hco_next)
+        tot = sum_b + term
+        if abs(sum_b) >= abs(term):
+            c_b += (sum_b - tot) + term
+        else:
+            c_b += (term - tot) + sum_b
+        sum_b = tot
+
+        term = (r_h2o18 + (r_h2o18_next - r_h2o18)/2.) * (h2o - h2o_next)
+        tot = sum_w + term
+        if abs(sum_w) >= abs(term):
+            c_w += (sum_w - tot) + term
+        else:
+            c_w += (term - tot) + sum_w
+        sum_w = tot
+
+        hco = hco_next
+        h2o = h2o_next
+        H2O = H2O_next
+        r_hco18 = r_hco18_next
+        r_h2o18 = r_h2o18_next
+
+    if hco_0 != hco:
+        r_hco18_mean = (sum_b + c_b) / (hco_0 - hco)
+    else:
+        r_hco18_mean = nan
+    if h2o_0 != h2o:
+        r_h2o18_mean = (sum_w + c_w) / (h2o_0 - h2o)
+    else:
+        r_h2o18_mean = nan
+
+    return (r_hco18, r_h2o18, HCO, hco, H2O, h2o, r_hco18_mean, r_h2o18_mean, N_times - 1)
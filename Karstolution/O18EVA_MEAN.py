@@ -1,6 +1,6 @@
 from __future__ import division
 import math
-from . import evaporation, cmodel_frac, constants
+from . import cave_context
 import numpy as np
 try:
     from numba import jit
@@ -8,35 +8,57 @@ except ImportError:
     # do-nothing decorator
     jit = lambda x:x
 
-@jit
 def O18EVA_MEAN(tmax, TC, pCO2, pCO2cave, h, v, R18_hco_ini, R18_h2o_ini, R18v, HCOMIX, h2o_new,tt):
 
     # Sourcecode to develope the evolution of the isotopic ratio of the oxygen
     # compostion of the oxygen isotopes 16O and 18O as a function of
     # temperature TC, supersaturation (pCO2), relative humidity (h) and wind
     # velocity (v). %(08.12.2010/m)
-
-    eva = evaporation.evaporation(TC, h, v)
-    e18_hco_caco, e18_hco_h2o, a18_m = cmodel_frac.cmodel_frac(TC)
-    TK = 273.15 + TC
+    #
+    # Returns the time series (r_hco18, r_h2o18, hco, h2o, delta_1) over the
+    # drip interval, all NaN if the water layer evaporates completely.  The
+    # loss-weighted means of the time series are calculated without storing
+    # it by O18EVA.O18EVA_kernel.
+    #
+    # Not compiled: the cave quantities come from Python caches, which numba
+    # cannot call.  The time series is calculated by the compiled
+    # O18EVA_MEAN_kernel.
+
+    #quantities which depend only on the cave conditions, see cave_context
+    ctx = cave_context.cave_context(TC, pCO2, pCO2cave, h, v)
+    eva = ctx.eva
     #Tau precipitation (s); t=d/a (according to Baker 98)
-    alpha_p = (1.188e-011 * TC**3 - 1.29e-011 * TC**2 + 7.875e-009 * TC + 4.844e-008)
+    alpha_p = ctx.alpha
     #Tau buffering, after Dreybrodt and Scholz (2010)
-    T = 125715.87302 - 16243.30688*TC + 1005.61111*TC**2 - 32.71852*TC**3 + 0.43333*TC**4
+    T = ctx.T
+    HCOCAVE = ctx.HCOCAVE    #HCO3- concentration, with respect to cave pCO2 (mol/l)
+
+    #Fractionation facors for oxygen isotope
+    eps_m = ctx.eps_m
+    avl = ctx.avl
+    abl = ctx.abl
+
+    return O18EVA_MEAN_kernel(tmax, eva, alpha_p, T, eps_m, abl, avl, h, HCOCAVE,
+                              R18_hco_ini, R18_h2o_ini, R18v, HCOMIX, h2o_new)
 
-    #Concentrations and mol mass
-    outputcave = constants.constants(TC, pCO2cave)      #Concentrations of the spezies in the solution, with respect to cave pCO2
-    HCOCAVE = outputcave[2][2]/np.sqrt(0.8)  #HCO3- concentration, with respect to cave pCO2 (mol/l)
 
+@jit
+def O18EVA_MEAN_kernel(tmax, eva, alpha_p, T, eps_m, abl, avl, h, HCOCAVE,
+                       R18_hco_ini, R18_h2o_ini, R18v, HCOMIX, h2o_new):
+    """
+    Time series of O18EVA_MEAN, with the cave quantities passed in as for
+    O18EVA.O18EVA_kernel
+
+    Returns
+    -------
+        - *(r_hco18, r_h2o18, hco, h2o, delta_1)*
+            arrays over the drip interval, see O18EVA_MEAN
+    """
     h2o_ini = h2o_new                          #Mol mass of the water, with respect to the volume of a single box (mol)
     H20_ini = h2o_ini*18/1000
     hco_ini = HCOMIX*H20_ini                   #Mol mass of the HCO3-(soil), with respect to the volume of a single box (mol)
     hco_eq = HCOCAVE*H20_ini                   #Mol mass of the HCO3-(cave), with respect to the volume of a single box (mol)
 
-    #Fractionation facors for oxygen isotope
-    eps_m = a18_m - 1
-    avl = ((-7356/TK + 15.38)/1000 + 1)
-    abl = 1/(e18_hco_h2o + 1)
     a = 1/1.008*1.003
     f = 1/6
 
@@ -59,7 +81,7 @@ def O18EVA_MEAN(tmax, TC, pCO2, pCO2cave, h, v, R18_hco_ini, R18_h2o_ini, R18v,
     if eva > 0 and tmax > np.floor(h2o_ini/eva):
         tmax = int(np.floor(h2o_ini/eva))
         #raise RuntimeError('DRIPINTERVALL IS TOO LONG, THE WATERLAYER EVAPORATES COMPLETLY FOR THE GIVEN d (tt={})'.format(tt))
-        return (np.NaN, np.NaN, np.NaN, np.NaN, np.NaN, np.NaN)
+        return (r_hco18*np.NaN, r_h2o18*np.NaN, hco, h2o, delta_1)
 
     # adjust dt so that it's roughly 1 second, but divides evenly into tmax
     t = np.linspace(0, tmax, N_times)
@@ -103,14 +125,6 @@ def O18EVA_MEAN(tmax, TC, pCO2, pCO2cave, h, v, R18_hco_ini, R18_h2o_ini, R18v,
                             ) * r_h2o18[ii - 1] - a * h /
                             (1 - h) * R18v / h2o[ii] * d_h2o) * dt))
 
-    if eva > 0 and tmax > np.floor(h2o_ini/eva):
-        raise RuntimeError('Error in O18EVA_MEAN.py')
-        r_hco18 *= np.NaN
-        r_h2o18 *= np.NaN
-        hco *= np.NaN
-        h2o *= np.NaN
-        delta_1 *= np.NaN
-
     #assert(np.isfinite([r_hco18, r_h2o18, hco, h2o, delta_1]).all())
 
     return (r_hco18, r_h2o18, hco, h2o, delta_1)
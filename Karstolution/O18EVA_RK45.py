@@ -0,0 +1,212 @@
+from __future__ import division
+
+import math
+try:
+    from numba import jit
+except ImportError:
+    # do-nothing decorator
+    jit = lambda x:x
+
+import numpy as np
+
+#Adaptive step size alternative to the fixed ~1 s explicit Euler step of O18EVA.
+#The HCO3- mass is integrated analytically and the isotope ratios (plus the
+#integrals needed for the loss-weighted means) use an embedded Runge-Kutta
+#pair with error control, so the cost is set by the time scales of the
+#chemistry rather than the length of the drip interval.
+
+#Dormand-Prince 5(4) coefficients
+_c2, _c3, _c4, _c5 = 1/5., 3/10., 4/5., 8/9.
+_a21 = 1/5.
+_a31, _a32 = 3/40., 9/40.
+_a41, _a42, _a43 = 44/45., -56/15., 32/9.
+_a51, _a52, _a53, _a54 = 19372/6561., -25360/2187., 64448/6561., -212/729.
+_a61, _a62, _a63, _a64, _a65 = 9017/3168., -355/33., 46732/5247., 49/176., -5103/18656.
+_b1, _b3, _b4, _b5, _b6 = 35/384., 500/1113., 125/192., -2187/6784., 11/84.
+#difference between the 5th and 4th order weights
+_e1, _e3, _e4, _e5, _e6, _e7 = (71/57600., -71/16695., 71/1920., -17253/339200.,
+                                22/525., -1/40.)
+
+#typical 18O/16O ratio, used to scale the absolute error
+_R_ref = 0.0020052
+
+#limits on the step size control: the solve gives up (and returns NaN) after
+#_MAX_STEPS steps, or if the step falls below _MIN_DT times the drip interval
+_MAX_STEPS = 1000000
+_MIN_DT = 1e-12
+
+
+@jit
+def _hco_analytic(t, hco_0, H2O_0, k, alpha_p, HCO_EQ):
+    """
+    HCO3- mass (mol) at time t, solution of
+
+        d(hco)/dt = -alpha_p*(hco/H2O - HCO_EQ),  H2O = H2O_0 - k*t
+
+    which is the continuous form of the HCO3- update in O18EVA
+    """
+    if k > 0:
+        # with x = H2O/H2O_0 and r = alpha_p/k, the solution is
+        #     hco_0*x**r + alpha_p*HCO_EQ*H2O_0*(x - x**r)/(alpha_p - k)
+        # and the second term is written with expm1, so that it has no
+        # cancellation as k -> alpha_p, where it tends to
+        # -HCO_EQ*H2O*log(x)
+        H2O = H2O_0 - k*t
+        log_x = math.log1p(-k*t/H2O_0)
+        r = alpha_p/k
+        if r == 1.0:
+            g = -log_x
+        else:
+            g = -math.expm1((r - 1)*log_x)/(r - 1)
+        return hco_0*math.exp(r*log_x) + r*HCO_EQ*H2O*g
+    else:
+        return HCO_EQ*H2O_0 + (hco_0 - HCO_EQ*H2O_0) * math.exp(-alpha_p*t/H2O_0)
+
+
+@jit
+def _rhs(t, r_b, r_w, hco_0, h2o_0, eva, alpha_p, T, eps_m, abl, avl, h, HCO_EQ, R18v):
+    """
+    Time derivative of the HCO3- and H2O isotope ratios and of the
+    loss-weighted ratio integrals
+    """
+    a = 1/1.008*1.003
+    f = 1/6.
+    d_h2o = -eva
+    h2o = h2o_0 - eva*t
+    H2O = h2o*18*1e-3
+    hco = _hco_analytic(t, hco_0, h2o_0*18*1e-3, eva*18*1e-3, alpha_p, HCO_EQ)
+    d_hco = -alpha_p*(hco/H2O - HCO_EQ)
+
+    dr_b = (eps_m*d_hco/hco - 1/T) * r_b + abl/T*r_w
+    dr_w = ( hco/h2o/T
+             - f/abl/h2o*d_hco * r_b
+             + ( d_h2o/h2o*(a*avl/(1-h)-1) - hco/h2o*abl/T) * r_w
+             - a*h/(1-h)*R18v/h2o*d_h2o )
+    return dr_b, dr_w, -d_hco*r_b, -d_h2o*r_w
+
+
+@jit
+def O18EVA_RK45_kernel(tmax, eva, alpha_p, T, eps_m, abl, avl, h, HCO_EQ,
+                       R18_hco_ini, R18_h2o_ini, R18v, HCOMIX, h2o_new, rtol=1e-8):
+    """
+    Adaptive step size version of O18EVA_kernel
+
+    Solves the same drip-water model with the Dormand-Prince 5(4) embedded
+    Runge-Kutta pair, integrating the HCO3- mass analytically.  The O18EVA
+    Euler scheme is a first order approximation (with a ~1 s step) to the
+    same equations.
+
+    Inputs
+    ------
+        As for O18EVA.O18EVA_kernel, plus
+
+        - *rtol*
+            relative error tolerance for each step, applied to the isotope
+            ratios and to the integrals for the loss-weighted means.  The
+            error in d18O is of order rtol*1000 permille.
+
+    Returns
+    -------
+        - *(r_hco18, r_h2o18, HCO, hco, H2O, h2o, r_hco18_mean, r_h2o18_mean, n_steps)*
+            see O18EVA.O18EVA_kernel.  n_steps counts the rejected steps as
+            well as the accepted ones.  Everything except n_steps is NaN if
+            the error estimate is not finite (e.g. NaN inputs), or the step
+            size control fails (see _MAX_STEPS and _MIN_DT).
+    """
+    nan = np.nan
+    h2o_ini = h2o_new
+    if eva > 0 and tmax > np.floor(h2o_ini/eva):
+        return (nan, nan, nan, nan, nan, nan, nan, nan, 0)
+
+    H2O_0 = h2o_ini*18/1000.
+    hco_0 = HCOMIX*H2O_0
+    h2o_end = h2o_ini - eva*tmax
+    H2O_end = h2o_end*18*1e-3
+    hco_end = _hco_analytic(tmax, hco_0, H2O_0, eva*18*1e-3, alpha_p, HCO_EQ)
+    HCO_end = hco_end/H2O_end
+
+    # absolute error scales
+    atol_r = rtol*_R_ref
+    atol_ib = rtol*_R_ref*abs(hco_0 - hco_end)
+    atol_iw = rtol*_R_ref*abs(h2o_ini - h2o_end)
+
+    r_b = R18_hco_ini
+    r_w = R18_h2o_ini
+    i_b = 0.0
+    i_w = 0.0
+
+    # the fastest process is the relaxation of HCO3- towards equilibrium
+    dt = min(tmax, 0.01*H2O_0/alpha_p)
+    t = 0.0
+    n_steps = 0
+    k1 = _rhs(t, r_b, r_w, hco_0, h2o_ini, eva, alpha_p, T, eps_m, abl, avl, h, HCO_EQ, R18v)
+    while t < tmax:
+        if t + dt > tmax:
+            dt = tmax - t
+        n_steps += 1
+        k2 = _rhs(t + _c2*dt,
+                  r_b + dt*_a21*k1[0],
+                  r_w + dt*_a21*k1[1],
+                  hco_0, h2o_ini, eva, alpha_p, T, eps_m, abl, avl, h, HCO_EQ, R18v)
+        k3 = _rhs(t + _c3*dt,
+                  r_b + dt*(_a31*k1[0] + _a32*k2[0]),
+                  r_w + dt*(_a31*k1[1] + _a32*k2[1]),
+                  hco_0, h2o_ini, eva, alpha_p, T, eps_m, abl, avl, h, HCO_EQ, R18v)
+        k4 = _rhs(t + _c4*dt,
+                  r_b + dt*(_a41*k1[0] + _a42*k2[0] + _a43*k3[0]),
+                  r_w + dt*(_a41*k1[1] + _a42*k2[1] + _a43*k3[1]),
+                  hco_0, h2o_ini, eva, alpha_p, T, eps_m, abl, avl, h, HCO_EQ, R18v)
+        k5 = _rhs(t + _c5*dt,
+                  r_b + dt*(_a51*k1[0] + _a52*k2[0] + _a53*k3[0] + _a54*k4[0]),
+                  r_w + dt*(_a51*k1[1] + _a52*k2[1] + _a53*k3[1] + _a54*k4[1]),
+                  hco_0, h2o_ini, eva, alpha_p, T, eps_m, abl, avl, h, HCO_EQ, R18v)
+        k6 = _rhs(t + dt,
+                  r_b + dt*(_a61*k1[0] + _a62*k2[0] + _a63*k3[0] + _a64*k4[0] + _a65*k5[0]),
+                  r_w + dt*(_a61*k1[1] + _a62*k2[1] + _a63*k3[1] + _a64*k4[1] + _a65*k5[1]),
+                  hco_0, h2o_ini, eva, alpha_p, T, eps_m, abl, avl, h, HCO_EQ, R18v)
+
+        y = [0.0, 0.0, 0.0, 0.0]
+        y[0] = r_b + dt*(_b1*k1[0] + _b3*k3[0] + _b4*k4[0] + _b5*k5[0] + _b6*k6[0])
+        y[1] = r_w + dt*(_b1*k1[1] + _b3*k3[1] + _b4*k4[1] + _b5*k5[1] + _b6*k6[1])
+        y[2] = i_b + dt*(_b1*k1[2] + _b3*k3[2] + _b4*k4[2] + _b5*k5[2] + _b6*k6[2])
+        y[3] = i_w + dt*(_b1*k1[3] + _b3*k3[3] + _b4*k4[3] + _b5*k5[3] + _b6*k6[3])
+        k7 = _rhs(t + dt, y[0], y[1],
+                  hco_0, h2o_ini, eva, alpha_p, T, eps_m, abl, avl, h, HCO_EQ, R18v)
+
+        # scaled RMS error estimate
+        err = 0.0
+        scale = (atol_r + rtol*max(abs(r_b), abs(y[0])),
+                 atol_r + rtol*max(abs(r_w), abs(y[1])),
+                 atol_ib + rtol*max(abs(i_b), abs(y[2])),
+                 atol_iw + rtol*max(abs(i_w), abs(y[3])))
+        for jj in range(4):
+            e = dt*(_e1*k1[jj] + _e3*k3[jj] + _e4*k4[jj] + _e5*k5[jj] + _e6*k6[jj] + _e7*k7[jj])
+            if scale[jj] > 0:
+                err += (e/scale[jj])**2
+        err = math.sqrt(err/4.)
+        if not math.isfinite(err):
+            return (nan, nan, nan, nan, nan, nan, nan, nan, n_steps)
+
+        if err <= 1.0:
+            t += dt
+            r_b, r_w, i_b, i_w = y[0], y[1], y[2], y[3]
+            k1 = k7
+        if err == 0.0:
+            factor = 5.0
+        else:
+            factor = min(5.0, max(0.2, 0.9*err**-0.2))
+        dt = dt*factor
+        if t < tmax and (n_steps >= _MAX_STEPS or dt < _MIN_DT*tmax):
+            return (nan, nan, nan, nan, nan, nan, nan, nan, n_steps)
+
+    if hco_0 != hco_end:
+        r_hco18_mean = i_b / (hco_0 - hco_end)
+    else:
+        r_hco18_mean = nan
+    if h2o_ini != h2o_end:
+        r_h2o18_mean = i_w / (h2o_ini - h2o_end)
+    else:
+        r_h2o18_mean = nan
+
+    return (r_b, r_w, HCO_end, hco_end, H2O_end, h2o_end, r_hco18_mean, r_h2o18_mean,
+            n_steps)
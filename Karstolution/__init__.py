@@ -1,5 +1,11 @@
-from .karstolution1_1 import karstolution
-from .calcpco2 import calc_pco2
+from .karstolution1_1 import karstolution, karstolution_arrays
+from .model import KarstolutionModel, spin_up
+from .karst_core import ModelState, save_state, load_state
+from .calcpco2 import calc_pco2, calc_pco2_array
+from .ensemble import (run_ensemble, run_ensemble_vectorized, grid_design,
+                       latin_hypercube_design, random_design)
+from .transfer import transfer_function
+from .output import open_sink, read_output
 
 if False:
     import csv
@@ -0,0 +1,73 @@
+from __future__ import division
+from collections import OrderedDict, namedtuple
+
+#small bounded cache used to memoize the chemistry calculations, which
+#tend to be repeated with the same inputs (e.g. a monthly climatology)
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LRUCache(object):
+    """
+    Bounded mapping with least-recently-used eviction and hit/miss counters
+
+    Usage example:
+    --------------
+    cache = LRUCache(maxsize=1024)
+    value = cache.get(key)
+    if value is None:
+        value = expensive_function(*key)
+        cache.put(key, value)
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = int(maxsize)
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Look up `key`, counting a hit or a miss
+        """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # re-insert to mark as most recently used
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Store `value`, evicting the least recently used entry if full
+        """
+        if self.maxsize <= 0:
+            return
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def resize(self, maxsize):
+        self.maxsize = int(maxsize)
+        while len(self._data) > max(self.maxsize, 0):
+            self._data.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all entries and reset the counters
+        """
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
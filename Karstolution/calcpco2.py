@@ -1,13 +1,105 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import division
-from __future__ import print_function
 
 import numpy as np
 
 from . import constants
 
 
+#search range of pCO2 (atm), as in the original bisection-by-tenths
+#algorithm of CALCPCO2.m
+pCO2_max = 1.0
+
+
+def calc_pco2_array(ca, TC, rtol=1e-6, max_iter=100):
+    """
+    Calculate pCO2-equivalents for arrays of Ca2+ concentration and temperature
+
+    Vectorized version of `calc_pco2`.  Samples outside the searched pCO2
+    range (0 to 1,000,000 ppmV) give NaN instead of raising an error.
+
+    Inputs
+    ------
+        *ca* - array-like
+        Calcium 2+ ion concentration (mol/l)
+
+        *TC* - array-like
+        Temperature in deg C (broadcast against *ca*)
+
+        *rtol* - scalar
+        Relative tolerance on the Ca2+ concentration
+
+        *max_iter* - int
+        Maximum number of iterations
+
+    Outputs
+    -------
+        *pCO2* - array
+        CO2 equivalent volume mixing ratio (ppmV)
+
+    Algorithm
+    ---------
+    In equilibrium Ca2+ is close to proportional to pCO2**(1/3), so the root
+    is found in the variable s = pCO2**(1/3), where the problem is nearly
+    linear.  The root is kept bracketed and refined with regula falsi (a
+    secant step within the bracket) with the Illinois modification, which
+    converges superlinearly.  The equilibrium concentrations are computed
+    by `constants.calcium`, the same calculation as in `constants`; a few
+    evaluations are usually needed.
+    """
+    ca, TC = np.broadcast_arrays(np.asarray(ca, dtype=float),
+                                 np.asarray(TC, dtype=float))
+    shape = ca.shape
+    ca = ca.ravel()
+    TC = TC.ravel()
+    # terminate when error is smaller than this
+    epsilon = (ca * rtol) + 1e-20
+    s_lo = np.zeros(ca.shape)
+    s_hi = np.ones(ca.shape) * pCO2_max**(1.0/3)
+    f_lo = constants.calcium(TC, s_lo**3) - ca
+    f_hi = constants.calcium(TC, s_hi**3) - ca
+    # the search region must bracket the target value
+    valid = (f_lo <= 0) & (f_hi >= 0)
+    s = np.where(valid, s_lo, np.nan)
+    done = ~valid | (np.abs(f_lo) < epsilon)
+    done_hi = ~done & (np.abs(f_hi) < epsilon)
+    s[done_hi] = s_hi[done_hi]
+    done |= done_hi
+    # side of the bracket replaced in the last iteration
+    side = np.zeros(ca.shape, dtype=int)
+
+    n_iter = 0
+    while not np.all(done):
+        if n_iter >= max_iter:
+            raise RuntimeError("calc_pco2 did not converge after {} iterations".format(n_iter))
+        n_iter += 1
+        active = ~done
+        s_new = (s_lo*f_hi - s_hi*f_lo) / (f_hi - f_lo)
+        f_new = np.zeros(ca.shape)
+        f_new[active] = constants.calcium(TC[active], s_new[active]**3) - ca[active]
+
+        converged = active & (np.abs(f_new) < epsilon)
+        s[converged] = s_new[converged]
+        done |= converged
+        active &= ~converged
+
+        # replace the end of the bracket with the same sign as f_new, and
+        # halve the value at the other end if it is retained twice in a row
+        low = active & (f_new < 0)
+        high = active & (f_new > 0)
+        f_hi[low & (side == -1)] /= 2
+        f_lo[high & (side == 1)] /= 2
+        s_lo[low] = s_new[low]
+        f_lo[low] = f_new[low]
+        s_hi[high] = s_new[high]
+        f_hi[high] = f_new[high]
+        side[low] = -1
+        side[high] = 1
+
+    return (s**3 * 1e6).reshape(shape)
+
+
 def calc_pco2(ca, TC):
     """
     Calculate pCO2-equivalent at a given Ca2+ concentration and temperature
@@ -45,54 +137,20 @@ def calc_pco2(ca, TC):
     mirroring the real Ca 2+ concentration is again subdivided into ten equidistant
     intervals, and then step 2 is repeated.
 
+    Here the same equation is solved over the same pCO2 range with a
+    bracketed secant method, see `calc_pco2_array`, which needs far fewer
+    evaluations of the equilibrium chemistry.
+
     History
     -------
     13 August 2018: Translated from Deininger's Matlab function
     """
-    # terminate when error is smaller than this
-    epsilon = (ca * 1e-6) + 1e-20
-    # number of steps to divide search interval into
-    # (must be at least 2)
-    n_steps = 10
-    # pco2 interval to search
-    pco2int = np.linspace(0, 1000000e-6, n_steps)
-    run = True
-    n_iter = 0
-    ca_int = np.empty(n_steps)
-
-    while run:
-        pco2_step_size = pco2int[1] - pco2int[0]
-        for ii, pco2ii in enumerate(pco2int):
-            concentrations = constants.constants(TC, pco2ii)
-            ca_int[ii] = concentrations[2][0]
-
-        # the search region must always bracket the target value
-        if not (ca_int[0] <= ca and ca_int[-1] >= ca):
-            raise ValueError(
-                "Unable to compute pCO2 for Ca concentration of {} mol/l.".
-                format(ca))
-
-        index_pco2 = np.argmin(np.abs(ca_int - ca))
-        # decide where to search next
-        if ca_int[index_pco2] < ca:
-            # search the interval with higher pCO2 next
-            pco2int = np.linspace(pco2int[index_pco2],
-                                  pco2int[index_pco2] + pco2_step_size,
-                                  n_steps)
-        else:
-            # search the interval with lower pCO2 next
-            pco2int = np.linspace(pco2int[index_pco2] - pco2_step_size,
-                                  pco2int[index_pco2], n_steps)
-
-        if np.abs(ca_int[index_pco2] - ca) < epsilon:
-            run = False
-
-        n_iter += 1
-        print(n_iter, ca, ca_int[index_pco2], pco2int[index_pco2] * 1e6)
-        # no convergence after many iterations: something has gone wrong
-        # tests converged in < 10 iterations.
-        assert (n_iter < 10000)
-    return pco2int[index_pco2] * 1e6
+    pco2 = calc_pco2_array(ca, TC)
+    if np.isnan(pco2):
+        raise ValueError(
+            "Unable to compute pCO2 for Ca concentration of {} mol/l.".
+            format(ca))
+    return float(pco2)
 
 
 # original matlab code
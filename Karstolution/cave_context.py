@@ -0,0 +1,104 @@
+from __future__ import division
+from collections import namedtuple
+import numpy as np
+from . import constants, evaporation, cmodel_frac
+from .caching import LRUCache
+
+#quantities used by ISOLUTION which depend only on the cave conditions of a
+#month (temperature, pCO2 of the drip water and the cave air, humidity and
+#ventilation), and not on the drip.  They are calculated once per set of
+#conditions and shared by all of the stalagmites and by every drip-water ODE
+#solution (isotope_calcite, isotope_calcite_batch, O18EVA, O18EVA_MEAN).
+
+# depth of fluid layer on the stalagmite surface[m]
+delta = 1e-4
+
+CaveContext = namedtuple('CaveContext', [
+    # the cave conditions
+    'TC', 'pCO2', 'pCO2cave', 'h', 'V',
+    # evaporation rate (mol/s)
+    'eva',
+    # fractionation factors (see cmodel_frac), eps_m = a18_m - 1
+    'e18_hco_caco', 'e18_hco_h2o', 'a18_m', 'eps_m',
+    # precipitation rate constant (m/s) and time scale (s), buffering time (s)
+    'alpha', 'Z', 'T',
+    # HCO3- concentrations with respect to the soil and cave pCO2 (mol/l),
+    # and the excess calcium (mol/m3)
+    'HCOSOIL', 'HCOCAVE', 'CaEx',
+    # vapour-liquid and HCO3--H2O fractionation factors
+    'avl', 'abl'])
+
+_cache = LRUCache(maxsize=4096)
+
+
+def _cave_context(TC, pCO2, pCO2cave, h, V):
+    eva=evaporation.evaporation(TC, h, V)   #Evaporationrate (mol/l)
+    e18_hco_caco, e18_hco_h2o, a18_m = cmodel_frac.cmodel_frac(TC)       #Fractionation factors
+    TK = 273.15 + TC            #Absolute temperature (K)
+    #Tau precipitation (s); t=d/a (according to Baker 98)
+    alpha = (1.188e-011 * TC**3 - 1.29e-011 * TC**2 + 7.875e-009 * TC + 4.844e-008)
+    Z = delta/alpha
+    #Tau buffering, after Dreybrodt and Scholz (2010)
+    T = 125715.87302 - 16243.30688*TC + 1005.61111*TC**2 - 32.71852*TC**3 + 0.43333*TC**4
+
+    #Concentrations of the spezies in the solution, with respect to soil and cave pCO2
+    outputsoil = constants.cached_constants(TC, pCO2)
+    outputcave = constants.cached_constants(TC, pCO2cave)
+
+    HCOSOIL = outputsoil[2][2]                   #HCO3- concentration, with respect to soil pCO2 (mol/l)
+    HCOCAVE = outputcave[2][2]/np.sqrt(0.8)    #HCO3- concentration, with respect to cave pCO2 (mol/l)
+    # Excess calcium accounting for inhibiting effects [mol/m3]
+    CaEx = ( outputsoil[2][0] - outputcave[2][0] / np.sqrt(0.8) ) * 1e3
+
+    #Fractionation facors for oxygen isotope
+    avl = (-7356./TK + 15.38)/1000. + 1
+    abl = 1/(e18_hco_h2o + 1)
+
+    return CaveContext(TC, pCO2, pCO2cave, h, V, eva, e18_hco_caco, e18_hco_h2o, a18_m,
+                       a18_m - 1, alpha, Z, T, HCOSOIL, HCOCAVE, CaEx, avl, abl)
+
+
+def cave_context(TC, pCO2, pCO2cave, h, V):
+    """
+    The CaveContext for a set of cave conditions
+
+    Results are kept in a bounded least-recently-used cache keyed on the
+    conditions, see `cache_info` and `cache_clear`.
+
+    Inputs
+    ------
+        - *TC*, *pCO2*, *pCO2cave*, *h*, *V*
+            cave temperature (degC), pCO2 of the drip water and of the cave
+            air (atm), relative humidity (0--1) and ventilation, as for
+            isotope_calcite
+
+    Returns
+    -------
+        - *CaveContext*
+
+    Usage example:
+    --------------
+    ctx = cave_context(cave_temp, drip_pco2, cave_pco2, h, v)
+    if ctx.HCOSOIL > ctx.HCOCAVE:
+        ...
+    """
+    key = (float(TC), float(pCO2), float(pCO2cave), float(h), float(V))
+    ctx = _cache.get(key)
+    if ctx is None:
+        ctx = _cave_context(*key)
+        _cache.put(key, ctx)
+    return ctx
+
+
+def cache_info():
+    """
+    Hits, misses, maximum and current size of the `cave_context` cache
+    """
+    return _cache.info()
+
+
+def cache_clear():
+    """
+    Empty the `cave_context` cache and reset its counters
+    """
+    _cache.clear()
@@ -1,5 +1,6 @@
 from __future__ import division
 import numpy as np
+from .caching import LRUCache
 
 try:
     from numba import jit
@@ -8,49 +9,30 @@ except ImportError:
     jit = lambda x:x
 
 @jit
-def constants(TC, pCO2):
-    #calculates activity coefficients, mass action constants,
-    #reaction rate constants and concentrations of all species [mol/l] comprised in the
-    #CO2-H2O-CaCO3 system.
-
-    TK = TC + 273.16
-    if pCO2<=0:
-        pCO2=0.0000000000001
-    #temperature (only) dependent variables
-
-    #reaction rate constants
-    k1m = 10**(13.558 - 3617.1/TK)
-    k1p = 10**(329.850 - 110.54 * np.log10(TK) - 17265.4/TK)
-    k2m = 10**(14.09 - 5308/TK)
-    k2p = 10**(13.635 - 2985/TK)
-
-    #mass action constants
+def _calcium_constants(TK):
+    #mass action constants needed for the equilibrium Ca2+ concentration
     K2 = 10**(-107.8871 - 0.03252849 * TK + 5151.79 / TK + 38.92561 * np.log10(TK) - 563713.9 / (TK**2))
-    K5 = 1.707e-4
-    K6 = 10**(-356.3094 + 21834.37 / TK - 0.060919964 * TK + 126.8339 * np.log10(TK) - 1684915 / (TK**2))
-
-    K0 = K5 / K6                              #BUHMANN1985
     K1 = 10**(-356.3094 - 0.06091964 * TK + 21834.37 / TK + 126.8339 * np.log10(TK) - 1684915 / (TK**2)) #KAUFMANN2003
-
     KC = 10**(-171.9065 - 0.077993 * TK + 2839.319 / TK + 71.595 * np.log10(TK))
     KH = 10**(108.3865 + 0.01985076 * TK - 6919.53 / TK - 40.45154 * np.log10(TK) + 669365 / (TK**2))
-    KS = 10**-(8.15087602 + 0.0136633623 * TC - 3.5812701e-5 * TC**2)
-    KW = 10**(22.801 - 4787.3 / TK - 0.010365 * TK - 7.1321 * np.log10(TK))
+    return K1, K2, KC, KH
+
+
+@jit
+def _calcium_equilibrium(TC, pCO2, K1, K2, KC, KH):
+    #equilibrium Ca2+ concentration and activity coefficients.  Works
+    #element-wise if the inputs are arrays.
 
     #constants for activity coefficients
     A = 0.48809 + 8.074e-4 * TC
     B = 0.3241 + 1.600e-4 * TC
 
-    #calculation of the concentrations in equilibrium at a given pCO2
-
-    Ca = 1e-3 #any starting concentration of calcium
+    Ca = 1e-3 + 0 * pCO2 #any starting concentration of calcium
 
     #calculation of the activity coefficients acoording to the boundary
     #condition IS = 3 * Ca. Equilibrium values establish after a few runs
     #(less than 10)
 
-    gammaCO2 = 1
-
     for i in range(1,11):
 
         #ionic strength
@@ -66,6 +48,40 @@ def constants(TC, pCO2):
         #calcium
         Ca = (pCO2 * K1 * KC * KH / (4 * K2 * gammaCa * gammaHCO**2))**(1.0/3)
 
+    return Ca, gammaH, gammaCa, gammaHCO, gammaOH, gammaCO3
+
+
+@jit
+def constants(TC, pCO2):
+    #calculates activity coefficients, mass action constants,
+    #reaction rate constants and concentrations of all species [mol/l] comprised in the
+    #CO2-H2O-CaCO3 system.
+
+    TK = TC + 273.16
+    if pCO2<=0:
+        pCO2=0.0000000000001
+    #temperature (only) dependent variables
+
+    #reaction rate constants
+    k1m = 10**(13.558 - 3617.1/TK)
+    k1p = 10**(329.850 - 110.54 * np.log10(TK) - 17265.4/TK)
+    k2m = 10**(14.09 - 5308/TK)
+    k2p = 10**(13.635 - 2985/TK)
+
+    #mass action constants
+    K1, K2, KC, KH = _calcium_constants(TK)
+    K5 = 1.707e-4
+    K6 = 10**(-356.3094 + 21834.37 / TK - 0.060919964 * TK + 126.8339 * np.log10(TK) - 1684915 / (TK**2))
+
+    K0 = K5 / K6                              #BUHMANN1985
+    KS = 10**-(8.15087602 + 0.0136633623 * TC - 3.5812701e-5 * TC**2)
+    KW = 10**(22.801 - 4787.3 / TK - 0.010365 * TK - 7.1321 * np.log10(TK))
+
+    #calculation of the concentrations in equilibrium at a given pCO2
+    Ca, gammaH, gammaCa, gammaHCO, gammaOH, gammaCO3 = _calcium_equilibrium(TC, pCO2, K1, K2, KC, KH)
+
+    gammaCO2 = 1
+
     #carbondioxide
     CO2 = KH * pCO2
 
@@ -98,3 +114,219 @@ def constants(TC, pCO2):
     ks = np.array([K0, K1, K2, KH])
 
     return (ac, rc, cc, mp, pH, ks)
+
+
+def calcium(TC, pCO2):
+    """
+    Equilibrium Ca2+ concentration (mol/l), i.e. `constants(TC, pCO2)[2][0]`
+
+    Unlike `constants` this works element-wise on arrays of temperature
+    (degC) and pCO2 (atm), which are broadcast against each other.
+    """
+    TC = np.asarray(TC, dtype=float)
+    pCO2 = np.asarray(pCO2, dtype=float)
+    pCO2 = np.where(pCO2 <= 0, 0.0000000000001, pCO2)
+    K1, K2, KC, KH = _calcium_constants(TC + 273.16)
+    return _calcium_equilibrium(TC, pCO2, K1, K2, KC, KH)[0]
+
+
+#memoized front end to `constants`.  The chemistry is usually evaluated at a
+#small number of (TC, pCO2) pairs (e.g. the monthly climatology of the cave),
+#so most calls can be answered from the cache.
+_cache = LRUCache(maxsize=4096)
+#optional interpolation table, see use_table
+_table = None
+
+
+def _freeze(output):
+    # cached arrays are shared between callers, so make them read-only
+    for item in output:
+        if isinstance(item, np.ndarray):
+            item.flags.writeable = False
+    return output
+
+
+def cached_constants(TC, pCO2):
+    """
+    Memoized version of `constants`
+
+    Results are kept in a bounded least-recently-used cache keyed on
+    (TC, pCO2); see `cache_info`, `cache_clear` and `set_cache_size`.  If an
+    interpolation table has been installed with `use_table`, points inside
+    the table are interpolated instead of being calculated.
+
+    The arrays in the returned tuple are shared between callers and are
+    read-only.
+    """
+    key = (float(TC), float(pCO2))
+    output = _cache.get(key)
+    if output is None:
+        if _table is not None:
+            output = _table.lookup(key[0], key[1])
+        if output is None:
+            output = constants(key[0], key[1])
+        output = _freeze(output)
+        _cache.put(key, output)
+    return output
+
+
+def cache_info():
+    """
+    Hits, misses, maximum and current size of the `cached_constants` cache
+    """
+    return _cache.info()
+
+
+def cache_clear():
+    """
+    Empty the `cached_constants` cache and reset its counters
+    """
+    _cache.clear()
+
+
+def set_cache_size(maxsize):
+    """
+    Set the maximum number of entries in the `cached_constants` cache
+    (0 disables caching)
+    """
+    _cache.resize(maxsize)
+
+
+def use_table(table):
+    """
+    Answer `cached_constants` calls from an interpolation table
+
+    Inputs
+    ------
+        - *table*
+            a ConstantsTable, or None to go back to exact calculation
+    """
+    global _table
+    _table = table
+    _cache.clear()
+    # cave contexts hold values calculated from `cached_constants`
+    from . import cave_context
+    cave_context.cache_clear()
+
+
+# sizes of the arrays returned by `constants`, pH is a scalar
+_output_sizes = (5, 7, 5, 2, None, 4)
+_pH_index = 5 + 7 + 5 + 2
+
+
+class ConstantsTable(object):
+    """
+    Bilinear interpolation table for `constants` over a temperature/pCO2 grid
+
+    The grid is uniform in temperature and in log(pCO2).  All outputs except
+    pH are interpolated as logarithms, which makes them nearly linear on the
+    grid, and pH is interpolated linearly.
+
+    When the table is built, every output is compared with `constants` at the
+    centre and edge midpoints of each grid cell, which is where the bilinear
+    interpolation error is largest.  The largest relative error is stored in
+    `max_rel_error`, and the largest error of each output (in the same layout
+    as the output of `constants`) in `rel_error`.  These bound the error
+    anywhere inside the table, up to higher order terms (the sampled maximum
+    exceeded them by less than 1% in testing).  With the default grid (0.5 degC and 24
+    points per decade of pCO2) `max_rel_error` is about 1.3e-4, set by the
+    rate constants, and the error in the Ca2+ and HCO3- concentrations used
+    by ISOLUTION is below 1e-5.  Halving the grid spacing reduces the error
+    by about a factor of four.  Points outside the grid are calculated
+    exactly.
+
+    Inputs
+    ------
+        - *TC_range*
+            (min, max) temperature, degC
+        - *pCO2_range*
+            (min, max) pCO2 (atm, i.e. ppmV/1e6)
+        - *n_TC*, *n_pCO2*
+            number of grid points in temperature and pCO2
+        - *check_error*
+            if True, calculate `max_rel_error` (needs about three evaluations
+            of `constants` per grid cell)
+
+    Usage example:
+    --------------
+    constants.use_table(constants.ConstantsTable(TC_range=(5., 15.)))
+    """
+    def __init__(self, TC_range=(0., 30.), pCO2_range=(1e-5, 0.1), n_TC=61, n_pCO2=97,
+                 check_error=True):
+        self.TC = np.linspace(TC_range[0], TC_range[1], int(n_TC))
+        self.log_pCO2 = np.linspace(np.log(pCO2_range[0]), np.log(pCO2_range[1]), int(n_pCO2))
+        self.pCO2_range = (float(pCO2_range[0]), float(pCO2_range[1]))
+        values = np.empty((len(self.TC), len(self.log_pCO2), _pH_index + 5))
+        for ii, TC in enumerate(self.TC):
+            for jj, log_pCO2 in enumerate(self.log_pCO2):
+                values[ii, jj] = self._flatten(constants(TC, np.exp(log_pCO2)))
+        self._is_log = np.ones(values.shape[-1], dtype=bool)
+        self._is_log[_pH_index] = False
+        values[..., self._is_log] = np.log(values[..., self._is_log])
+        self.values = values
+        # number of lookups inside/outside the table
+        self.hits = 0
+        self.misses = 0
+        self.max_rel_error = np.nan
+        self.rel_error = None
+        if check_error:
+            self.max_rel_error = self._check_error()
+
+    @staticmethod
+    def _flatten(output):
+        return np.concatenate([np.atleast_1d(item) for item in output])
+
+    @staticmethod
+    def _unflatten(v):
+        output = []
+        ii = 0
+        for n in _output_sizes:
+            if n is None:
+                output.append(v[ii])
+                ii += 1
+            else:
+                output.append(v[ii:ii+n])
+                ii += n
+        return tuple(output)
+
+    def _interpolate(self, TC, pCO2):
+        x = (TC - self.TC[0]) / (self.TC[1] - self.TC[0])
+        y = (np.log(pCO2) - self.log_pCO2[0]) / (self.log_pCO2[1] - self.log_pCO2[0])
+        ii = min(int(x), len(self.TC) - 2)
+        jj = min(int(y), len(self.log_pCO2) - 2)
+        fx = x - ii
+        fy = y - jj
+        t = self.values
+        v = ((1-fx)*(1-fy)*t[ii, jj] + fx*(1-fy)*t[ii+1, jj] +
+             (1-fx)*fy*t[ii, jj+1] + fx*fy*t[ii+1, jj+1])
+        v[self._is_log] = np.exp(v[self._is_log])
+        return v
+
+    def lookup(self, TC, pCO2):
+        """
+        Interpolated `constants(TC, pCO2)`, or None if outside the table
+        """
+        if not (self.TC[0] <= TC <= self.TC[-1] and
+                self.pCO2_range[0] <= pCO2 <= self.pCO2_range[1]):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._unflatten(self._interpolate(TC, pCO2))
+
+    def _check_error(self):
+        # for a locally quadratic function the bilinear interpolation error
+        # is largest either at the centre of a cell or at the middle of an
+        # edge (if the curvatures in the two directions have opposite sign)
+        TC_mid = (self.TC[1:] + self.TC[:-1]) / 2.
+        log_pCO2_mid = (self.log_pCO2[1:] + self.log_pCO2[:-1]) / 2.
+        points = ([(TC, lp) for TC in TC_mid for lp in log_pCO2_mid] +
+                  [(TC, lp) for TC in TC_mid for lp in self.log_pCO2] +
+                  [(TC, lp) for TC in self.TC for lp in log_pCO2_mid])
+        err = np.zeros(self.values.shape[-1])
+        for TC, log_pCO2 in points:
+            pCO2 = np.exp(log_pCO2)
+            exact = self._flatten(constants(TC, pCO2))
+            approx = self._interpolate(TC, pCO2)
+            err = np.maximum(err, np.abs(approx - exact) / np.abs(exact))
+        self.rel_error = self._unflatten(err)
+        return err.max()
@@ -0,0 +1,445 @@
+from __future__ import division, print_function
+import sys
+import copy
+import itertools
+import traceback
+import multiprocessing
+import numpy as np
+from . import karst_core, karst_ensemble, output as output_files
+
+#parameter sweeps and ensembles.  Each ensemble member is the base
+#configuration with some parameters replaced, and the members are run on a
+#pool of worker processes.  The forcing is sent to each worker once, when the
+#pool starts, and the tasks only contain the parameter values.
+#run_ensemble_vectorized instead advances all of the members together, see
+#karst_ensemble.
+
+
+def set_parameter(config, name, value):
+    """
+    Set a configuration parameter, in place
+
+    Nested parameters are named with dots, e.g. 'initial_conditions.soil'
+    or 'monthly_forcing.cave_temp'.
+    """
+    keys = name.split('.')
+    d = config
+    for key in keys[:-1]:
+        d = d[key]
+    d[keys[-1]] = value
+
+
+def member_config(config, params):
+    """
+    Copy of `config` with the parameters in the dict `params` replaced
+    """
+    config = copy.deepcopy(config)
+    for name, value in params.items():
+        set_parameter(config, name, value)
+    return config
+
+
+def grid_design(values):
+    """
+    All combinations of parameter values
+
+    Inputs
+    ------
+        - *values*
+            dict of parameter name: list of values
+
+    Returns
+    -------
+        - list of dicts of parameter name: value, one for each member
+
+    Usage example:
+    --------------
+    members = grid_design({'f1':[0.1, 0.2], 'initial_conditions.soil':[50., 100.]})
+    """
+    names = list(values.keys())
+    return [dict(zip(names, combination))
+            for combination in itertools.product(*[values[k] for k in names])]
+
+
+def random_design(bounds, n, seed=None):
+    """
+    Parameter values sampled independently from uniform distributions
+
+    Inputs
+    ------
+        - *bounds*
+            dict of parameter name: (low, high)
+        - *n*
+            number of members
+        - *seed*
+            seed for the random number generator
+
+    Returns
+    -------
+        - list of dicts of parameter name: value, one for each member
+    """
+    rng = np.random.RandomState(seed)
+    names = list(bounds.keys())
+    u = rng.uniform(size=(n, len(names)))
+    return _scale_samples(bounds, names, u)
+
+
+def latin_hypercube_design(bounds, n, seed=None):
+    """
+    Latin hypercube sample of parameter values
+
+    The range of each parameter is divided into `n` equal intervals and each
+    interval is sampled once (at a random point within the interval), with
+    the intervals randomly paired between parameters.
+
+    Inputs
+    ------
+        As for `random_design`
+
+    Returns
+    -------
+        - list of dicts of parameter name: value, one for each member
+    """
+    rng = np.random.RandomState(seed)
+    names = list(bounds.keys())
+    u = np.empty((n, len(names)))
+    for jj in range(len(names)):
+        u[:, jj] = (rng.permutation(n) + rng.uniform(size=n)) / n
+    return _scale_samples(bounds, names, u)
+
+
+def _scale_samples(bounds, names, u):
+    members = []
+    for row in u:
+        members.append(dict((name, bounds[name][0] + x*(bounds[name][1] - bounds[name][0]))
+                            for name, x in zip(names, row)))
+    return members
+
+
+class EnsembleResult(object):
+    """
+    Output of `run_ensemble`
+
+    Attributes
+    ----------
+        - *data*
+            array of shape (member, time, variable).  Members which failed
+            are filled with NaN.
+        - *members*
+            list of the parameter dicts for each member
+        - *tt*
+            timestep numbers
+        - *variables*
+            names of the output variables (see karst_core.OUTPUT_COLUMNS)
+        - *errors*
+            dict of member index: traceback for the members which failed
+    """
+    def __init__(self, data, members, tt, variables, errors):
+        self.data = data
+        self.members = members
+        self.tt = tt
+        self.variables = variables
+        self.errors = errors
+
+    def sel(self, variable):
+        """
+        Array of shape (member, time) for one output variable
+        """
+        return self.data[:, :, self.variables.index(variable)]
+
+    def to_dataframe(self, member):
+        """
+        Output of one member, in the same format as `karstolution`
+        """
+        import pandas as pd
+        df = pd.DataFrame(self.data[member], columns=self.variables)
+        for name in ('tt', 'mm'):
+            if name in df and not self.errors.get(member):
+                df[name] = df[name].astype(np.int64)
+        return df
+
+    def to_xarray(self):
+        """
+        The ensemble as an xarray.DataArray, with the parameter values as
+        coordinates along the member dimension
+        """
+        import xarray as xr
+        coords = {'member': np.arange(len(self.members)), 'time': self.tt,
+                  'variable': list(self.variables)}
+        for name in sorted(set(itertools.chain(*self.members))):
+            values = [m.get(name, np.nan) for m in self.members]
+            if all(np.ndim(v) == 0 for v in values):
+                coords[name] = ('member', np.array(values))
+        return xr.DataArray(self.data, dims=('member', 'time', 'variable'), coords=coords)
+
+    def write(self, output, **options):
+        """
+        Write the ensemble to an output file
+
+        Inputs
+        ------
+            - *output*
+                output file name, see output.open_sink (the format is given
+                by the extension), or an open output.OutputSink
+            - *options*
+                passed to open_sink, e.g. float32=True
+
+        Members which failed are not written (they read back as NaN from
+        NetCDF and Zarr files, and are missing from Parquet and CSV).
+        """
+        sink = _open_output(output, self.variables, self.members, options)
+        try:
+            for member in range(len(self.members)):
+                if member not in self.errors:
+                    sink.write(self.data[member], member)
+        finally:
+            if sink is not output:
+                sink.close()
+
+
+def _open_output(output, variables, members, options):
+    # the ensemble output file, with the parameters of the members as metadata
+    if isinstance(output, output_files.OutputSink):
+        return output
+    attrs = dict(options.pop('attrs', None) or {}, members=members)
+    return output_files.open_sink(output, variables, n_members=len(members), attrs=attrs,
+                                  **options)
+
+
+# arguments shared by all of the tasks on a worker, see _init_worker
+_worker_args = None
+
+
+def _init_worker(config, forcing, kwargs, rows):
+    global _worker_args
+    # output buffer, reused for each member run on the worker
+    out = np.empty((len(karst_core.OUTPUT_COLUMNS), len(forcing[0])))
+    _worker_args = (config, forcing, kwargs, rows, out)
+
+
+def _run_member(task):
+    index, params = task
+    config, forcing, kwargs, rows, out = _worker_args
+    try:
+        karst_core.run(member_config(config, params), *forcing, out=out, **kwargs)
+        return index, out[rows].T, None
+    except Exception:
+        return index, None, traceback.format_exc()
+
+
+def _print_progress(n_done, n_total):
+    print('\rensemble: {}/{} members'.format(n_done, n_total), end='', file=sys.stderr)
+    if n_done == n_total:
+        print(file=sys.stderr)
+
+
+def run_ensemble(config, df_input, param_grid_or_samples, n_workers=None,
+                 calculate_drip=True, calculate_isotope_calcite=True, variables=None,
+                 state=None, progress=None, chunksize=None, output=None, **options):
+    """
+    Run the model for each member of a parameter ensemble
+
+    Inputs
+    ------
+        - *config*
+            base configuration dict, see README
+        - *df_input*
+            forcing, as for `karstolution`
+        - *param_grid_or_samples*
+            either a dict of parameter name: list of values, which is
+            expanded with `grid_design`, or a list of dicts of parameter
+            name: value (one per member), e.g. from `latin_hypercube_design`
+            or `random_design`.  Nested parameters are named with dots, e.g.
+            'initial_conditions.soil'.
+        - *n_workers*
+            number of worker processes (default: number of CPUs).  With
+            n_workers=1 the members are run in this process.
+        - *calculate_drip*, *calculate_isotope_calcite*, *variables*, *state*
+            as for `karstolution`.  Only the output `variables` are
+            returned by the workers and stored.  All of the members start
+            from `state`, e.g. a spin-up which has been run once.
+        - *progress*
+            None for no progress reporting, True to print progress, or a
+            function called as progress(n_done, n_total) as members complete
+        - *chunksize*
+            number of members sent to a worker at a time (default: about
+            four chunks per worker)
+        - *output*
+            optional output file name, '.parquet', '.nc', '.zarr' or '.csv'
+            (see output.open_sink), with `options` passed to open_sink.
+            Each member is written as it completes, with the dimensions
+            (member, time, variable) and the parameters of the members in
+            the metadata.  See EnsembleResult.write.
+
+    Returns
+    -------
+        - *EnsembleResult*
+            with the output of every member in an array of shape
+            (member, time, variable).  Members which raise an exception are
+            filled with NaN and the traceback is stored in `errors`.
+
+    Usage example:
+    --------------
+    members = latin_hypercube_design({'f1':(0.1, 0.3), 'k_diffuse':(0.001, 0.01)}, 1000)
+    result = run_ensemble(config, df_input, members, n_workers=8, progress=True)
+    stal1 = result.sel('stal1d18o')
+    """
+    if isinstance(param_grid_or_samples, dict):
+        members = grid_design(param_grid_or_samples)
+    else:
+        members = [dict(m) for m in param_grid_or_samples]
+    if progress is True:
+        progress = _print_progress
+
+    variables, rows = karst_core.output_rows(variables)
+    forcing = karst_core.prepare_forcing(
+        *[np.asarray(df_input[name]) for name in karst_core.INPUT_COLUMNS])
+    kwargs = dict(calculate_drip=calculate_drip,
+                  calculate_isotope_calcite=karst_core.needs_isolution(
+                      variables, calculate_isotope_calcite), state=state)
+    n_total = len(members)
+    data = np.empty((n_total, len(forcing[0]), len(variables)))
+    data.fill(np.nan)
+    errors = {}
+
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    n_workers = max(1, min(n_workers, n_total))
+    if chunksize is None:
+        chunksize = max(1, n_total // (4*n_workers))
+
+    sink = None if output is None else _open_output(output, variables, members, options)
+    tasks = list(enumerate(members))
+    _init_worker(config, forcing, kwargs, rows)
+    if n_workers == 1:
+        pool = None
+        results = (_run_member(task) for task in tasks)
+    else:
+        # run the first member here, so that the numba kernels are compiled
+        # before the workers are started (on platforms where workers are
+        # forked, they inherit the compiled code)
+        first = _run_member(tasks[0])
+        pool = multiprocessing.Pool(n_workers, initializer=_init_worker,
+                                    initargs=(config, forcing, kwargs, rows))
+        results = itertools.chain([first], pool.imap_unordered(_run_member, tasks[1:], chunksize))
+    try:
+        for n_done, (index, out, error) in enumerate(results, 1):
+            if error is None:
+                data[index] = out
+                if sink is not None:
+                    sink.write(out, index)
+            else:
+                errors[index] = error
+            if progress:
+                progress(n_done, n_total)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if sink is not None and sink is not output:
+            sink.close()
+
+    return EnsembleResult(data, members, forcing[0].astype(np.int64), variables, errors)
+
+
+def ensemble_config(config, param_grid_or_samples):
+    """
+    Ensemble configuration, with each parameter which varies between the
+    members replaced by the list of its values (see
+    karst_ensemble.ensemble_values)
+
+    Inputs
+    ------
+        - *config*
+            base configuration dict
+        - *param_grid_or_samples*
+            as for `run_ensemble`
+    """
+    if isinstance(param_grid_or_samples, dict):
+        members = grid_design(param_grid_or_samples)
+    else:
+        members = [dict(m) for m in param_grid_or_samples]
+    ensemble = copy.deepcopy(config)
+    for name in sorted(set(itertools.chain(*members))):
+        # members which do not set a parameter have the base value
+        base = config
+        for key in name.split('.'):
+            base = base[key]
+        set_parameter(ensemble, name, [m.get(name, base) for m in members])
+    return ensemble
+
+
+def run_ensemble_vectorized(config, df_input, param_grid_or_samples=None,
+                            calculate_drip=True, calculate_isotope_calcite=True,
+                            variables=None, state=None, n_workers=1, output=None,
+                            **options):
+    """
+    Run the model for each member of a parameter (or forcing) ensemble, with
+    the members advanced together one month at a time
+
+    Each month of the hydrology is one set of numpy operations over all of
+    the members (see karst_ensemble), so that ensembles of thousands of
+    members cost little more than a few single runs.  ISOLUTION is run for
+    one member at a time, so for ensembles which need the stalagmite output
+    `run_ensemble` (which runs members in parallel) may be faster.
+
+    Inputs
+    ------
+        - *config*
+            configuration dict, see README.  Parameters given as a list of
+            values (or, for the `monthly_forcing` values, a list of lists of
+            12 values) vary between the members, e.g. `f1: [0.1, 0.2, 0.3]`.
+        - *df_input*
+            forcing, as for `karstolution`.  Alternatively a dict with `tt`
+            and `mm` arrays and `evpt`, `prp`, `tempp` and `d18o` arrays of
+            shape (timesteps, members) for an ensemble of forcing.
+        - *param_grid_or_samples*
+            optional parameter values for each member, as for
+            `run_ensemble`, in place of (or as well as) lists in `config`
+        - *calculate_drip*, *calculate_isotope_calcite*, *variables*, *n_workers*
+            as for `karstolution`
+        - *state*
+            ModelState to start all members from, or an ensemble state with a
+            last axis over the members (see karst_ensemble.stack_states)
+        - *output*, *options*
+            optional output file, as for `run_ensemble`.  The members are
+            written at the end of the run.
+
+    Returns
+    -------
+        - *EnsembleResult*
+            as for `run_ensemble`
+
+    Usage example:
+    --------------
+    members = latin_hypercube_design({'f1':(0.1, 0.3), 'k_diffuse':(0.001, 0.01)}, 10000)
+    result = run_ensemble_vectorized(config, df_input, members,
+                                     calculate_isotope_calcite=False)
+    kststor1 = result.sel('kststor1')
+    """
+    if param_grid_or_samples is not None:
+        config = ensemble_config(config, param_grid_or_samples)
+    variables, rows = karst_core.output_rows(variables)
+    columns = [np.asarray(df_input[name]) for name in karst_core.INPUT_COLUMNS]
+    n_forcing = max(np.shape(x)[1] if np.ndim(x) == 2 else 1 for x in columns)
+    configs, members = karst_ensemble.member_configs(config, n_forcing)
+    params = [karst_core.resolve_parameters(c, calculate_drip) for c in configs]
+    p = karst_ensemble.stack_parameters(params)
+    n_members = len(params)
+    if state is None:
+        state = karst_ensemble.stack_states([karst_core.initial_state(c) for c in configs])
+    else:
+        if np.ndim(state.stores) == 1:
+            state = karst_ensemble.stack_states([state]*n_members)
+        for ii in range(n_members):
+            karst_core.check_state(params[ii], karst_ensemble.member_state(state, ii))
+        state = karst_core.copy_state(state)
+    forcing = karst_ensemble.prepare_forcing(*(columns + [n_members]))
+    out = karst_ensemble.advance(p, params, state, forcing,
+                                 karst_core.needs_isolution(variables, calculate_isotope_calcite),
+                                 n_workers)
+    data = out[rows].transpose(2, 1, 0)
+    result = EnsembleResult(data, members, forcing[0], variables, {})
+    if output is not None:
+        result.write(output, **options)
+    return result
@@ -0,0 +1,276 @@
+from __future__ import division
+import os
+import json
+import hashlib
+import itertools
+import multiprocessing
+import numpy as np
+from .isotope_calcite_batch import isotope_transfer_coefficients, solver_code
+
+#precomputed tables of ISOLUTION over a grid of cave conditions, so that
+#runs can interpolate instead of solving the drip-water ODE.  Calcite d18O
+#is affine in the drip-water d18O (see isotope_transfer_coefficients), so the
+#table holds the slope and intercept of that relation and the growth rate.
+#
+#A table is a directory with one .npy file per field, which is memory-mapped
+#when it is loaded, and a metadata.json file with the grid, the solver
+#settings, the estimated interpolation error and a hash of the ISOLUTION
+#source code, so that a table is not used with a model it was not built for.
+
+# format of the table files
+TABLE_VERSION = 1
+
+# grid axes, in the order of the arguments of isotope_calcite
+TABLE_AXES = ['d', 'TC', 'pCO2', 'pCO2cave', 'h', 'V', 'phi']
+
+# axes interpolated in log space (the drip interval spans several orders of
+# magnitude)
+LOG_AXES = ['d']
+
+# tabulated quantities, see isotope_transfer_coefficients
+TABLE_FIELDS = ['slope', 'intercept', 'growth_rate']
+
+# source files which determine the tabulated values
+_SOURCE_FILES = ['isotope_calcite_batch.py', 'O18EVA.py', 'O18EVA_RK45.py', 'constants.py',
+                 'evaporation.py', 'cmodel_frac.py', 'cave_context.py']
+
+
+def source_hash():
+    """
+    Hash of the ISOLUTION source code and the table format
+    """
+    h = hashlib.sha256(str(TABLE_VERSION).encode())
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for filename in _SOURCE_FILES:
+        with open(os.path.join(directory, filename), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+class IsolutionTable(object):
+    """
+    Table of ISOLUTION results over a grid of cave conditions, see
+    `build_table` and `load_table`
+
+    Attributes
+    ----------
+        - *axes*
+            dict of axis name (see TABLE_AXES): grid values
+        - *fields*
+            dict of field name (see TABLE_FIELDS): array over the grid
+        - *metadata*
+            dict read from metadata.json, including `max_error`, the largest
+            interpolation error found for each field when the table was built
+    """
+    def __init__(self, axes, fields, metadata):
+        self.axes = axes
+        self.fields = fields
+        self.metadata = metadata
+        self._coords = [np.log(axes[name]) if name in LOG_AXES else np.asarray(axes[name])
+                        for name in TABLE_AXES]
+
+    def interpolate(self, d, TC, pCO2, pCO2cave, h, V, phi):
+        """
+        Multilinear interpolation of the table
+
+        Inputs
+        ------
+            - *d*, *TC*, *pCO2*, *pCO2cave*, *h*, *V*, *phi*
+                as for `isotope_calcite_batch`, arrays which broadcast
+                together.  A ValueError is raised for values outside of the
+                grid (along an axis with a single value, the value has to
+                match it).
+
+        Returns
+        -------
+            - *(slope, intercept, WMix_mm_per_year)*
+                as for `isotope_transfer_coefficients`
+        """
+        values = np.broadcast_arrays(*[np.asarray(x, dtype=float)
+                                       for x in (d, TC, pCO2, pCO2cave, h, V, phi)])
+        shape = values[0].shape
+        index = []
+        weight = []
+        for name, coords, x in zip(TABLE_AXES, self._coords, values):
+            x = x.ravel()
+            if name in LOG_AXES:
+                x = np.log(x)
+            if len(coords) == 1:
+                if not np.allclose(x, coords[0], rtol=1e-12, atol=0):
+                    raise ValueError("{} is fixed at {} in the ISOLUTION table".format(
+                        name, self.axes[name][0]))
+                index.append(np.zeros((1, x.size), dtype=np.intp))
+                weight.append(np.ones((1, x.size)))
+                continue
+            tol = 1e-12*(coords[-1] - coords[0])
+            if np.any(x < coords[0] - tol) or np.any(x > coords[-1] + tol) or np.any(np.isnan(x)):
+                raise ValueError("{} is outside of the ISOLUTION table range {} to {}".format(
+                    name, self.axes[name][0], self.axes[name][-1]))
+            lo = np.clip(np.searchsorted(coords, x, side='right') - 1, 0, len(coords) - 2)
+            frac = np.clip((x - coords[lo]) / (coords[lo + 1] - coords[lo]), 0.0, 1.0)
+            index.append(np.stack([lo, lo + 1]))
+            weight.append(np.stack([1 - frac, frac]))
+        # sum over the corners of the grid cell containing each point
+        corners = list(itertools.product(*[range(len(ii)) for ii in index]))
+        corner_index = tuple(np.stack([ii[c[k]] for c in corners])
+                             for k, ii in enumerate(index))
+        corner_weight = np.ones((len(corners), index[0].shape[1]))
+        for k, w in enumerate(weight):
+            corner_weight *= np.stack([w[c[k]] for c in corners])
+        return tuple((self.fields[name][corner_index]*corner_weight).sum(axis=0).reshape(shape)
+                     for name in TABLE_FIELDS)
+
+    def isotope_calcite(self, d, TC, pCO2, pCO2cave, h, V, phi, d18Oini, tt=0):
+        """
+        Same as `isotope_calcite_batch`, by interpolation of the table
+        """
+        slope, intercept, WMix_mm_per_year = self.interpolate(d, TC, pCO2, pCO2cave, h, V, phi)
+        return slope*d18Oini + intercept, WMix_mm_per_year
+
+
+def _grid_conditions(axes):
+    # every combination of the values of the axes other than d
+    return list(itertools.product(*[axes[name] for name in TABLE_AXES[1:]]))
+
+
+def _table_column(args):
+    d, conditions, solver, rtol = args
+    return np.stack(isotope_transfer_coefficients(d, *conditions, solver=solver, rtol=rtol))
+
+
+def build_table(path, grid, solver='euler', rtol=1e-8, n_workers=None, n_check=200,
+                seed=0):
+    """
+    Build an ISOLUTION table and save it to a directory
+
+    Inputs
+    ------
+        - *path*
+            directory to write the table to (created if needed)
+        - *grid*
+            dict of axis name (see TABLE_AXES): increasing array of values.
+            All of the axes have to be given; an axis can have a single
+            value, e.g. if the ventilation is the same in every month.  The
+            drip interval `d` is interpolated in log space, the others
+            linearly.
+        - *solver*, *rtol*
+            drip-water ODE solver settings, as for `isotope_calcite_batch`
+        - *n_workers*
+            number of processes (default: number of CPUs)
+        - *n_check*
+            number of random points in the grid at which the interpolation
+            is compared with ISOLUTION, to estimate the interpolation error
+
+    Returns
+    -------
+        - *IsolutionTable*
+            the table, with the estimated maximum interpolation error for
+            each field in metadata['max_error']
+
+    Usage example:
+    --------------
+    grid = dict(d=np.geomspace(10., 9001., 40), TC=np.linspace(5., 15., 11),
+                pCO2=[4000e-6], pCO2cave=[1000e-6], h=[0.95], V=[0.0], phi=[1.0])
+    table = build_table('isolution_table', grid)
+    print(table.metadata['max_error'])
+    """
+    missing = [name for name in TABLE_AXES if name not in grid]
+    if missing:
+        raise ValueError("ISOLUTION table grid is missing the axes {}".format(missing))
+    axes = dict((name, np.atleast_1d(np.asarray(grid[name], dtype=float))) for name in TABLE_AXES)
+    for name, values in axes.items():
+        if np.any(np.diff(values) <= 0):
+            raise ValueError("ISOLUTION table axis {} is not increasing".format(name))
+    solver_code(solver)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    shape = tuple(len(axes[name]) for name in TABLE_AXES)
+    fields = dict((name, np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+',
+                                                   dtype=float, shape=shape))
+                  for name in TABLE_FIELDS)
+
+    # the drip intervals for one set of conditions are solved together
+    conditions = _grid_conditions(axes)
+    tasks = [(axes['d'], c, solver, rtol) for c in conditions]
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    n_workers = max(1, min(n_workers, len(tasks)))
+    if n_workers == 1:
+        results = map(_table_column, tasks)
+        pool = None
+    else:
+        # compile the kernels before the workers are forked
+        _table_column((axes['d'][:1],) + tasks[0][1:])
+        pool = multiprocessing.Pool(n_workers)
+        results = pool.imap(_table_column, tasks, max(1, len(tasks) // (4*n_workers)))
+    try:
+        for index, column in zip(itertools.product(*[range(n) for n in shape[1:]]), results):
+            for name, values in zip(TABLE_FIELDS, column):
+                fields[name][(slice(None),) + index] = values
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    for values in fields.values():
+        values.flush()
+
+    metadata = dict(version=TABLE_VERSION, source_hash=source_hash(), solver=solver,
+                    rtol=rtol, fields=TABLE_FIELDS, log_axes=LOG_AXES,
+                    axes=dict((name, axes[name].tolist()) for name in TABLE_AXES))
+    table = IsolutionTable(axes, fields, metadata)
+
+    # interpolation error at random points within the grid
+    rng = np.random.RandomState(seed)
+    points = []
+    for name, coords in zip(TABLE_AXES, table._coords):
+        x = rng.uniform(coords[0], coords[-1], n_check)
+        points.append(np.exp(x) if name in LOG_AXES else x)
+    interpolated = table.interpolate(*points)
+    errors = np.empty((len(TABLE_FIELDS), n_check))
+    for ii in range(n_check):
+        exact = isotope_transfer_coefficients(
+            points[0][ii], *[x[ii] for x in points[1:]], solver=solver, rtol=rtol)
+        errors[:, ii] = [abs(a[ii] - b[0]) for a, b in zip(interpolated, exact)]
+    with np.errstate(invalid='ignore'):
+        metadata['max_error'] = dict((name, float(np.nanmax(e)) if np.any(np.isfinite(e))
+                                      else None) for name, e in zip(TABLE_FIELDS, errors))
+    metadata['n_check'] = n_check
+    with open(os.path.join(path, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, indent=1)
+    return table
+
+
+def load_table(path, check_source=True):
+    """
+    Load an ISOLUTION table written by `build_table`
+
+    The fields are memory-mapped, so only the parts of the table which are
+    used are read from disk.  A ValueError is raised if the table was built
+    with a different version of the ISOLUTION code, unless `check_source`
+    is False.
+    """
+    with open(os.path.join(path, 'metadata.json')) as f:
+        metadata = json.load(f)
+    if metadata.get('version') != TABLE_VERSION:
+        raise ValueError("{} is not a compatible ISOLUTION table".format(path))
+    if check_source and metadata.get('source_hash') != source_hash():
+        raise ValueError("The ISOLUTION table {} was built with a different version of the "
+                         "model code, rebuild it with build_table".format(path))
+    axes = dict((name, np.array(metadata['axes'][name])) for name in TABLE_AXES)
+    fields = dict((name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+                  for name in TABLE_FIELDS)
+    return IsolutionTable(axes, fields, metadata)
+
+
+# tables which have been loaded, by path
+_tables = {}
+
+
+def get_table(path):
+    """
+    The table at `path`, loaded once per process
+    """
+    path = os.path.abspath(path)
+    if path not in _tables:
+        _tables[path] = load_table(path)
+    return _tables[path]
@@ -1,21 +1,18 @@
 from __future__ import division
-from . import constants, evaporation, cmodel_frac, O18EVA_MEAN, O18EVA
+from . import cave_context, O18EVA_MEAN, O18EVA, isotope_calcite_batch
 import numpy as np
-import math
 
 #main module for the ISOLUTION part of the Karstolution model, which deals with in-cave
 #isotope fractionation. This is a translation of the matlab code from Deininger et al. (2012)
 #preserving many of the comments. However, all components related to d13C from the original model
 #have been removed (as only d18O is modelled in Karstolution)
+#
+#The drip-water ODE is solved by O18EVA.O18EVA_kernel, which keeps only the
+#present state and accumulates the loss-weighted mean isotope ratios as it
+#goes.  The O18EVA_MEAN time series are only calculated for full_output.
 
-try:
-    from numba import jit
-except ImportError:
-    # do-nothing decorator
-    jit = lambda x:x
-
-@jit
-def isotope_calcite(d, TC, pCO2, pCO2cave, h, V, phi, d18Oini, tt, full_output=False):
+def isotope_calcite(d, TC, pCO2, pCO2cave, h, V, phi, d18Oini, tt, full_output=False,
+                    solver='euler', rtol=1e-8):
     """
     The isolution part of the model
     
@@ -40,6 +37,11 @@ def isotope_calcite(d, TC, pCO2, pCO2cave, h, V, phi, d18Oini, tt, full_output=F
             initial d18O of drip water (?)
         - *tt*
             timestep (months)
+        - *solver*
+            drip-water ODE solver, 'euler' (default) or 'rk45' (adaptive step
+            size, see O18EVA_RK45).  `full_output` needs the 'euler' solver.
+        - *rtol*
+            relative tolerance for the 'rk45' solver
 
     Returns
     -------
@@ -48,7 +50,8 @@ def isotope_calcite(d, TC, pCO2, pCO2cave, h, V, phi, d18Oini, tt, full_output=F
             growth rate in mm per year
         - *(d18Ocalcite, WMix_mm_per_year), data*
             if `full_output==True`, also return *data* a dict of time-evolved 
-            chemical properties in the dripwater
+            chemical properties in the dripwater, and the number of
+            splash-mixing fixed-point iterations ('iterations')
 
     
     Usage example:
@@ -57,6 +60,13 @@ def isotope_calcite(d, TC, pCO2, pCO2cave, h, V, phi, d18Oini, tt, full_output=F
         phi,kststor118o,tt)
     
     """
+    if solver != 'euler':
+        if full_output:
+            raise ValueError("full_output is only available with the 'euler' solver")
+        ic, gr = isotope_calcite_batch.isotope_calcite_batch(d, TC, pCO2, pCO2cave, h, V, phi,
+                                                             d18Oini, tt, solver=solver, rtol=rtol)
+        return ic[0], gr[0]
+
     #boundary value constant parameters (equiv of BOUNDARY)
     R2smow = 0.00015575
     R18smow = 0.0020052
@@ -65,29 +75,21 @@ def isotope_calcite(d, TC, pCO2, pCO2cave, h, V, phi, d18Oini, tt, full_output=F
     # depth of fluid layer on the stalagmite surface[m]
     delta = 1e-4
 
-    eva=evaporation.evaporation(TC, h, V)   #Evaporationrate (mol/l)
-    e18_hco_caco, e18_hco_h2o, a18_m = cmodel_frac.cmodel_frac(TC)       #Fractionation factors
-    TK = 273.15 + TC            #Absolute temperature (K)
+    #quantities which depend only on the cave conditions, shared with the
+    #other stalagmites in the cave (see cave_context)
+    ctx = cave_context.cave_context(TC, pCO2, pCO2cave, h, V)
+    eva = ctx.eva                                                     #Evaporationrate (mol/l)
+    e18_hco_caco, e18_hco_h2o, a18_m = ctx.e18_hco_caco, ctx.e18_hco_h2o, ctx.a18_m  #Fractionation factors
     #Tau precipitation (s); t=d/a (according to Baker 98)
-    alpha = (1.188e-011 * TC**3 - 1.29e-011 * TC**2 + 7.875e-009 * TC + 4.844e-008)
-    Z = delta/alpha
+    alpha = ctx.alpha
+    Z = ctx.Z
     #Tau buffering, after Dreybrodt and Scholz (2010)
-    T = 125715.87302 - 16243.30688*TC + 1005.61111*TC**2 - 32.71852*TC**3 + 0.43333*TC**4
+    T = ctx.T
 
-    #Concentrations and mol mass
-    #Concentrations of the spezies in the solution, with respect to soil pCO2
-    outputsoil = constants.constants(TC, pCO2)
-    #Concentrations of the spezies in the solution, with respect to cave pCO2
-    outputcave = constants.constants(TC, pCO2cave)
-
-    HCOSOIL = outputsoil[2][2]                   #HCO3- concentration, with respect to soil pCO2 (mol/l)
-    HCOCAVE = outputcave[2][2]/np.sqrt(0.8)    #HCO3- concentration, with respect to cave pCO2 (mol/l)
-
-    # Ca concentrations, for calculating precipitation rate
-    CASOIL = outputsoil[2][0]
-    CACAVE = outputcave[2][0]
+    HCOSOIL = ctx.HCOSOIL                   #HCO3- concentration, with respect to soil pCO2 (mol/l)
+    HCOCAVE = ctx.HCOCAVE                   #HCO3- concentration, with respect to cave pCO2 (mol/l)
     # Excess calcium accounting for inhibiting effects [mol/m3]
-    CaEx = ( CASOIL - CACAVE / np.sqrt(0.8) ) * 1e3
+    CaEx = ctx.CaEx
 
     # if the apparent equilibrium concentration (HCOCAVE) is greater than
     # the incoming drip's concentration (HCOSOIL) then the HCO gradient
@@ -102,7 +104,8 @@ def isotope_calcite(d, TC, pCO2, pCO2cave, h, V, phi, d18Oini, tt, full_output=F
     if HCOSOIL <= HCOCAVE:
         ret = np.NaN, 0.0
         if full_output:
-            data = {'r_hco18':np.NaN, 'r_h2o18':np.NaN, 'hco':np.NaN, 'h2o':np.NaN, 'time':np.NaN}
+            data = {'r_hco18':np.NaN, 'r_h2o18':np.NaN, 'hco':np.NaN, 'h2o':np.NaN, 'time':np.NaN,
+                    'iterations':0}
             ret = (ret,data)
         return ret
 
@@ -115,11 +118,9 @@ def isotope_calcite(d, TC, pCO2, pCO2cave, h, V, phi, d18Oini, tt, full_output=F
     hco_eq = HCOCAVE*1e-4
 
     #Fractionation facors for oxygen isotope
-    eps_m = a18_m - 1
-    avl = (-7356./TK + 15.38)/1000. + 1
-    abl = 1/(e18_hco_h2o + 1)
-    a = 1/1.008
-    f = 1/6.
+    eps_m = ctx.eps_m
+    avl = ctx.avl
+    abl = ctx.abl
 
     Rdrop18_w = ( (d18Oini / 1000.) + 1) * R18smow
     Rdrop18_b = Rdrop18_w / (e18_hco_h2o + 1)
@@ -140,15 +141,18 @@ def isotope_calcite(d, TC, pCO2, pCO2cave, h, V, phi, d18Oini, tt, full_output=F
     r18res = 0
     r18mix = 1
 
-    # in the test case, this only takes one iteration
+    # in the test case, this only takes one iteration.  The splash mixing
+    # weight of the HCO3- ratio, phi_r_b, differs from one by less than
+    # (1-phi)/phi*1e-13, so the test on r_hco18 passes after the first
+    # iteration unless nearly all of the drip is lost to splash (phi < 1e-6)
     while r18mix != r18res:
 
         number += 1
 
         r18_hco_res = r_hco18_mix
 
-        temp = O18EVA.O18EVA(d, TC, pCO2, pCO2cave,  h, V, r_hco18_mix, r_h2o18_mix, Rv18, HCOMIX,
-        h2o_mix,tt)
+        temp = O18EVA.O18EVA_kernel(d, eva, alpha, T, eps_m, abl, avl, h, HCOCAVE,
+                                    r_hco18_mix, r_h2o18_mix, Rv18, HCOMIX, h2o_mix)
 
         hco_out = temp[3]                       #mol mass of hco
         h2o_out = temp[5]                       #mol mass of h2o
@@ -194,39 +198,29 @@ def isotope_calcite(d, TC, pCO2, pCO2cave, h, V, phi, d18Oini, tt, full_output=F
     seconds_peryear = 365.2425*24*60*60
     WMix_mm_per_year = WMix*1000*seconds_peryear
 
-    r_hco18, r_h2o18, hco, h2o, delta_1  = O18EVA_MEAN.O18EVA_MEAN(d,
-                TC, pCO2, pCO2cave, h, V, r_hco18_mix, r_h2o18_mix, Rv18,
-                HCOMIX, h2o_mix,tt)
-    delta_0 = delta_1[0]
-    delta_end= delta_1[-1]
-
+    # loss-weighted mean isotope ratio of the HCO3- over the drip interval
+    r_hco18_mean = O18EVA.O18EVA_kernel(d, eva, alpha, T, eps_m, abl, avl, h, HCOCAVE,
+                                        r_hco18_mix, r_h2o18_mix, Rv18, HCOMIX, h2o_mix)[6]
 
-    tmp = np.isnan(r_hco18)
-    if tmp.all() != True:
-        # use math.fsum to improve accuracy, compared to numpy.sum
-        r_hco18_mean = math.fsum( (r_hco18[:-1] + np.diff(r_hco18,n=1)/2.) * (-np.diff(hco,n=1) / (hco[0]-hco[-1]) ))
+    if not np.isnan(r_hco18_mean):
         d18Ocalcite = (r_hco18_mean*(e18_hco_caco + 1)/R18vpdb - 1)*1000
-        (r_hco18[[0,-1]]*(e18_hco_caco + 1)/R18vpdb-1)*1000
-
-        r_h2o18_mean = math.fsum( (r_h2o18[:-1] + np.diff(r_h2o18,n=1)/2.) * (-np.diff(h2o,n=1) / (h2o[0]-h2o[-1]) ))
-        d18Owater = (r_h2o18_mean/R18smow - 1)*1000
-
-        d18Ovapor = (Rv18/R18smow - 1)*1000
-
         ret = d18Ocalcite, WMix_mm_per_year
-
     else:
+        # the drip evaporates completely
         ret = np.NaN, 0.0
-    
+
     if full_output:
         # properties as function of time between drips
+        r_hco18, r_h2o18, hco, h2o, delta_1  = O18EVA_MEAN.O18EVA_MEAN_kernel(d,
+                    eva, alpha, T, eps_m, abl, avl, h, HCOCAVE, r_hco18_mix, r_h2o18_mix,
+                    Rv18, HCOMIX, h2o_mix)
         # some copy-and-paste from O18EVA_MEAN 
         # (with drip interval, d, instead of tmax)
         N_times = int(np.ceil(d + 1))
         t = np.linspace(0, d, N_times)
         data = {'r_hco18':r_hco18, 'r_h2o18':r_h2o18, 'hco':hco, 'h2o':h2o, 'time':t, 
                 'd18Ocalcite':(r_hco18*(e18_hco_caco + 1)/R18vpdb - 1)*1000,
-                'd18Owater':(r_h2o18/R18smow - 1)*1000},
+                'd18Owater':(r_h2o18/R18smow - 1)*1000, 'iterations':number},
                 
         ret = (ret,data)
     
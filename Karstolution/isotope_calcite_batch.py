@@ -0,0 +1,392 @@
+from __future__ import division
+from . import constants
+from .caching import LRUCache
+from .cave_context import cave_context, delta
+from .O18EVA import O18EVA_kernel
+from .O18EVA_RK45 import O18EVA_RK45_kernel
+import numpy as np
+
+#batched version of the ISOLUTION part of the model.  All of the stalagmites in
+#a cave see the same temperature, pCO2, humidity and ventilation in a given
+#month, so the chemistry is computed once (see cave_context) and only the
+#drip-water ODE is solved for each stalagmite (drip interval and initial d18O).
+
+try:
+    from numba import jit
+except ImportError:
+    # do-nothing decorator
+    jit = lambda x:x
+
+#boundary value constant parameters (equiv of BOUNDARY)
+R2smow = 0.00015575
+R18smow = 0.0020052
+R18vpdb = 0.0020672
+
+#drip-water ODE solvers: the ~1 s explicit Euler step of O18EVA, or the
+#adaptive Runge-Kutta solver in O18EVA_RK45
+SOLVERS = {'euler':0, 'rk45':1}
+
+
+def solver_code(solver):
+    """
+    Integer code for the named drip-water ODE solver (see SOLVERS)
+    """
+    try:
+        return SOLVERS[solver]
+    except KeyError:
+        raise ValueError("Unknown ISOLUTION solver '{}', expected one of {}".format(
+            solver, sorted(SOLVERS.keys())))
+
+
+@jit
+def _O18EVA_solve(solver, rtol, tmax, eva, alpha_p, T, eps_m, abl, avl, h, HCO_EQ,
+                  R18_hco_ini, R18_h2o_ini, R18v, HCOMIX, h2o_new):
+    if solver == 1:
+        return O18EVA_RK45_kernel(tmax, eva, alpha_p, T, eps_m, abl, avl, h, HCO_EQ,
+                                  R18_hco_ini, R18_h2o_ini, R18v, HCOMIX, h2o_new, rtol)
+    return O18EVA_kernel(tmax, eva, alpha_p, T, eps_m, abl, avl, h, HCO_EQ,
+                         R18_hco_ini, R18_h2o_ini, R18v, HCOMIX, h2o_new)
+
+
+def _growth_rate(d, Z, CaEx, phi):
+    """
+    Growth rate (mm per year) from the drip interval, the precipitation time
+    scale Z and the excess calcium CaEx, see cave_context.CaveContext
+    """
+    # initial growth rate estimate, assuming no splashing/mixing
+    W0 = 0.10009 / 2689 * delta / d * ( 1 - np.exp(-d / Z) ) * CaEx
+    # growth rate, taking into account that part of the drip is lost to splash
+    # (mixing process) truncated at 100 drips.  The splash series
+    # B = sum(r**ii, ii < n_drip) is geometric, with r the fraction of
+    # the excess calcium left from the previous drip
+    n_drip = 100
+    r = ( 1 - phi ) * np.exp(-d / Z)
+    A = r**n_drip
+    with np.errstate(divide='ignore', invalid='ignore'):
+        B = np.where(r == 1, n_drip, (1 - A) / (1 - r))
+    lambda_splash = A + phi * B
+    WMix = W0 * lambda_splash
+    seconds_peryear = 365.2425*24*60*60
+    return WMix*1000*seconds_peryear
+
+
+def growth_rate(d, TC, pCO2, pCO2cave, phi):
+    """
+    Stalagmite growth rate, without the isotope calculation of ISOLUTION
+
+    Gives the same growth rate as `isotope_calcite`, which needs the drip
+    water ODE only for the calcite d18O.  (Where the drip evaporates
+    completely, `isotope_calcite` returns a growth rate of zero along with
+    the NaN d18O, which this function does not check for.)
+
+    Inputs
+    ------
+        - *d*, *TC*, *pCO2*, *pCO2cave*, *phi*
+            as for `isotope_calcite`, scalars or arrays which broadcast
+            together
+
+    Returns
+    -------
+        - *WMix_mm_per_year*
+            growth rate in mm per year, zero where there is no calcite
+            precipitation
+
+    Usage example:
+    --------------
+    growth_rate(drip_intervals, cave_temp, drip_pco2, cave_pco2, phi)
+    """
+    # the chemistry is calculated once for each set of cave conditions, on
+    # contiguous 1-d arrays (so that the compiled kernels are reused)
+    TC, pCO2, pCO2cave = np.broadcast_arrays(
+        *[np.asarray(x, dtype=float) for x in (TC, pCO2, pCO2cave)])
+    shape = TC.shape
+    TC, pCO2, pCO2cave = [np.array(x, dtype=float).ravel() for x in (TC, pCO2, pCO2cave)]
+    #Tau precipitation (s); t=d/a (according to Baker 98)
+    alpha = (1.188e-011 * TC**3 - 1.29e-011 * TC**2 + 7.875e-009 * TC + 4.844e-008)
+    Z = delta/alpha
+    # Excess calcium accounting for inhibiting effects [mol/m3].  At
+    # equilibrium [HCO3-] = 2[Ca2+], so the test HCOSOIL <= HCOCAVE for no
+    # precipitation in isotope_calcite is CaEx <= 0
+    CaEx = ( constants.calcium(TC, pCO2) - constants.calcium(TC, pCO2cave) / np.sqrt(0.8) ) * 1e3
+    Z = Z.reshape(shape)
+    CaEx = CaEx.reshape(shape)
+    WMix_mm_per_year = _growth_rate(np.asarray(d, dtype=float), Z, CaEx,
+                                    np.asarray(phi, dtype=float))
+    return np.where(CaEx > 0, WMix_mm_per_year, 0.0)
+
+
+@jit
+def _drip_water_batch(d, d18Oini, phi, eva, alpha, T, e18_hco_h2o, a18_m, avl, abl, h,
+                      HCOSOIL, HCOCAVE, solver=0, rtol=1e-8):
+    """
+    Splash-mixing fixed point and loss-weighted mean HCO3- isotope ratio for
+    each drip interval in `d` (with initial d18O `d18Oini`), and the number
+    of fixed-point iterations and of ODE time steps for each
+    """
+    n = len(d)
+    r_hco18_mean = np.empty(n)
+    iterations = np.zeros(n, dtype=np.int64)
+    steps = np.zeros(n, dtype=np.int64)
+    eps_m = a18_m - 1
+
+    #Mol mass of the water, with respect to the volume of a single box (mol)
+    h2o_ini = 0.1/18
+    #Mol mass of the HCO3-(soil), with respect to the volume of a single box (mol)
+    hco_ini = HCOSOIL*1e-4
+
+    for jj in range(n):
+        Rdrop18_w = ( (d18Oini[jj] / 1000.) + 1) * R18smow
+        Rdrop18_b = Rdrop18_w / (e18_hco_h2o + 1)
+        Rv18 = avl * Rdrop18_w
+
+        hco_mix = hco_ini
+        h2o_mix = h2o_ini
+        HCOMIX = hco_mix / 1e-4
+        r_hco18_mix = Rdrop18_b
+        r_h2o18_mix = Rdrop18_w
+
+        if phi == 1:
+            # no splash: the mixing leaves the drip unchanged, so the fixed
+            # point is the drip itself
+            temp = _O18EVA_solve(solver, rtol, d[jj], eva, alpha, T, eps_m, abl, avl, h, HCOCAVE,
+                                 r_hco18_mix, r_h2o18_mix, Rv18, HCOMIX, h2o_mix)
+            r_hco18_mean[jj] = temp[6]
+            steps[jj] = temp[8]
+            continue
+
+        # same iteration as in isotope_calcite
+        while True:
+            iterations[jj] += 1
+            r18_hco_res = r_hco18_mix
+
+            temp = _O18EVA_solve(solver, rtol, d[jj], eva, alpha, T, eps_m, abl, avl, h, HCOCAVE,
+                                 r_hco18_mix, r_h2o18_mix, Rv18, HCOMIX, h2o_mix)
+            steps[jj] += temp[8]
+            hco_out = temp[3]
+            h2o_out = temp[5]
+            r_hco18_out = temp[0]
+            r_h2o18_out = temp[1]
+
+            hco_mix = phi*hco_ini + (1-phi)*hco_out
+            h2o_mix = phi*h2o_ini + (1-phi)*h2o_out
+
+            phi_r_b = 1 / (1 + (1-phi) / phi*hco_out*hco_ini)
+            phi_r_w = 1 / (1 + (1-phi) / phi*h2o_out/h2o_ini)
+
+            r_hco18_mix = phi_r_b*Rdrop18_b + (1-phi_r_b)*r_hco18_out
+            r_h2o18_mix = phi_r_w*Rdrop18_w + (1-phi_r_w)*r_h2o18_out
+
+            H2O_mix = h2o_mix*18/1000.
+            HCOMIX = hco_mix / H2O_mix
+
+            # O18EVA returns NaN if the droplet evaporates completely
+            if np.isnan(r_hco18_mix) or np.isnan(r18_hco_res):
+                break
+            if round(r_hco18_mix*10**13) == round(r18_hco_res*10**13):
+                break
+
+        if np.isnan(HCOMIX) or np.isnan(h2o_mix):
+            r_hco18_mean[jj] = np.nan
+        else:
+            temp = _O18EVA_solve(solver, rtol, d[jj], eva, alpha, T, eps_m, abl, avl, h, HCOCAVE,
+                                 r_hco18_mix, r_h2o18_mix, Rv18, HCOMIX, h2o_mix)
+            r_hco18_mean[jj] = temp[6]
+            steps[jj] += temp[8]
+
+    return r_hco18_mean, iterations, steps
+
+
+#number of drips solved by isotope_calcite_batch in this process, of
+#splash-mixing fixed-point iterations and ODE time steps, and of drips without
+#a result, see fixed_point_info
+_fixed_point_counts = {'drips':0, 'iterations':0, 'max_iterations':0, 'ode_steps':0,
+                       'evaporated':0, 'no_precipitation':0}
+
+
+def isotope_calcite_batch(d, TC, pCO2, pCO2cave, h, V, phi, d18Oini, tt,
+                          solver='euler', rtol=1e-8):
+    """
+    The isolution part of the model, for several stalagmites at once
+
+    Equivalent to calling `isotope_calcite` for each pair of drip interval
+    and initial d18O, but the chemistry which depends only on the cave
+    conditions is computed once.
+
+    Inputs
+    ------
+        - *d*
+            drip intervals (s), array-like
+        - *TC*, *pCO2*, *pCO2cave*, *h*, *V*, *phi*
+            scalar cave conditions, as for `isotope_calcite`
+        - *d18Oini*
+            initial d18O of drip water, array-like (broadcast against *d*)
+        - *tt*
+            timestep (months)
+        - *solver*
+            drip-water ODE solver, 'euler' (default, fixed ~1 s step) or
+            'rk45' (adaptive step size, cost independent of drip interval)
+        - *rtol*
+            relative tolerance for the 'rk45' solver
+
+    Returns
+    -------
+        - *(d18Ocalcite, WMix_mm_per_year)*
+            arrays of calcite d18O in permille VPDB and growth rate in mm per
+            year, one entry for each drip interval
+
+    Usage example:
+    --------------
+    isotope_calcite_batch([drip_interval_ks2, drip_interval_epi], cave_temp,
+        drip_pco2, cave_pco2, h, v, phi, [kststor218o, epx18o], tt)
+    """
+    solver = solver_code(solver)
+    d, d18Oini = np.broadcast_arrays(np.atleast_1d(np.asarray(d, dtype=float)),
+                                     np.asarray(d18Oini, dtype=float))
+    d = np.ascontiguousarray(d)
+    d18Oini = np.ascontiguousarray(d18Oini)
+
+    ctx = cave_context(TC, pCO2, pCO2cave, h, V)
+
+    # no calcite precipitation, see isotope_calcite
+    if ctx.HCOSOIL <= ctx.HCOCAVE:
+        _fixed_point_counts['drips'] += len(d)
+        _fixed_point_counts['no_precipitation'] += len(d)
+        return np.nan*np.ones(d.shape), np.zeros(d.shape)
+
+    r_hco18_mean, iterations, steps = _drip_water_batch(d, d18Oini, phi, ctx.eva, ctx.alpha, ctx.T,
+                                                 ctx.e18_hco_h2o, ctx.a18_m, ctx.avl, ctx.abl,
+                                                 h, ctx.HCOSOIL, ctx.HCOCAVE, solver, rtol)
+    _fixed_point_counts['drips'] += len(d)
+    _fixed_point_counts['iterations'] += int(iterations.sum())
+    _fixed_point_counts['max_iterations'] = max(_fixed_point_counts['max_iterations'],
+                                                int(iterations.max()))
+    _fixed_point_counts['ode_steps'] += int(steps.sum())
+    # the drip-water ODE gives NaN if the drip evaporates completely
+    _fixed_point_counts['evaporated'] += int(np.isnan(r_hco18_mean).sum())
+    d18Ocalcite = (r_hco18_mean*(ctx.e18_hco_caco + 1)/R18vpdb - 1)*1000
+
+    WMix_mm_per_year = _growth_rate(d, ctx.Z, ctx.CaEx, phi)
+    WMix_mm_per_year[np.isnan(d18Ocalcite)] = 0.0
+
+    return d18Ocalcite, WMix_mm_per_year
+
+
+#transfer coefficients from isotope_transfer_coefficients, keyed on the drip
+#interval and cave conditions
+_transfer_cache = LRUCache(maxsize=65536)
+
+
+def isotope_transfer_coefficients(d, TC, pCO2, pCO2cave, h, V, phi,
+                                  solver='euler', rtol=1e-8):
+    """
+    Calcite d18O as an affine function of the drip-water d18O
+
+    For fixed drip interval and cave conditions, the drip-water isotope
+    equations (O18EVA) and the splash mixing are linear in the isotope
+    ratios, so that
+
+        d18Ocalcite = slope * d18Oini + intercept
+
+    The coefficients are found from two solutions, at d18Oini = 0 and
+    d18Oini = -1000 permille (zero 18O), and are kept in a cache so that
+    evaluating other drip-water d18O values under the same conditions only
+    needs a multiply-add (see `transfer_cache_info`).
+
+    Inputs
+    ------
+        - *d*
+            drip intervals (s), array-like
+        - *TC*, *pCO2*, *pCO2cave*, *h*, *V*, *phi*, *solver*, *rtol*
+            as for `isotope_calcite_batch`
+
+    Returns
+    -------
+        - *(slope, intercept, WMix_mm_per_year)*
+            arrays with one entry for each drip interval.  `intercept` is
+            the calcite d18O (permille VPDB) for drip water with d18O = 0
+            (permille VSMOW), i.e. the fractionation offset.  The growth rate
+            does not depend on d18Oini.  Slope and intercept are NaN where
+            no calcite is formed.
+
+    Usage example:
+    --------------
+    slope, intercept, growth = isotope_transfer_coefficients([100., 200.], 10.,
+        4000e-6, 1000e-6, 0.95, 0.1, 1.0)
+    d18Ocalcite = slope * d18Oini + intercept
+    """
+    d = np.atleast_1d(np.asarray(d, dtype=float))
+    conditions = (float(TC), float(pCO2), float(pCO2cave), float(h), float(V),
+                  float(phi), solver, float(rtol))
+    values = [_transfer_cache.get((x,) + conditions) for x in d.flat]
+    missing = sorted(set(x for x, v in zip(d.flat, values) if v is None))
+    if missing:
+        n = len(missing)
+        d_missing = np.array(missing + missing)
+        d18Oini = np.r_[np.zeros(n), -1000*np.ones(n)]
+        d18Ocalcite, WMix_mm_per_year = isotope_calcite_batch(
+            d_missing, TC, pCO2, pCO2cave, h, V, phi, d18Oini, 0, solver=solver, rtol=rtol)
+        new = {}
+        for ii, x in enumerate(missing):
+            new[x] = ((d18Ocalcite[ii] - d18Ocalcite[n + ii]) / 1000., d18Ocalcite[ii],
+                      WMix_mm_per_year[ii])
+            _transfer_cache.put((x,) + conditions, new[x])
+        values = [new[x] if v is None else v for x, v in zip(d.flat, values)]
+    slope, intercept, WMix_mm_per_year = [np.array(v).reshape(d.shape) for v in zip(*values)]
+    return slope, intercept, WMix_mm_per_year
+
+
+def isotope_calcite_affine(d, TC, pCO2, pCO2cave, h, V, phi, d18Oini, tt,
+                           solver='euler', rtol=1e-8):
+    """
+    Same as `isotope_calcite_batch`, but evaluated with (cached)
+    `isotope_transfer_coefficients`
+
+    Stalagmites with the same drip interval share one pair of solutions,
+    and conditions seen before need no solution at all.  The results agree
+    with `isotope_calcite_batch` to about 1e-12 permille.
+    """
+    d, d18Oini = np.broadcast_arrays(np.atleast_1d(np.asarray(d, dtype=float)),
+                                     np.asarray(d18Oini, dtype=float))
+    slope, intercept, WMix_mm_per_year = isotope_transfer_coefficients(
+        d, TC, pCO2, pCO2cave, h, V, phi, solver=solver, rtol=rtol)
+    return slope*d18Oini + intercept, WMix_mm_per_year
+
+
+def transfer_cache_info():
+    """
+    Hits, misses, maximum and current size of the transfer coefficient cache
+    """
+    return _transfer_cache.info()
+
+
+def transfer_cache_clear():
+    """
+    Empty the transfer coefficient cache and reset its counters
+    """
+    _transfer_cache.clear()
+
+
+def fixed_point_info():
+    """
+    Number of drips solved by `isotope_calcite_batch` (in this process),
+    and the total and largest number of splash-mixing fixed-point
+    iterations
+
+    Each iteration is one solution of the drip-water ODE, and there is one
+    more solution per drip for the mean isotope ratio.  Without splash
+    (phi = 1) the fixed point is the drip itself, and no iterations are
+    needed.  `ode_steps` is the total number of ODE time steps.  Drips
+    without a result (NaN d18O) are counted in `evaporated` if the water
+    layer evaporated completely, and in `no_precipitation` if the drip
+    water is not supersaturated with respect to the cave (HCOSOIL <=
+    HCOCAVE, see isotope_calcite).
+    """
+    return dict(_fixed_point_counts)
+
+
+def fixed_point_clear():
+    """
+    Reset the counters of `fixed_point_info`
+    """
+    _fixed_point_counts.update(drips=0, iterations=0, max_iterations=0, ode_steps=0,
+                               evaporated=0, no_precipitation=0)
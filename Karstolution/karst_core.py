@@ -0,0 +1,1294 @@
+from __future__ import division
+from collections import namedtuple
+import operator
+import multiprocessing
+import numpy as np
+from scipy import signal
+from . import karst_process
+from .isotope_calcite_batch import (isotope_calcite_batch, isotope_calcite_affine, growth_rate,
+                                    solver_code)
+from . import isolution_table, profiling
+
+#array based version of the model loop in karstolution1_1/karst_process.  The
+#configuration is resolved once into a KarstParameters tuple, the hydrology and
+#tracer mixing for all timesteps run in one compiled loop, and the results are
+#written into a preallocated (variable, time) array.  ISOLUTION is then run
+#month by month on the drip intervals and drip-water d18O from the hydrology.
+#
+#karst_process.karst_process is kept as the (slow, but easy to read) reference
+#version of one model step.
+
+try:
+    from numba import jit
+except ImportError:
+    # do-nothing decorator
+    jit = lambda x:x
+
+# columns of the forcing input
+INPUT_COLUMNS = ['tt', 'mm', 'evpt', 'prp', 'tempp', 'd18o']
+
+# columns of the model output, in order
+OUTPUT_COLUMNS = ['tt','mm','f1','f3','f4','f5','f6','f7','soilstor','epxstor',
+    'kststor1','kststor2','soil18o','epx18o','kststor118o','kststor218o','dpdf[0]',
+    'stal1d18o','stal2d18o','stal3d18o','stal4d18o','stal5d18o','drip_int_stal1',
+    'drip_int_stal4','drip_int_stal3','drip_int_stal2','drip_int_stal5','cave_temp',
+    'stal1_growth_rate','stal2_growth_rate','stal3_growth_rate','stal4_growth_rate',
+    'stal5_growth_rate']
+
+# rows of the output used for ISOLUTION, with the stalagmites in the order
+# stal1 (KS2), stal4 (epikarst), stal5 (KS1), stal3 and stal2 (KS1 + bypass)
+_DRIP_ROWS = [OUTPUT_COLUMNS.index(name) for name in
+              ['drip_int_stal1', 'drip_int_stal4', 'drip_int_stal5', 'drip_int_stal3', 'drip_int_stal2']]
+_D18O_ROWS = [OUTPUT_COLUMNS.index(name) for name in
+              ['kststor218o', 'epx18o', 'kststor118o']]
+_STAL_ROWS = [OUTPUT_COLUMNS.index(name) for name in
+              ['stal1d18o', 'stal4d18o', 'stal5d18o', 'stal3d18o', 'stal2d18o']]
+_GROWTH_ROWS = [OUTPUT_COLUMNS.index(name) for name in
+                ['stal1_growth_rate', 'stal4_growth_rate', 'stal5_growth_rate',
+                 'stal3_growth_rate', 'stal2_growth_rate']]
+_CAVE_TEMP_ROW = OUTPUT_COLUMNS.index('cave_temp')
+
+# output columns which need ISOLUTION
+ISOLUTION_COLUMNS = [OUTPUT_COLUMNS[ii] for ii in _STAL_ROWS + _GROWTH_ROWS]
+
+# length of the surface temperature history used for the cave temperature
+# (months)
+N_TEMPP = 36
+
+# length of a month (days), the timestep the configuration is written for.
+# With another `timestep_days`, the flux coefficients, the Weibull delay and
+# the surface temperature history are converted, see timestep_lengths.
+MONTH_DAYS = 365.2425/12
+
+# layout of the `stores` array, which holds the scalar part of the model state
+STORE_NAMES = ['soilstor', 'soil18o', 'epxstor', 'epx18o', 'kststor1', 'kststor118o',
+               'kststor2', 'kststor218o', 'prpxp', 'd18oxp', 'difference']
+
+# ways of calculating the diffuse flow convolution, see diffuse_flow.  With
+# diffuse_flow_method 'auto', FFT convolution is used for Weibull delays of
+# more than DIFFUSE_FFT_MONTHS months.
+DIFFUSE_METHODS = ['direct', 'fft']
+DIFFUSE_FFT_MONTHS = 60
+
+# what ISOLUTION calculates: stalagmite d18O and growth rate, or only the
+# growth rate (which does not need the drip-water ODE), see advance
+CALCULATE_OPTIONS = ['all', 'growth_rate']
+
+# ways of running ISOLUTION: solving the drip-water ODE each month, or
+# interpolating a table built with isolution_table.build_table
+ISOLUTION_ENGINES = ['ode', 'table']
+
+# how often ISOLUTION runs (see isolution_blocks): every `isolution_cadence`
+# timesteps, or once for each run of timesteps in the same month
+ISOLUTION_CADENCES = ['month']
+
+# flux coefficients, fractions of a store leaving it per timestep, see
+# timestep_lengths
+_FLUX_COEFFICIENTS = ['k_f1', 'k_f3', 'k_f4', 'k_f5', 'k_f6', 'k_f7', 'k_diffuse']
+
+
+KarstParameters = namedtuple('KarstParameters', [
+    # flags
+    'calculate_drip', 'tracer_mixing_flag', 'new_f8_routing_flag',
+    # store sizes and overflow levels
+    'soilsize', 'episize', 'ks1size', 'ks2size', 'epicap', 'ovcap', 'area_ratio',
+    # flux and fractionation coefficients
+    'k_f1', 'k_f3', 'k_f4', 'k_f5', 'k_f6', 'k_f7', 'k_f8', 'k_diffuse',
+    'k_e_evap', 'k_evapf', 'k_e_evapf', 'i', 'j', 'k', 'm', 'n',
+    # weibull weights for the diffuse flow, and how they are applied (see
+    # diffuse_flow)
+    'y', 'diffuse_method',
+    # monthly forcing, arrays of length 12
+    'driprate_store_full', 'driprate_store_empty', 'drip_interval', 'cave_temp',
+    'drip_pco2', 'cave_pco2', 'h', 'v',
+    # mean of the monthly cave temperature
+    'avr_cave',
+    # ISOLUTION settings
+    'phi', 'isolution_solver', 'isolution_rtol', 'isolution_affine', 'isolution_engine',
+    'isolution_table', 'isolution_cadence',
+    # timestep length (days) and length of the surface temperature history
+    # (timesteps)
+    'timestep_days', 'n_tempp'])
+
+
+def timestep_lengths(config):
+    """
+    Timestep-dependent lengths, from `timestep_days` in the configuration
+
+    Returns
+    -------
+        - *(steps_per_month, weibull_delay_steps, n_tempp)*
+            number of timesteps per month (one for the default monthly
+            timestep), and the lengths (timesteps) of the Weibull delay and
+            of the surface temperature history
+    """
+    timestep_days = float(config.get('timestep_days', MONTH_DAYS))
+    if not timestep_days > 0:
+        raise ValueError("timestep_days has to be positive, not {}".format(timestep_days))
+    weibull_delay_months = int(config.get('weibull_delay_months', 12))
+    if timestep_days == MONTH_DAYS:
+        return 1.0, weibull_delay_months, N_TEMPP
+    steps_per_month = MONTH_DAYS/timestep_days
+    return (steps_per_month, max(1, int(round(weibull_delay_months*steps_per_month))),
+            max(1, int(round(N_TEMPP*steps_per_month))))
+
+
+def _flux_per_step(k, steps_per_month):
+    # the fraction of a store draining in one timestep, for the same
+    # fraction `k` per month (the stores are linear reservoirs)
+    if steps_per_month == 1 or not 0 <= k < 1:
+        return k
+    return 1 - (1 - k)**(1/steps_per_month)
+
+
+def resolve_parameters(config, calculate_drip=True):
+    """
+    Read the model parameters from the configuration, once
+
+    The checks and limits which karst_process applies every timestep (e.g.
+    overflow levels smaller than the store sizes, relative humidity < 1)
+    are applied here.
+
+    Inputs
+    ------
+        - *config*
+            configuration dict, see README
+        - *calculate_drip*
+            if True, drip intervals are calculated from the store levels,
+            otherwise the monthly `drip_interval` is used
+
+    Returns
+    -------
+        - *KarstParameters*
+    """
+    mf = config['monthly_forcing']
+    steps_per_month, weibull_delay_steps, n_tempp = timestep_lengths(config)
+
+    soilsize = float(config['soilstore'])
+    episize = float(config['epikarst'])
+    ks1size = float(config['ks1'])
+    ks2size = float(config['ks2'])
+    #ensuring the overflow parameters are less than the store
+    epicap = float(config['epicap'])
+    if epicap >= episize:
+        epicap = episize - 1
+    ovcap = float(config['ovicap'])
+    if ovcap >= ks2size:
+        ovcap = ks2size - 1
+
+    w = config['lambda_weibull']
+    z = config['k_weibull']
+    if config.get('use_new_weibull_definition', True):
+        y = karst_process.weibull_parameters_y(w, z, weibull_delay_steps)
+    else:
+        y = karst_process.weibull_parameters_y_original(w, z, weibull_delay_steps)
+    diffuse_method = config.get('diffuse_flow_method', 'auto')
+    if diffuse_method == 'auto':
+        if weibull_delay_steps > DIFFUSE_FFT_MONTHS:
+            diffuse_method = 'fft'
+        else:
+            diffuse_method = 'direct'
+    if diffuse_method not in DIFFUSE_METHODS:
+        raise ValueError("Unknown diffuse_flow_method '{}', expected one of {}".format(
+            diffuse_method, ['auto'] + DIFFUSE_METHODS))
+
+    def monthly(key):
+        return np.array(mf[key], dtype=float)
+
+    #making sure cave values don't become negative, or exceed one
+    v = np.maximum(monthly('ventilation'), 0)
+    drip_pco2 = monthly('drip_pco2')/1000000.0
+    drip_pco2[drip_pco2 < 0] = 0.0000000000000001
+    cave_pco2 = monthly('cave_pco2')/1000000.0
+    cave_pco2[cave_pco2 < 0] = 0.0000000000000001
+    h = np.maximum(monthly('rel_humidity'), 0)
+    h[h >= 1] = 0.99
+    phi = min(max(config['mixing_parameter_phi'], 0), 1)
+
+    isolution_solver = config.get('isolution_solver', 'euler')
+    solver_code(isolution_solver)
+    isolution_engine = config.get('isolution_engine', 'ode')
+    if isolution_engine not in ISOLUTION_ENGINES:
+        raise ValueError("Unknown isolution_engine '{}', expected one of {}".format(
+            isolution_engine, ISOLUTION_ENGINES))
+    table_path = config.get('isolution_table')
+    if isolution_engine == 'table':
+        if table_path is None:
+            raise ValueError("isolution_engine 'table' needs the path of the table in "
+                             "isolution_table")
+        # check the table now, rather than at the first ISOLUTION call
+        isolution_table.get_table(table_path)
+    isolution_cadence = config.get('isolution_cadence', 1)
+    if not (isinstance(isolution_cadence, str) and isolution_cadence in ISOLUTION_CADENCES):
+        # any integer type, e.g. numpy integers from an ensemble design
+        try:
+            if isinstance(isolution_cadence, bool):
+                raise TypeError
+            isolution_cadence = operator.index(isolution_cadence)
+        except TypeError:
+            isolution_cadence = None
+        if isolution_cadence is None or isolution_cadence < 1:
+            raise ValueError("isolution_cadence has to be a number of timesteps (>= 1) or "
+                             "one of {}, not {}".format(ISOLUTION_CADENCES,
+                                                        config.get('isolution_cadence')))
+
+    flux = dict((name, _flux_per_step(float(config[key]), steps_per_month))
+                for name, key in zip(_FLUX_COEFFICIENTS,
+                                     ['f1', 'f3', 'f4', 'f5', 'f6', 'f7', 'k_diffuse']))
+
+    return KarstParameters(
+        calculate_drip=bool(calculate_drip),
+        tracer_mixing_flag=bool(config.get('use_new_tracer_mixing_code', True)),
+        new_f8_routing_flag=bool(config.get('use_new_f8_routing', True)),
+        soilsize=soilsize, episize=episize, ks1size=ks1size, ks2size=ks2size,
+        epicap=epicap, ovcap=ovcap, area_ratio=float(config.get('area_ratio', 1.0)),
+        k_f8=float(config['f8']),
+        k_e_evap=float(config['k_eevap']), k_evapf=float(config['k_d18o_soil']),
+        k_e_evapf=float(config['k_d18o_epi']),
+        i=float(config['i']), j=float(config['j']), k=float(config['k']),
+        m=float(config['m']), n=float(config['n']),
+        y=np.ascontiguousarray(y, dtype=float), diffuse_method=diffuse_method,
+        driprate_store_full=monthly('driprate_store_full'),
+        driprate_store_empty=monthly('driprate_store_empty'),
+        drip_interval=monthly('drip_interval'),
+        cave_temp=monthly('cave_temp'),
+        drip_pco2=drip_pco2, cave_pco2=cave_pco2, h=h, v=v,
+        avr_cave=float(np.mean(mf['cave_temp'])),
+        phi=float(phi), isolution_solver=isolution_solver,
+        isolution_rtol=float(config.get('isolution_rtol', 1e-8)),
+        isolution_affine=bool(config.get('isolution_affine', False)),
+        isolution_engine=isolution_engine, isolution_table=table_path,
+        isolution_cadence=isolution_cadence,
+        timestep_days=float(config.get('timestep_days', MONTH_DAYS)), n_tempp=n_tempp,
+        **flux)
+
+
+# the model state, which is carried from one timestep to the next
+ModelState = namedtuple('ModelState', ['stores', 'dpdf', 'epdf', 'tempp'])
+
+# version of the checkpoint files written by save_state
+STATE_FILE_VERSION = 1
+
+
+def initial_state(config):
+    """
+    Model state at the start of a run, from the configuration
+
+    Returns
+    -------
+        - *ModelState(stores, dpdf, epdf, tempp)*
+            `stores` holds the store levels and d18O and the other scalar
+            state variables (see STORE_NAMES), `dpdf` and `epdf` the water
+            quantity and d18O history of the diffuse flow, and `tempp` the
+            surface temperature history
+    """
+    ic = config['initial_conditions']
+    steps_per_month, weibull_delay_steps, n_tempp = timestep_lengths(config)
+    stores = np.array([ic['soil'], ic['d18o_soil'], ic['epikarst'], ic['d18o_epikarst'],
+                       ic['ks1'], ic['d18o_ks1'], ic['ks2'], ic['d18o_ks2'],
+                       0, ic['d18o_prevrain'],
+                       # dummy value for the surface-cave temperature
+                       # difference, set when tt==1
+                       10], dtype=float)
+    dpdf = np.ones(weibull_delay_steps) * ic['diffuse']
+    epdf = np.ones(weibull_delay_steps) * ic['d18o_diffuse']
+    #36 month surface temp history for coupling surface to cave; dummy values
+    #until tt==1
+    tempp = np.arange(n_tempp, dtype=float)
+    return ModelState(stores, dpdf, epdf, tempp)
+
+
+def copy_state(state):
+    """
+    Copy of a model state (the model updates the state arrays in place)
+    """
+    return ModelState(*[np.array(x, dtype=float) for x in state])
+
+
+def check_state(p, state):
+    """
+    Raise ValueError if `state` does not fit the parameters `p`
+    """
+    sizes = (len(state.stores), len(state.dpdf), len(state.epdf), len(state.tempp))
+    expected = (len(STORE_NAMES), len(p.y), len(p.y), p.n_tempp)
+    if sizes != expected:
+        raise ValueError("Model state has array sizes {} (stores, dpdf, epdf, tempp), "
+                         "expected {}; are weibull_delay_months and timestep_days the "
+                         "same?".format(sizes, expected))
+
+
+def save_state(filename, state, n_steps=0):
+    """
+    Save a model state to a (numpy .npz) file
+
+    Inputs
+    ------
+        - *filename*
+            file name or open file
+        - *state*
+            ModelState
+        - *n_steps*
+            number of timesteps run to reach this state, stored for reference
+    """
+    np.savez(filename, version=STATE_FILE_VERSION, n_steps=n_steps,
+             store_names=np.array(STORE_NAMES), **state._asdict())
+
+
+def load_state(filename):
+    """
+    Load a model state saved by `save_state`
+
+    Returns
+    -------
+        - *(state, n_steps)*
+            the ModelState and the number of timesteps run to reach it
+    """
+    with np.load(filename) as f:
+        if int(f['version']) != STATE_FILE_VERSION or list(f['store_names']) != STORE_NAMES:
+            raise ValueError("{} is not a compatible model state file".format(filename))
+        state = ModelState(*[np.array(f[name], dtype=float) for name in ModelState._fields])
+        return state, int(f['n_steps'])
+
+
+@jit
+def _calc_flux(k, store_level):
+    # see karst_process.calc_flux
+    Q = k*store_level
+    return min(Q, store_level)
+
+
+@jit
+def _calc_drip_rate(store_level, store_capacity, driprate_store_empty, driprate_store_full):
+    # see karst_process.calc_drip_rate
+    return (store_level/store_capacity) * (driprate_store_full - driprate_store_empty) + driprate_store_empty
+
+
+@jit
+def _mix_tracer(volumes, tracer_concs, n):
+    # karst_process.mix_tracer applied to the first n entries
+    v_total = 0.0
+    for ii in range(n):
+        v_total += volumes[ii]
+    if v_total == 0:
+        mean_tracer_conc = 0.0
+        for ii in range(n):
+            mean_tracer_conc += tracer_concs[ii]
+        return mean_tracer_conc / n
+    # skip any volumes which are zero (or negative)
+    total = 0.0
+    for ii in range(n):
+        if volumes[ii] > 0:
+            total += volumes[ii]*tracer_concs[ii]
+    return total / v_total
+
+
+@jit
+def _soil_epikarst(p, stores, tempp, tt, mm, evpt, prp, tempp_in, d18o, out):
+    # first pass of `hydrology`: cave temperature, soil store and epikarst,
+    # which do not depend on the stores below them.  Writes the output rows
+    # for these terms, which are read by _karst_stores.
+    nan = np.nan
+    n_tempp = len(tempp)
+    # scratch space for the tracer mixing
+    volumes = np.empty(2)
+    isotopes = np.empty(2)
+
+    soilstor = stores[0]
+    soil18o = stores[1]
+    epxstor = stores[2]
+    epx18o = stores[3]
+    difference = stores[10]
+
+    for it in range(len(tt)):
+        mi = mm[it] - 1
+
+        #update the first value in the list with new input value
+        tempp[0] = tempp_in[it]
+        #for the first loop of the program filling tempp with the first input value
+        if tt[it] == 1:
+            for ii in range(1, n_tempp):
+                tempp[ii] = tempp[0]
+            #the difference between the surface temp and cave temp
+            difference = tempp[0] - p.avr_cave
+        #seasonlity factor for that month based on GUI cave temp inputs
+        seasonality = p.cave_temp[mi] - p.avr_cave
+        #average surface temp of last 36 months
+        avr_surfacet = 0.0
+        for ii in range(n_tempp):
+            avr_surfacet += tempp[ii]
+        avr_surfacet = avr_surfacet/n_tempp
+        cave_temp = avr_surfacet - difference + seasonality
+
+        #previous values of the state variables
+        soilstorxp = soilstor
+        soil18oxp = soil18o
+        epxstorxp = epxstor
+        epx18oxp = epx18o
+
+        #making sure the init sizes don't exceed store capacity
+        if soilstorxp > p.soilsize:
+            soilstorxp = p.soilsize - 1
+        if epxstorxp > p.episize:
+            epxstorxp = p.episize - 1
+
+        prp_t = prp[it]
+        evpt_t = evpt[it]
+        d18o_t = d18o[it]
+
+        #soil store, see karst_process for comments on the hydrology
+        if soilstorxp + prp_t - evpt_t < 0:
+            soilstor = 0.0
+            f_surface = -soilstorxp
+        else:
+            soilstor = soilstorxp + prp_t - evpt_t
+            f_surface = prp_t - evpt_t
+        if soilstor > p.soilsize:
+            soilstor = p.soilsize
+        if tempp[0] > 0.0:
+            f1 = _calc_flux(p.k_f1, soilstor)
+        else:
+            f1 = 0.0
+        soilstor = soilstor - f1
+
+        #epikarst
+        epxstor = epxstorxp + f1
+        f3 = _calc_flux(p.k_f3, epxstor)
+        diffuse_flux = _calc_flux(p.k_diffuse, epxstor - f3)
+        if epxstor - f3 - diffuse_flux > p.epicap:
+            f4 = _calc_flux(p.k_f4, epxstor - f3 - diffuse_flux - p.epicap)
+        else:
+            f4 = 0.0
+        if prp_t == 0:
+            e_evpt = p.k_e_evap*evpt_t
+        elif soilstor <= 0.1*p.soilsize:
+            e_evpt = p.k_e_evap*evpt_t*(1 - 4*soilstor/p.soilsize)
+        else:
+            e_evpt = 0.0
+        if epxstor - f3 - f4 - diffuse_flux - e_evpt < 0:
+            epxstor = 0.0
+        else:
+            epxstor = epxstor - f3 - f4 - diffuse_flux - e_evpt
+        if epxstor > p.episize:
+            epxstor = p.episize
+
+        #mixing and fractionation of soil store d18o
+        if p.tracer_mixing_flag:
+            if f_surface < 0:
+                soil18o = soil18oxp
+            else:
+                volumes[0] = f_surface
+                volumes[1] = soilstor
+                isotopes[0] = d18o_t
+                isotopes[1] = soil18oxp
+                soil18o = _mix_tracer(volumes, isotopes, 2)
+        else:
+            e = prp_t + soilstorxp
+            if e < 0.01:
+                e = 0.001
+            f = soilstorxp/e
+            g = prp_t/e
+            h_1 = d18o_t + (evpt_t*p.k_evapf)
+            soil18o = (f*soil18oxp) + (g*h_1)
+            if soil18o > 0.0001:
+                soil18o = soil18oxp
+
+        #mixing and fractionation of epikarst store d18o
+        if p.tracer_mixing_flag:
+            volumes[0] = f1
+            volumes[1] = epxstorxp
+            isotopes[0] = soil18o
+            isotopes[1] = epx18oxp + e_evpt*p.k_e_evapf
+            epx18o = _mix_tracer(volumes, isotopes, 2)
+        else:
+            b = f1 + epxstorxp
+            if b <= 0.001:
+                b = 0.001
+            epx18o = (epxstorxp/b)*(epx18oxp + e_evpt*p.k_e_evapf) + (f1/b)*soil18o
+
+        #drip interval of the stalagmite fed from the epikarst
+        stal4d18o = nan
+        if p.calculate_drip:
+            driprate = _calc_drip_rate(epxstor, p.episize, p.driprate_store_empty[mi],
+                                       p.driprate_store_full[mi])
+            if driprate <= 0:
+                stal4d18o = -99.9
+                drip_interval_epi = 9001.0
+            else:
+                drip_interval_epi = 1.0/driprate
+        else:
+            drip_interval_epi = p.drip_interval[mi]
+
+        #output, see OUTPUT_COLUMNS
+        out[0, it] = tt[it]
+        out[1, it] = mm[it]
+        out[2, it] = f1
+        out[3, it] = f3
+        out[4, it] = f4
+        out[8, it] = soilstor
+        out[9, it] = epxstor
+        out[12, it] = soil18o
+        out[13, it] = epx18o
+        out[16, it] = diffuse_flux
+        out[20, it] = stal4d18o
+        out[23, it] = drip_interval_epi
+        out[27, it] = cave_temp
+
+        for ii in range(n_tempp - 1, 0, -1):
+            tempp[ii] = tempp[ii - 1]
+
+    stores[0] = soilstor
+    stores[1] = soil18o
+    stores[2] = epxstor
+    stores[3] = epx18o
+    stores[10] = difference
+
+
+@jit
+def _diffuse_flow_direct(y, flow, flow_d18o, diffuse, diffuse_d18o, d18o_sum):
+    # see diffuse_flow
+    nd = len(y)
+    for it in range(len(diffuse)):
+        total = 0.0
+        total_d18o = 0.0
+        total_sum = 0.0
+        for ii in range(nd):
+            jj = it + nd - 1 - ii
+            volume = y[ii]*flow[jj]
+            total += volume
+            # as in _mix_tracer, volumes which are zero (or negative) are skipped
+            if volume > 0:
+                total_d18o += volume*flow_d18o[jj]
+            total_sum += flow_d18o[jj]
+        diffuse[it] = total
+        diffuse_d18o[it] = total_d18o
+        d18o_sum[it] = total_sum
+
+
+def diffuse_flow(y, flow, flow_d18o, method='direct'):
+    """
+    Diffuse flow from the epikarst to KS1, as a convolution of the history
+    of the flow leaving the epikarst with the Weibull weights
+
+    Inputs
+    ------
+        - *y*
+            Weibull weights, y[k] for a delay of k months
+        - *flow*, *flow_d18o*
+            flow leaving the epikarst and its d18O (the epikarst d18O), one
+            entry per month, oldest first.  The first len(y) - 1 entries are
+            history from before the first month to calculate.  For an
+            ensemble, these have a second axis over the members, as does `y`.
+        - *method*
+            'direct', which sums over the weights for each month, or 'fft',
+            which calculates the whole series at once by FFT convolution (cost
+            nearly independent of len(y)).  See DIFFUSE_METHODS.
+
+    Returns
+    -------
+        - *(diffuse, diffuse_d18o, d18o_sum)*
+            for each month, the diffuse flow sum(y[k]*flow[t-k]), the
+            flow-weighted d18O sum(y[k]*flow[t-k]*flow_d18o[t-k]) and the
+            unweighted sum of flow_d18o over the same window (used by the
+            tracer mixing when there is no flow at all)
+    """
+    nd = len(y)
+    if method == 'fft':
+        diffuse = signal.fftconvolve(flow, y, mode='valid', axes=0)
+        diffuse_d18o = signal.fftconvolve(flow*flow_d18o, y, mode='valid', axes=0)
+        d18o_sum = signal.fftconvolve(flow_d18o, np.ones(y.shape), mode='valid', axes=0)
+        # FFT round-off leaves small non-zero values where there is no flow,
+        # which would otherwise be mixed as (nearly) zero volumes
+        scale = np.abs(y).sum(axis=0)*np.abs(flow).max(axis=0)
+        no_flow = np.abs(diffuse) <= 1e-12*scale
+        diffuse[no_flow] = 0.0
+        diffuse_d18o[no_flow] = 0.0
+        return diffuse, diffuse_d18o, d18o_sum
+    shape = (len(flow) - nd + 1,) + flow.shape[1:]
+    diffuse = np.empty(shape)
+    diffuse_d18o = np.empty(shape)
+    d18o_sum = np.empty(shape)
+    if flow.ndim == 1:
+        _diffuse_flow_direct(y, flow, flow_d18o, diffuse, diffuse_d18o, d18o_sum)
+        return diffuse, diffuse_d18o, d18o_sum
+    results = np.empty((3, len(diffuse)))
+    for ii in range(flow.shape[1]):
+        _diffuse_flow_direct(np.ascontiguousarray(y[:, ii]), np.ascontiguousarray(flow[:, ii]),
+                             np.ascontiguousarray(flow_d18o[:, ii]), *results)
+        diffuse[:, ii], diffuse_d18o[:, ii], d18o_sum[:, ii] = results
+    return diffuse, diffuse_d18o, d18o_sum
+
+
+@jit
+def _karst_stores(p, stores, diffuse, diffuse_d18o, d18o_sum, mm, evpt, prp, d18o,
+                  out, drip_d18o):
+    # last pass of `hydrology`: KS1 and KS2, the drip water d18O and drip
+    # intervals, given the output of _soil_epikarst and the diffuse flow
+    nan = np.nan
+    nd = len(p.y)
+    # scratch space for the tracer mixing
+    volumes = np.empty(3)
+    isotopes = np.empty(3)
+
+    kststor1 = stores[4]
+    kststor118o = stores[5]
+    kststor2 = stores[6]
+    kststor218o = stores[7]
+    prpxp = stores[8]
+    d18oxp = stores[9]
+
+    for it in range(len(mm)):
+        mi = mm[it] - 1
+
+        #previous values of the state variables
+        kststor1xp = kststor1
+        kststor118oxp = kststor118o
+        kststor2xp = kststor2
+        kststor218oxp = kststor218o
+
+        #making sure the init sizes don't exceed store capacity
+        if kststor1xp > p.ks1size:
+            kststor1xp = p.ks1size - 1
+        if kststor2xp > p.ks2size:
+            kststor2xp = p.ks2size - 1
+
+        prp_t = prp[it]
+        evpt_t = evpt[it]
+        d18o_t = d18o[it]
+        f3 = out[3, it]
+        f4 = out[4, it]
+        epx18o = out[13, it]
+
+        #bypass flow from the surface
+        if prp_t > 7:
+            if p.new_f8_routing_flag:
+                f8 = (prp_t - evpt_t)*p.k_f8
+            else:
+                f8 = prp_t*p.k_f8
+        else:
+            f8 = 0.0
+
+        #KS2
+        if p.new_f8_routing_flag:
+            kststor2 = kststor2xp + f4 + f8
+        else:
+            kststor2 = kststor2xp + f4
+        if kststor2 > p.ovcap:
+            f7 = _calc_flux(p.k_f7, kststor2 - p.ovcap)
+        else:
+            f7 = 0.0
+        f6 = _calc_flux(p.k_f6, kststor2 - f7)
+        kststor2 = kststor2 - f6 - f7
+        if kststor2 > p.ks2size:
+            kststor2 = p.ks2size
+
+        #KS1
+        kststor1 = kststor1xp + f3 + diffuse[it] + f7*p.area_ratio
+        if not p.new_f8_routing_flag:
+            kststor1 += f8
+        f5 = _calc_flux(p.k_f5, kststor1)
+        kststor1 = kststor1 - f5
+        if kststor1 > p.ks1size:
+            kststor1 = p.ks1size
+
+        #mixing of kststor2 d18o
+        if p.tracer_mixing_flag:
+            volumes[0] = f4
+            volumes[1] = kststor2xp
+            isotopes[0] = epx18o
+            isotopes[1] = kststor218oxp
+            if p.new_f8_routing_flag:
+                volumes[2] = f8
+                isotopes[2] = d18o_t
+                kststor218o = _mix_tracer(volumes, isotopes, 3)
+            else:
+                kststor218o = _mix_tracer(volumes, isotopes, 2)
+        else:
+            if f4 < 0.01:
+                kststor218o = kststor218oxp
+            else:
+                b2 = f4 + kststor2xp
+                kststor218o = (kststor2xp/b2)*kststor218oxp + (f4/b2)*epx18o
+
+        #mixing of KS1 d18o, _mix_tracer with the diffuse flow from each
+        #month as a separate volume
+        if p.tracer_mixing_flag:
+            v_total = f3 + kststor1xp + diffuse[it] + f7*p.area_ratio
+            n_mix = nd + 3
+            if not p.new_f8_routing_flag:
+                v_total += f8
+                n_mix += 1
+            if v_total == 0:
+                kststor118o = epx18o + kststor118oxp + d18o_sum[it] + kststor218o
+                if not p.new_f8_routing_flag:
+                    kststor118o += d18o_t
+                kststor118o = kststor118o / n_mix
+            else:
+                total = diffuse_d18o[it]
+                if f3 > 0:
+                    total += f3*epx18o
+                if kststor1xp > 0:
+                    total += kststor1xp*kststor118oxp
+                if f7*p.area_ratio > 0:
+                    total += f7*p.area_ratio*kststor218o
+                if not p.new_f8_routing_flag and f8 > 0:
+                    total += f8*d18o_t
+                kststor118o = total / v_total
+        else:
+            b1 = f3 + kststor1xp + diffuse[it] + f7*p.area_ratio + f8
+            kststor118o = ((kststor1xp/b1)*kststor118oxp + (f3/b1)*epx18o + (diffuse_d18o[it]/b1)
+                           + (f7*p.area_ratio/b1)*kststor218o + f8/b1*d18o_t)
+
+        #bypass flow (from epikarst and direct from rain)
+        drip118o = (kststor118o*p.i) + (d18o_t*p.j) + (d18oxp*p.k)
+        drip218o = (kststor118o*p.m) + (d18o_t*p.n)
+
+        #placeholders, overwritten if ISOLUTION is run
+        stal1d18o = nan
+        stal2d18o = nan
+        stal3d18o = nan
+        stal5d18o = nan
+
+        #drip intervals
+        if p.calculate_drip:
+            empty = p.driprate_store_empty[mi]
+            full = p.driprate_store_full[mi]
+            driprate = _calc_drip_rate(kststor2, p.ks2size, empty, full)
+            if driprate <= 0:
+                stal1d18o = -99.9
+                drip_interval_ks2 = 9001.0
+            else:
+                drip_interval_ks2 = 1.0/driprate
+            driprate = _calc_drip_rate(kststor1, p.ks1size, empty, full)
+            driprate_stal3 = _calc_drip_rate(kststor1 + prp_t, p.ks1size, empty, full)
+            driprate_stal2 = _calc_drip_rate(kststor1 + prp_t + prpxp, p.ks1size, empty, full)
+            if driprate <= 0:
+                stal2d18o = -99.9
+                stal3d18o = -99.9
+                stal5d18o = -99.99
+                drip_interval_ks1 = 9001.0
+                drip_interval_stal3 = 9001.0
+                drip_interval_stal2 = 9001.0
+            else:
+                drip_interval_ks1 = 1.0/driprate
+                drip_interval_stal2 = 1.0/driprate_stal2
+                drip_interval_stal3 = 1.0/driprate_stal3
+        else:
+            drip_interval_ks2 = p.drip_interval[mi]
+            drip_interval_ks1 = p.drip_interval[mi]
+            drip_interval_stal3 = p.drip_interval[mi]
+            drip_interval_stal2 = p.drip_interval[mi]
+
+        #output, see OUTPUT_COLUMNS
+        out[5, it] = f5
+        out[6, it] = f6
+        out[7, it] = f7
+        out[10, it] = kststor1
+        out[11, it] = kststor2
+        out[14, it] = kststor118o
+        out[15, it] = kststor218o
+        out[17, it] = stal1d18o
+        out[18, it] = stal2d18o
+        out[19, it] = stal3d18o
+        out[21, it] = stal5d18o
+        out[22, it] = drip_interval_ks2
+        out[24, it] = drip_interval_stal3
+        out[25, it] = drip_interval_stal2
+        out[26, it] = drip_interval_ks1
+        for ii in range(28, 33):
+            out[ii, it] = nan
+        drip_d18o[0, it] = drip118o
+        drip_d18o[1, it] = drip218o
+
+        d18oxp = d18o_t
+        prpxp = prp_t
+
+    stores[4] = kststor1
+    stores[5] = kststor118o
+    stores[6] = kststor2
+    stores[7] = kststor218o
+    stores[8] = prpxp
+    stores[9] = d18oxp
+
+
+def hydrology(p, stores, dpdf, epdf, tempp, tt, mm, evpt, prp, tempp_in, d18o, out, drip_d18o,
+              profile=None):
+    """
+    Run the karst hydrology and tracer mixing for each timestep
+
+    This is the same calculation as karst_process (with
+    calculate_isotope_calcite=False) followed by the state update in
+    karstolution, for all of the timesteps in the input arrays.
+
+    The soil and epikarst do not depend on the stores below them, so they
+    are run first for all of the timesteps.  The diffuse flow into KS1 is
+    then a convolution of the flow leaving the epikarst with the Weibull
+    weights (see `diffuse_flow`), after which KS1 and KS2 are run.
+
+    Inputs
+    ------
+        - *p*
+            KarstParameters, see `resolve_parameters`
+        - *stores*, *dpdf*, *epdf*, *tempp*
+            model state, see `initial_state`.  These are updated in place.
+        - *tt*, *mm*, *evpt*, *prp*, *tempp_in*, *d18o*
+            forcing, one entry per timestep (see INPUT_COLUMNS)
+        - *out*
+            output array, shape (len(OUTPUT_COLUMNS), number of timesteps).
+            The stalagmite d18O rows are filled with NaN, or the -99.9/-99.99
+            placeholders if the store feeding a stalagmite has no drip, and
+            the growth rate rows with NaN.
+        - *drip_d18o*
+            output array, shape (2, number of timesteps), for the d18O of
+            the drip water feeding stalagmites 2 and 3 (KS1 + bypass flow)
+        - *profile*
+            profiling.RunProfile to record the time of each stage in, or None
+    """
+    if len(tt) == 0:
+        return
+    nd = len(dpdf)
+    with profiling.stage(profile, 'soil_epikarst'):
+        _soil_epikarst(p, stores, tempp, tt, mm, evpt, prp, tempp_in, d18o, out)
+    # flow leaving the epikarst and its d18O, oldest first.  dpdf[k] and
+    # epdf[k] are from k months before the first timestep (dpdf[0] and
+    # epdf[0] are replaced by the first timestep).
+    flow = np.concatenate([dpdf[:0:-1], out[16]])
+    flow_d18o = np.concatenate([epdf[:0:-1], out[13]])
+    with profiling.stage(profile, 'diffuse_flow'):
+        diffuse, diffuse_d18o, d18o_sum = diffuse_flow(p.y, flow, flow_d18o, p.diffuse_method)
+    with profiling.stage(profile, 'karst_stores'):
+        _karst_stores(p, stores, diffuse, diffuse_d18o, d18o_sum, mm, evpt, prp, d18o,
+                      out, drip_d18o)
+    # history for the next call
+    dpdf[1:] = flow[:-nd:-1]
+    epdf[1:] = flow_d18o[:-nd:-1]
+    dpdf[0] = stores[2]
+    epdf[0] = stores[3]
+
+
+def isolution(p, mm, out, drip_d18o, profile=None):
+    """
+    Run ISOLUTION for each timestep of the hydrology output
+
+    Fills in the stalagmite d18O and growth rate rows of `out`, see
+    `hydrology`.  If `profile` (a profiling.RunProfile) is given, the
+    stalagmites are solved one at a time, and the time and counters of each
+    are recorded in it.
+    """
+    if p.isolution_engine == 'table':
+        _isolution_table(p, mm, out, drip_d18o)
+        return
+    if profile is not None:
+        _isolution_profiled(p, mm, out, drip_d18o, profile)
+        return
+    d18o_ini = np.empty(5)
+    if p.isolution_affine:
+        solve = isotope_calcite_affine
+    else:
+        solve = isotope_calcite_batch
+    for it in range(out.shape[1]):
+        mi = mm[it] - 1
+        d18o_ini[:3] = out[_D18O_ROWS, it]
+        d18o_ini[3] = drip_d18o[1, it]
+        d18o_ini[4] = drip_d18o[0, it]
+        stal_d18o, stal_growth_rate = solve(
+            out[_DRIP_ROWS, it], out[_CAVE_TEMP_ROW, it], p.drip_pco2[mi], p.cave_pco2[mi],
+            p.h[mi], p.v[mi], p.phi, d18o_ini, out[0, it],
+            solver=p.isolution_solver, rtol=p.isolution_rtol)
+        out[_STAL_ROWS, it] = stal_d18o
+        out[_GROWTH_ROWS, it] = stal_growth_rate
+
+
+def _isolution_profiled(p, mm, out, drip_d18o, profile):
+    # same as isolution, one stalagmite at a time (which gives the same
+    # results, as the drips are solved independently)
+    if p.isolution_affine:
+        solve = isotope_calcite_affine
+    else:
+        solve = isotope_calcite_batch
+    for it in range(out.shape[1]):
+        mi = mm[it] - 1
+        d18o_ini = [out[_D18O_ROWS[0], it], out[_D18O_ROWS[1], it], out[_D18O_ROWS[2], it],
+                    drip_d18o[1, it], drip_d18o[0, it]]
+        for ii in range(len(_DRIP_ROWS)):
+            stal_d18o, stal_growth_rate = profile.solve(
+                ii, solve, out[_DRIP_ROWS[ii], it], out[_CAVE_TEMP_ROW, it], p.drip_pco2[mi],
+                p.cave_pco2[mi], p.h[mi], p.v[mi], p.phi, d18o_ini[ii], out[0, it],
+                solver=p.isolution_solver, rtol=p.isolution_rtol)
+            out[_STAL_ROWS[ii], it] = stal_d18o[0]
+            out[_GROWTH_ROWS[ii], it] = stal_growth_rate[0]
+
+
+def _isolution_table(p, mm, out, drip_d18o):
+    # all timesteps at once, by interpolation of the ISOLUTION table
+    mi = np.asarray(mm) - 1
+    d18o_ini = np.concatenate([out[_D18O_ROWS], drip_d18o[::-1]])
+    stal_d18o, stal_growth_rate = isolution_table.get_table(p.isolution_table).isotope_calcite(
+        out[_DRIP_ROWS], out[_CAVE_TEMP_ROW], p.drip_pco2[mi], p.cave_pco2[mi], p.h[mi],
+        p.v[mi], p.phi, d18o_ini)
+    out[_STAL_ROWS] = stal_d18o
+    out[_GROWTH_ROWS] = stal_growth_rate
+
+
+def growth_rates(p, mm, out):
+    """
+    Fill in the stalagmite growth rate rows of `out`, for all timesteps at
+    once, without the isotope part of ISOLUTION (the stalagmite d18O rows
+    are left as NaN)
+    """
+    mi = np.asarray(mm) - 1
+    out[_GROWTH_ROWS] = growth_rate(out[_DRIP_ROWS], out[_CAVE_TEMP_ROW], p.drip_pco2[mi],
+                                    p.cave_pco2[mi], p.phi)
+
+
+# model parameters shared by the ISOLUTION worker processes, see
+# isolution_parallel
+_worker_params = None
+
+
+def _init_isolution_worker(p):
+    global _worker_params
+    _worker_params = p
+
+
+def _isolution_block(block):
+    mm, out, drip_d18o, profile = block
+    isolution(_worker_params, mm, out, drip_d18o, profile)
+    return out[_STAL_ROWS + _GROWTH_ROWS], profile
+
+
+def isolution_parallel(p, mm, out, drip_d18o, n_workers=None, profile=None):
+    """
+    Run ISOLUTION for each timestep of the hydrology output, on a pool of
+    worker processes
+
+    The stalagmite d18O and growth rates do not feed back into the
+    hydrology, so once `hydrology` has run the timesteps are independent.
+    They are split into contiguous blocks which are solved in parallel, and
+    the output is the same as for `isolution`.
+
+    Inputs
+    ------
+        - *p*, *mm*, *out*, *drip_d18o*, *profile*
+            as for `isolution`.  The profiles of the workers are added to
+            `profile`, so the stalagmite times are summed over the workers.
+        - *n_workers*
+            number of worker processes (default: number of CPUs)
+    """
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    n = out.shape[1]
+    n_workers = max(1, min(n_workers, n))
+    if n_workers == 1 or p.isolution_engine == 'table':
+        isolution(p, mm, out, drip_d18o, profile)
+        return
+    # about four blocks per worker, to balance the load when some months
+    # (e.g. long drip intervals) are slower to solve than others
+    bounds = np.linspace(0, n, 4*n_workers + 1).astype(int)
+    blocks = [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+    # solve the first block here, so that the numba kernels are compiled
+    # before the workers are started (on platforms where workers are
+    # forked, they inherit the compiled code)
+    isolution(p, mm[blocks[0]], out[:, blocks[0]], drip_d18o[:, blocks[0]], profile)
+    rows = _STAL_ROWS + _GROWTH_ROWS
+    worker_profile = None if profile is None else profiling.RunProfile()
+    pool = multiprocessing.Pool(n_workers, initializer=_init_isolution_worker, initargs=(p,))
+    try:
+        results = pool.map(_isolution_block,
+                           [(mm[b], out[:, b], drip_d18o[:, b], worker_profile)
+                            for b in blocks[1:]])
+    finally:
+        pool.close()
+        pool.join()
+    for b, (values, block_profile) in zip(blocks[1:], results):
+        out[rows, b] = values
+        if profile is not None:
+            profile.merge(block_profile)
+
+
+def isolution_blocks(cadence, mm):
+    """
+    Start of each block of timesteps for which ISOLUTION is run once
+
+    Inputs
+    ------
+        - *cadence*
+            number of timesteps in a block, or 'month' for one block per run
+            of timesteps in the same month (see ISOLUTION_CADENCES)
+        - *mm*
+            month of each timestep
+
+    Returns
+    -------
+        - *starts*
+            index of the first timestep of each block
+    """
+    n = len(mm)
+    if cadence == 'month':
+        mm = np.asarray(mm)
+        return np.flatnonzero(np.r_[True, mm[1:] != mm[:-1]]) if n else np.zeros(0, dtype=int)
+    return np.arange(0, n, cadence)
+
+
+def aggregate_drips(mm, out, drip_d18o, starts):
+    """
+    Drip series aggregated over blocks of timesteps, as ISOLUTION input
+
+    The drip interval of each stalagmite over a block is the one with the
+    same number of drips, and the drip-water d18O is weighted by the number
+    of drips in each timestep.  The cave temperature is the block mean, and
+    the other cave conditions are those of the month of the first timestep
+    in the block.
+
+    Inputs
+    ------
+        - *mm*, *out*, *drip_d18o*
+            as for `isolution`
+        - *starts*
+            first timestep of each block, see `isolution_blocks`
+
+    Returns
+    -------
+        - *(mm, out, drip_d18o)*
+            the same, with one entry per block (the rows of `out` which are
+            not used by ISOLUTION are NaN)
+    """
+    counts = np.diff(np.r_[starts, out.shape[1]])
+    rate = 1/out[_DRIP_ROWS]
+    # drip-water d18O of each stalagmite, in the order of _DRIP_ROWS
+    d18o = np.concatenate([out[_D18O_ROWS], drip_d18o[::-1]])
+    total_rate = np.add.reduceat(rate, starts, axis=1)
+    d18o = np.add.reduceat(rate*d18o, starts, axis=1)/total_rate
+    block_out = np.full((out.shape[0], len(starts)), np.nan)
+    block_out[[0, 1]] = out[[0, 1]][:, starts]
+    block_out[_DRIP_ROWS] = counts/total_rate
+    block_out[_D18O_ROWS] = d18o[:3]
+    block_out[_CAVE_TEMP_ROW] = np.add.reduceat(out[_CAVE_TEMP_ROW], starts)/counts
+    return np.asarray(mm)[starts], block_out, np.ascontiguousarray(d18o[:2:-1])
+
+
+def isolution_scheduled(p, mm, out, drip_d18o, n_workers=1, profile=None):
+    """
+    Run ISOLUTION at the cadence `p.isolution_cadence`
+
+    With a cadence of one timestep, this is `isolution_parallel`.
+    Otherwise the drip series are aggregated over blocks of timesteps (see
+    `isolution_blocks` and `aggregate_drips`), ISOLUTION is run once for
+    each block, and the stalagmite d18O and growth rate of the block are
+    given to each of its timesteps.  Blocks do not extend across calls, so
+    for chunked runs the chunks have to be whole blocks (except the last
+    one); KarstolutionModel raises ValueError otherwise.
+
+    Inputs
+    ------
+        as for `isolution_parallel`
+    """
+    starts = isolution_blocks(p.isolution_cadence, mm)
+    if len(starts) == out.shape[1]:
+        isolution_parallel(p, mm, out, drip_d18o, n_workers, profile)
+        return
+    block_mm, block_out, block_drip_d18o = aggregate_drips(mm, out, drip_d18o, starts)
+    isolution_parallel(p, block_mm, block_out, block_drip_d18o, n_workers, profile)
+    rows = _STAL_ROWS + _GROWTH_ROWS
+    out[rows] = np.repeat(block_out[rows], np.diff(np.r_[starts, out.shape[1]]), axis=1)
+
+
+def output_rows(variables=None):
+    """
+    Rows of the output array for a list of output variable names
+
+    Inputs
+    ------
+        - *variables*
+            list of names from OUTPUT_COLUMNS, or None for all of them
+
+    Returns
+    -------
+        - *(variables, rows)*
+            the list of names and the corresponding row indices
+    """
+    if variables is None:
+        variables = list(OUTPUT_COLUMNS)
+    elif isinstance(variables, str):
+        variables = [variables]
+    else:
+        variables = list(variables)
+    unknown = [name for name in variables if name not in OUTPUT_COLUMNS]
+    if unknown:
+        raise ValueError("Unknown output variable(s) {}, expected names from {}".format(
+            unknown, OUTPUT_COLUMNS))
+    return variables, [OUTPUT_COLUMNS.index(name) for name in variables]
+
+
+def needs_isolution(variables, calculate_isotope_calcite=True):
+    """
+    True if ISOLUTION has to run to calculate the output `variables`
+    """
+    return calculate_isotope_calcite and any(name in ISOLUTION_COLUMNS for name in variables)
+
+
+def prepare_forcing(tt, mm, evpt, prp, tempp, d18o):
+    """
+    Forcing arrays in the types used by `hydrology`
+
+    The inputs can be any array-like objects, e.g. numpy arrays,
+    memory-mapped .npy files or Arrow arrays.  Inputs which are already
+    contiguous arrays of the right type (int64 for tt and mm, float64
+    otherwise) are used without copying, and are not modified.
+
+    Returns
+    -------
+        - *(tt, mm, evpt, prp, tempp, d18o)*
+            contiguous arrays, integer for tt and mm and float otherwise
+    """
+    tt = np.ascontiguousarray(tt, dtype=np.int64)
+    mm = np.ascontiguousarray(mm, dtype=np.int64)
+    evpt, prp, tempp, d18o = [np.ascontiguousarray(x, dtype=float)
+                              for x in (evpt, prp, tempp, d18o)]
+    return tt, mm, evpt, prp, tempp, d18o
+
+
+def check_output_array(out, n_rows, n):
+    """
+    Check that `out` can be filled with the output of a run, shape
+    (n_rows, n) and type float64
+    """
+    if not isinstance(out, np.ndarray) or out.shape != (n_rows, n) or out.dtype != np.float64:
+        raise ValueError("Expected a float64 output array of shape {}, got {} of shape {}".format(
+            (n_rows, n), getattr(out, 'dtype', type(out)), np.shape(out)))
+    if not out.flags.writeable:
+        raise ValueError("The output array is read-only")
+
+
+def advance(p, state, forcing, calculate_isotope_calcite=True, n_workers=1, calculate='all',
+            profile=None, out=None):
+    """
+    Run the model over the timesteps in `forcing`, starting from `state`
+
+    Inputs
+    ------
+        - *p*
+            KarstParameters, see `resolve_parameters`
+        - *state*
+            ModelState, see `initial_state`.  This is updated in place, so
+            that a run can be continued with another call.
+        - *forcing*
+            tuple of forcing arrays, see `prepare_forcing`
+        - *calculate_isotope_calcite*, *n_workers*, *calculate*
+            as for karstolution
+        - *profile*
+            profiling.RunProfile to record timings and counters in, or None
+        - *out*
+            optional C-contiguous float64 array of shape
+            (len(OUTPUT_COLUMNS), number of timesteps) to fill with the
+            output, e.g. a buffer which is reused from one run to the next
+
+    Returns
+    -------
+        - *out*
+            array of shape (len(OUTPUT_COLUMNS), number of timesteps)
+    """
+    if calculate not in CALCULATE_OPTIONS:
+        raise ValueError("Unknown calculate option '{}', expected one of {}".format(
+            calculate, CALCULATE_OPTIONS))
+    mm = forcing[1]
+    assert np.all(p.driprate_store_full[mm - 1] >= p.driprate_store_empty[mm - 1])
+    n = len(mm)
+    if out is None:
+        out = np.empty((len(OUTPUT_COLUMNS), n))
+    else:
+        check_output_array(out, len(OUTPUT_COLUMNS), n)
+        if not out.flags.c_contiguous:
+            raise ValueError("The output array must be C-contiguous")
+    drip_d18o = np.empty((2, n))
+    hydrology(p, *(tuple(state) + tuple(forcing) + (out, drip_d18o)), profile=profile)
+    if calculate_isotope_calcite:
+        if calculate == 'growth_rate':
+            with profiling.stage(profile, 'growth_rate'):
+                growth_rates(p, mm, out)
+        else:
+            with profiling.stage(profile, 'isolution'):
+                isolution_scheduled(p, mm, out, drip_d18o, n_workers, profile)
+    if profile is not None:
+        profile.months += n
+    return out
+
+
+def spin_up_state(p, state, forcing, tol=1e-6, max_cycles=10000):
+    """
+    Repeat a cycle of forcing until the model reaches a steady state
+
+    Only the hydrology and tracer mixing are run.  `tt` is offset by the
+    length of the cycle on each repeat, so the surface temperature history
+    is only reset if the first cycle starts at tt == 1.
+
+    Inputs
+    ------
+        - *p*
+            KarstParameters, see `resolve_parameters`
+        - *state*
+            ModelState to start from, updated in place
+        - *forcing*
+            tuple of forcing arrays for one cycle (e.g. a climatological
+            year), see `prepare_forcing`
+        - *tol*
+            the steady state is reached when no store level (mm) or d18O
+            (permille), including the diffuse flow history, changes by more
+            than `tol` from the end of one cycle to the end of the next
+        - *max_cycles*
+            maximum number of cycles
+
+    Returns
+    -------
+        - *(n_cycles, change)*
+            the number of cycles run and the largest change in the last one
+    """
+    n = len(forcing[0])
+    out = np.empty((len(OUTPUT_COLUMNS), n))
+    drip_d18o = np.empty((2, n))
+    # state variables which are checked for convergence
+    stores = state.stores[:STORE_NAMES.index('prpxp')]
+    previous = np.concatenate([stores, state.dpdf, state.epdf])
+    change = np.inf
+    n_cycles = 0
+    while n_cycles < max_cycles and not change < tol:
+        tt = forcing[0] + n_cycles*n
+        hydrology(p, *(tuple(state) + (tt,) + tuple(forcing[1:]) + (out, drip_d18o)))
+        n_cycles += 1
+        current = np.concatenate([stores, state.dpdf, state.epdf])
+        change = np.max(np.abs(current - previous))
+        previous = current
+    return n_cycles, change
+
+
+def run(config, tt, mm, evpt, prp, tempp, d18o, calculate_drip=True,
+        calculate_isotope_calcite=True, state=None, n_workers=1, calculate='all', out=None):
+    """
+    Run the model on arrays of forcing
+
+    Inputs
+    ------
+        - *config*
+            configuration dict, see README
+        - *tt*, *mm*, *evpt*, *prp*, *tempp*, *d18o*
+            forcing arrays, one entry per timestep (see README)
+        - *calculate_drip*, *calculate_isotope_calcite*, *n_workers*, *calculate*
+            as for karstolution
+        - *state*
+            ModelState to start from (which is not modified), default is
+            the initial state from the configuration
+        - *out*
+            optional output array to fill, see `advance`
+
+    Returns
+    -------
+        - *out*
+            array of shape (len(OUTPUT_COLUMNS), number of timesteps)
+    """
+    p = resolve_parameters(config, calculate_drip)
+    if state is None:
+        state = initial_state(config)
+    else:
+        check_state(p, state)
+        state = copy_state(state)
+    forcing = prepare_forcing(tt, mm, evpt, prp, tempp, d18o)
+    return advance(p, state, forcing, calculate_isotope_calcite, n_workers, calculate, out=out)
@@ -0,0 +1,480 @@
+from __future__ import division
+import numpy as np
+from . import karst_core
+from .karst_core import KarstParameters, ModelState
+
+#the karst hydrology and tracer mixing for many ensemble members at once.
+#Every parameter and state variable is an array over the members, and the
+#branches of the scalar model (karst_core.hydrology) are np.where
+#selections, so each month is one set of numpy operations for the whole
+#ensemble.  Array shapes have the members on the last axis.
+
+# parameters which have to be the same for all members
+COMMON_PARAMETERS = ['calculate_drip', 'tracer_mixing_flag', 'new_f8_routing_flag',
+                     'diffuse_method', 'isolution_solver', 'isolution_rtol',
+                     'isolution_affine', 'isolution_engine', 'isolution_table',
+                     'isolution_cadence', 'timestep_days', 'n_tempp']
+
+# configuration sections whose values are arrays of length 12 for a single
+# member
+_MONTHLY_SECTIONS = ['monthly_forcing']
+
+
+def ensemble_values(config):
+    """
+    Configuration values which vary between ensemble members
+
+    A parameter varies between members if it is given as a list, e.g.
+    `f1: [0.1, 0.2, 0.3]`, or for the `monthly_forcing` values a list of
+    lists of 12 values.
+
+    Returns
+    -------
+        - *values*
+            dict of parameter name (nested parameters named with dots, e.g.
+            'initial_conditions.soil'): list of values, one per member
+    """
+    values = {}
+
+    def visit(d, prefix, monthly):
+        for key, value in d.items():
+            name = prefix + key
+            if isinstance(value, dict):
+                visit(value, name + '.', key in _MONTHLY_SECTIONS)
+            elif np.ndim(value) == (2 if monthly else 1):
+                values[name] = list(value)
+
+    visit(config, '', False)
+    return values
+
+
+def member_configs(config, n_members=None):
+    """
+    Configuration for each member of an ensemble configuration (see
+    `ensemble_values`)
+
+    Returns
+    -------
+        - *(configs, members)*
+            lists of the configuration and of the dict of parameter name:
+            value for each member
+    """
+    values = ensemble_values(config)
+    lengths = set(len(v) for v in values.values())
+    if n_members is not None:
+        lengths.add(n_members)
+    lengths.discard(1)
+    if len(lengths) > 1:
+        raise ValueError("Ensemble parameters have different numbers of members: {}".format(
+            dict((name, len(v)) for name, v in values.items())))
+    n_members = lengths.pop() if lengths else 1
+    members = [dict((name, v[0] if len(v) == 1 else v[ii]) for name, v in values.items())
+               for ii in range(n_members)]
+    configs = []
+    for params in members:
+        # only the dicts are copied, values are shared with `config`
+        member = _copy_dicts(config)
+        for name, value in params.items():
+            keys = name.split('.')
+            d = member
+            for key in keys[:-1]:
+                d = d[key]
+            d[keys[-1]] = value
+        configs.append(member)
+    return configs, members
+
+
+def _copy_dicts(d):
+    return dict((key, _copy_dicts(value) if isinstance(value, dict) else value)
+                for key, value in d.items())
+
+
+def stack_parameters(params):
+    """
+    KarstParameters for an ensemble, from the parameters of each member
+
+    Numeric parameters become arrays with a last axis over the members
+    (the Weibull weights `y` have shape (weibull_delay_months, members)).
+    The parameters in COMMON_PARAMETERS and `weibull_delay_months` have to
+    be the same for all members, otherwise a ValueError is raised.
+    """
+    values = {}
+    for name in KarstParameters._fields:
+        column = [getattr(p, name) for p in params]
+        if name in COMMON_PARAMETERS:
+            if any(x != column[0] for x in column):
+                raise ValueError("{} has to be the same for all ensemble members".format(name))
+            values[name] = column[0]
+        elif name == 'y':
+            if len(set(len(y) for y in column)) > 1:
+                raise ValueError("weibull_delay_months has to be the same for all "
+                                 "ensemble members")
+            values[name] = np.stack(column, axis=-1)
+        else:
+            values[name] = np.stack([np.asarray(x, dtype=float) for x in column], axis=-1)
+    return KarstParameters(**values)
+
+
+def stack_states(states):
+    """
+    Ensemble ModelState from the state of each member, with a last axis
+    over the members
+    """
+    return ModelState(*[np.stack(x, axis=-1) for x in zip(*states)])
+
+
+def member_state(state, member):
+    """
+    ModelState of one member of an ensemble state
+    """
+    return ModelState(*[np.array(x[..., member]) for x in state])
+
+
+def _calc_flux(k, store_level):
+    # see karst_process.calc_flux
+    return np.minimum(k*store_level, store_level)
+
+
+def _calc_drip_rate(store_level, store_capacity, driprate_store_empty, driprate_store_full):
+    # see karst_process.calc_drip_rate
+    return (store_level/store_capacity) * (driprate_store_full - driprate_store_empty) + driprate_store_empty
+
+
+def _drip_interval(driprate):
+    # 1/driprate, or 9001 s (and no ISOLUTION) where there is no drip
+    no_drip = driprate <= 0
+    with np.errstate(divide='ignore'):
+        return np.where(no_drip, 9001.0, 1.0/driprate), no_drip
+
+
+def _mix_tracer(volumes, tracer_concs):
+    # see karst_core._mix_tracer
+    v_total = 0.0
+    mean_tracer_conc = 0.0
+    total = 0.0
+    for v, c in zip(volumes, tracer_concs):
+        v_total = v_total + v
+        mean_tracer_conc = mean_tracer_conc + c
+        # skip any volumes which are zero (or negative)
+        total = total + np.where(v > 0, v*c, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(v_total == 0, mean_tracer_conc / len(volumes), total / v_total)
+
+
+def _soil_epikarst(p, stores, tempp, tt, mm, evpt, prp, tempp_in, d18o, out):
+    # see karst_core._soil_epikarst
+    soilstor, soil18o, epxstor, epx18o = stores[:4]
+    difference = stores[10]
+
+    for it in range(len(tt)):
+        mi = mm[it] - 1
+
+        #surface temperature history and cave temperature
+        tempp[0] = tempp_in[it]
+        if tt[it] == 1:
+            tempp[1:] = tempp[0]
+            difference = tempp[0] - p.avr_cave
+        seasonality = p.cave_temp[mi] - p.avr_cave
+        cave_temp = tempp.sum(axis=0)/len(tempp) - difference + seasonality
+
+        #previous values of the state variables, not exceeding the store
+        #capacity
+        soilstorxp = np.where(soilstor > p.soilsize, p.soilsize - 1, soilstor)
+        soil18oxp = soil18o
+        epxstorxp = np.where(epxstor > p.episize, p.episize - 1, epxstor)
+        epx18oxp = epx18o
+
+        prp_t = prp[it]
+        evpt_t = evpt[it]
+        d18o_t = d18o[it]
+
+        #soil store
+        dry = soilstorxp + prp_t - evpt_t < 0
+        soilstor = np.where(dry, 0.0, soilstorxp + prp_t - evpt_t)
+        f_surface = np.where(dry, -soilstorxp, prp_t - evpt_t)
+        soilstor = np.minimum(soilstor, p.soilsize)
+        f1 = np.where(tempp[0] > 0.0, _calc_flux(p.k_f1, soilstor), 0.0)
+        soilstor = soilstor - f1
+
+        #epikarst
+        epxstor = epxstorxp + f1
+        f3 = _calc_flux(p.k_f3, epxstor)
+        diffuse_flux = _calc_flux(p.k_diffuse, epxstor - f3)
+        overflow = epxstor - f3 - diffuse_flux
+        f4 = np.where(overflow > p.epicap, _calc_flux(p.k_f4, overflow - p.epicap), 0.0)
+        e_evpt = np.where(prp_t == 0, p.k_e_evap*evpt_t,
+                          np.where(soilstor <= 0.1*p.soilsize,
+                                   p.k_e_evap*evpt_t*(1 - 4*soilstor/p.soilsize), 0.0))
+        remaining = epxstor - f3 - f4 - diffuse_flux - e_evpt
+        epxstor = np.minimum(np.where(remaining < 0, 0.0, remaining), p.episize)
+
+        #mixing and fractionation of soil store and epikarst d18o
+        if p.tracer_mixing_flag:
+            soil18o = np.where(f_surface < 0, soil18oxp,
+                               _mix_tracer([f_surface, soilstor], [d18o_t, soil18oxp]))
+            epx18o = _mix_tracer([f1, epxstorxp], [soil18o, epx18oxp + e_evpt*p.k_e_evapf])
+        else:
+            e = prp_t + soilstorxp
+            e = np.where(e < 0.01, 0.001, e)
+            soil18o = (soilstorxp/e)*soil18oxp + (prp_t/e)*(d18o_t + (evpt_t*p.k_evapf))
+            soil18o = np.where(soil18o > 0.0001, soil18oxp, soil18o)
+            b = f1 + epxstorxp
+            b = np.where(b <= 0.001, 0.001, b)
+            epx18o = (epxstorxp/b)*(epx18oxp + e_evpt*p.k_e_evapf) + (f1/b)*soil18o
+
+        #drip interval of the stalagmite fed from the epikarst
+        if p.calculate_drip:
+            drip_interval_epi, no_drip = _drip_interval(_calc_drip_rate(
+                epxstor, p.episize, p.driprate_store_empty[mi], p.driprate_store_full[mi]))
+            out[20, it] = np.where(no_drip, -99.9, np.nan)
+        else:
+            drip_interval_epi = p.drip_interval[mi]
+            out[20, it] = np.nan
+
+        #output, see OUTPUT_COLUMNS
+        out[0, it] = tt[it]
+        out[1, it] = mm[it]
+        out[2, it] = f1
+        out[3, it] = f3
+        out[4, it] = f4
+        out[8, it] = soilstor
+        out[9, it] = epxstor
+        out[12, it] = soil18o
+        out[13, it] = epx18o
+        out[16, it] = diffuse_flux
+        out[23, it] = drip_interval_epi
+        out[27, it] = cave_temp
+
+        tempp[1:] = tempp[:-1]
+
+    stores[0] = soilstor
+    stores[1] = soil18o
+    stores[2] = epxstor
+    stores[3] = epx18o
+    stores[10] = difference
+
+
+def _karst_stores(p, stores, diffuse, diffuse_d18o, d18o_sum, mm, evpt, prp, d18o,
+                  out, drip_d18o):
+    # see karst_core._karst_stores
+    nd = len(p.y)
+    kststor1, kststor118o, kststor2, kststor218o, prpxp, d18oxp = stores[4:10]
+
+    for it in range(len(mm)):
+        mi = mm[it] - 1
+
+        #previous values of the state variables, not exceeding the store
+        #capacity
+        kststor1xp = np.where(kststor1 > p.ks1size, p.ks1size - 1, kststor1)
+        kststor118oxp = kststor118o
+        kststor2xp = np.where(kststor2 > p.ks2size, p.ks2size - 1, kststor2)
+        kststor218oxp = kststor218o
+
+        prp_t = prp[it]
+        evpt_t = evpt[it]
+        d18o_t = d18o[it]
+        f3 = out[3, it]
+        f4 = out[4, it]
+        epx18o = out[13, it]
+
+        #bypass flow from the surface
+        if p.new_f8_routing_flag:
+            f8 = np.where(prp_t > 7, (prp_t - evpt_t)*p.k_f8, 0.0)
+        else:
+            f8 = np.where(prp_t > 7, prp_t*p.k_f8, 0.0)
+
+        #KS2
+        if p.new_f8_routing_flag:
+            kststor2 = kststor2xp + f4 + f8
+        else:
+            kststor2 = kststor2xp + f4
+        f7 = np.where(kststor2 > p.ovcap, _calc_flux(p.k_f7, kststor2 - p.ovcap), 0.0)
+        f6 = _calc_flux(p.k_f6, kststor2 - f7)
+        kststor2 = np.minimum(kststor2 - f6 - f7, p.ks2size)
+
+        #KS1
+        kststor1 = kststor1xp + f3 + diffuse[it] + f7*p.area_ratio
+        if not p.new_f8_routing_flag:
+            kststor1 = kststor1 + f8
+        f5 = _calc_flux(p.k_f5, kststor1)
+        kststor1 = np.minimum(kststor1 - f5, p.ks1size)
+
+        #mixing of kststor2 d18o
+        if p.tracer_mixing_flag:
+            if p.new_f8_routing_flag:
+                kststor218o = _mix_tracer([f4, kststor2xp, f8], [epx18o, kststor218oxp, d18o_t])
+            else:
+                kststor218o = _mix_tracer([f4, kststor2xp], [epx18o, kststor218oxp])
+        else:
+            b2 = f4 + kststor2xp
+            with np.errstate(divide='ignore', invalid='ignore'):
+                kststor218o = np.where(f4 < 0.01, kststor218oxp,
+                                       (kststor2xp/b2)*kststor218oxp + (f4/b2)*epx18o)
+
+        #mixing of KS1 d18o, _mix_tracer with the diffuse flow from each
+        #month as a separate volume
+        if p.tracer_mixing_flag:
+            v_total = f3 + kststor1xp + diffuse[it] + f7*p.area_ratio
+            mean_tracer_conc = epx18o + kststor118oxp + d18o_sum[it] + kststor218o
+            total = (diffuse_d18o[it] + np.where(f3 > 0, f3*epx18o, 0.0)
+                     + np.where(kststor1xp > 0, kststor1xp*kststor118oxp, 0.0)
+                     + np.where(f7*p.area_ratio > 0, f7*p.area_ratio*kststor218o, 0.0))
+            n_mix = nd + 3
+            if not p.new_f8_routing_flag:
+                v_total = v_total + f8
+                mean_tracer_conc = mean_tracer_conc + d18o_t
+                total = total + np.where(f8 > 0, f8*d18o_t, 0.0)
+                n_mix += 1
+            with np.errstate(divide='ignore', invalid='ignore'):
+                kststor118o = np.where(v_total == 0, mean_tracer_conc / n_mix, total / v_total)
+        else:
+            b1 = f3 + kststor1xp + diffuse[it] + f7*p.area_ratio + f8
+            with np.errstate(divide='ignore', invalid='ignore'):
+                kststor118o = ((kststor1xp/b1)*kststor118oxp + (f3/b1)*epx18o
+                               + (diffuse_d18o[it]/b1) + (f7*p.area_ratio/b1)*kststor218o
+                               + f8/b1*d18o_t)
+
+        #bypass flow (from epikarst and direct from rain)
+        drip_d18o[0, it] = (kststor118o*p.i) + (d18o_t*p.j) + (d18oxp*p.k)
+        drip_d18o[1, it] = (kststor118o*p.m) + (d18o_t*p.n)
+
+        #drip intervals, and placeholders for the stalagmite d18O
+        if p.calculate_drip:
+            empty = p.driprate_store_empty[mi]
+            full = p.driprate_store_full[mi]
+            drip_interval_ks2, no_drip_ks2 = _drip_interval(
+                _calc_drip_rate(kststor2, p.ks2size, empty, full))
+            drip_interval_ks1, no_drip_ks1 = _drip_interval(
+                _calc_drip_rate(kststor1, p.ks1size, empty, full))
+            with np.errstate(divide='ignore'):
+                drip_interval_stal3 = np.where(no_drip_ks1, 9001.0, 1.0/_calc_drip_rate(
+                    kststor1 + prp_t, p.ks1size, empty, full))
+                drip_interval_stal2 = np.where(no_drip_ks1, 9001.0, 1.0/_calc_drip_rate(
+                    kststor1 + prp_t + prpxp, p.ks1size, empty, full))
+            out[17, it] = np.where(no_drip_ks2, -99.9, np.nan)
+            out[18, it] = np.where(no_drip_ks1, -99.9, np.nan)
+            out[19, it] = out[18, it]
+            out[21, it] = np.where(no_drip_ks1, -99.99, np.nan)
+        else:
+            drip_interval_ks2 = drip_interval_ks1 = p.drip_interval[mi]
+            drip_interval_stal3 = drip_interval_stal2 = p.drip_interval[mi]
+            out[[17, 18, 19, 21], it] = np.nan
+
+        #output, see OUTPUT_COLUMNS
+        out[5, it] = f5
+        out[6, it] = f6
+        out[7, it] = f7
+        out[10, it] = kststor1
+        out[11, it] = kststor2
+        out[14, it] = kststor118o
+        out[15, it] = kststor218o
+        out[22, it] = drip_interval_ks2
+        out[24, it] = drip_interval_stal3
+        out[25, it] = drip_interval_stal2
+        out[26, it] = drip_interval_ks1
+        out[28:33, it] = np.nan
+
+        d18oxp = d18o_t
+        prpxp = prp_t
+
+    stores[4] = kststor1
+    stores[5] = kststor118o
+    stores[6] = kststor2
+    stores[7] = kststor218o
+    stores[8] = prpxp
+    stores[9] = d18oxp
+
+
+def hydrology(p, stores, dpdf, epdf, tempp, tt, mm, evpt, prp, tempp_in, d18o, out, drip_d18o):
+    """
+    Run the karst hydrology and tracer mixing for each timestep, for all of
+    the members of an ensemble
+
+    The same calculation as karst_core.hydrology, with a last axis over the
+    members on all of the arrays.
+
+    Inputs
+    ------
+        - *p*
+            ensemble KarstParameters, see `stack_parameters`
+        - *stores*, *dpdf*, *epdf*, *tempp*
+            ensemble model state, see `stack_states`.  These are updated in
+            place.
+        - *tt*, *mm*
+            timestep and month, one entry per timestep (the same for all
+            members)
+        - *evpt*, *prp*, *tempp_in*, *d18o*
+            forcing, arrays of shape (timesteps, members)
+        - *out*
+            output array, shape (len(OUTPUT_COLUMNS), timesteps, members)
+        - *drip_d18o*
+            output array, shape (2, timesteps, members)
+    """
+    if len(tt) == 0:
+        return
+    nd = len(dpdf)
+    _soil_epikarst(p, stores, tempp, tt, mm, evpt, prp, tempp_in, d18o, out)
+    flow = np.concatenate([dpdf[:0:-1], out[16]])
+    flow_d18o = np.concatenate([epdf[:0:-1], out[13]])
+    diffuse, diffuse_d18o, d18o_sum = karst_core.diffuse_flow(p.y, flow, flow_d18o,
+                                                              p.diffuse_method)
+    _karst_stores(p, stores, diffuse, diffuse_d18o, d18o_sum, mm, evpt, prp, d18o,
+                  out, drip_d18o)
+    dpdf[1:] = flow[:-nd:-1]
+    epdf[1:] = flow_d18o[:-nd:-1]
+    dpdf[0] = stores[2]
+    epdf[0] = stores[3]
+
+
+def prepare_forcing(tt, mm, evpt, prp, tempp, d18o, n_members):
+    """
+    Forcing arrays in the types and shapes used by `hydrology`
+
+    `evpt`, `prp`, `tempp` and `d18o` can be one value per timestep (the
+    same for all members) or arrays of shape (timesteps, members), e.g.
+    realizations of the forcing.
+    """
+    tt, mm = [np.ascontiguousarray(x).astype(np.int64) for x in (tt, mm)]
+    shape = (len(tt), n_members)
+    columns = []
+    for x in (evpt, prp, tempp, d18o):
+        x = np.asarray(x, dtype=float)
+        if x.ndim == 1:
+            x = x[:, np.newaxis]
+        columns.append(np.ascontiguousarray(np.broadcast_to(x, shape)))
+    return (tt, mm) + tuple(columns)
+
+
+def advance(p, params, state, forcing, calculate_isotope_calcite=True, n_workers=1):
+    """
+    Run the ensemble over the timesteps in `forcing`, starting from `state`
+
+    Inputs
+    ------
+        - *p*
+            ensemble KarstParameters, see `stack_parameters`
+        - *params*
+            list of the KarstParameters of each member, used for ISOLUTION
+        - *state*
+            ensemble ModelState, updated in place
+        - *forcing*
+            see `prepare_forcing`
+        - *calculate_isotope_calcite*, *n_workers*
+            as for karstolution.  ISOLUTION is run for one member at a time.
+
+    Returns
+    -------
+        - *out*
+            array of shape (len(OUTPUT_COLUMNS), timesteps, members)
+    """
+    mm = forcing[1]
+    assert np.all(p.driprate_store_full[mm - 1] >= p.driprate_store_empty[mm - 1])
+    n_members = len(params)
+    out = np.empty((len(karst_core.OUTPUT_COLUMNS), len(mm), n_members))
+    drip_d18o = np.empty((2, len(mm), n_members))
+    hydrology(p, *(tuple(state) + tuple(forcing) + (out, drip_d18o)))
+    if calculate_isotope_calcite:
+        for ii in range(n_members):
+            karst_core.isolution_scheduled(params[ii], mm, out[..., ii], drip_d18o[..., ii],
+                                           n_workers)
+    return out
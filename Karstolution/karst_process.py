@@ -1,7 +1,7 @@
 from __future__ import division
 from scipy import stats
 import numpy as np
-from .isotope_calcite import isotope_calcite
+from .isotope_calcite_batch import isotope_calcite_batch
 
 def weibull_parameters_y(w,z, weibull_delay_months, __cache=[None,None]):
     """
@@ -31,12 +31,12 @@ def weibull_parameters_y(w,z, weibull_delay_months, __cache=[None,None]):
         loc = 0
         weibull_lambda = w
         weibull_k = z
-        y = stats.weibull_min(loc=0.0, c=weibull_k, scale=weibull_lambda).pdf(x)
+        y = stats.weibull_min.pdf(x, weibull_k, loc=0.0, scale=weibull_lambda)
         y[0] = 0.0
         # guard against bad inputs
         y[np.logical_not(np.isfinite(y))] = 0.001
         y = y/y.sum()
-        __cache[0] = (w,z)
+        __cache[0] = (w,z,weibull_delay_months)
         __cache[1] = y
     return y
 
@@ -54,7 +54,7 @@ def weibull_parameters_y_original(w,z, weibull_delay_months, __cache=[None,None]
         v_1=stats.exponweib(w,z)
         y1=v_1.cdf(x)
         y=np.append([0],y1[1:]-y1[0:weibull_delay_months-1])
-        __cache[0] = (w,z)
+        __cache[0] = (w,z,weibull_delay_months)
         __cache[1] = y
     return y
 
@@ -191,6 +191,9 @@ calculate_isotope_calcite=True):
     new_weibull_flag = config.get('use_new_weibull_definition', True)
     # ratio of the areas of ks2 to ks1
     area_ratio = config.get('area_ratio', 1.0)
+    # drip-water ODE solver for ISOLUTION ('euler' or 'rk45') and its tolerance
+    isolution_solver = config.get('isolution_solver', 'euler')
+    isolution_rtol = config.get('isolution_rtol', 1e-8)
 
     #store size parameters  - soilstore, epikarst, ks1, ks2
     soilsize=config['soilstore']
@@ -496,10 +499,6 @@ calculate_isotope_calcite=True):
             drip_interval_ks2 = (1.0/driprate)
     else:
         drip_interval_ks2=drip_interval
-    if calculate_isotope_calcite:
-        #running the ISOLUTION part of the model
-        stal1d18o,stal1_growth_rate=isotope_calcite(drip_interval_ks2, cave_temp, drip_pco2, cave_pco2, h, v, phi,
-        kststor218o,tt)
 
 
     #same drip interval calculation for epikarst store (stalagmite 4)
@@ -512,9 +511,6 @@ calculate_isotope_calcite=True):
             drip_interval_epi = (1.0/driprate)
     else:
         drip_interval_epi=drip_interval
-    if calculate_isotope_calcite:
-        stal4d18o,stal4_growth_rate=isotope_calcite(drip_interval_epi, cave_temp, drip_pco2, cave_pco2, h, v, phi,
-        epx18o,tt)
 
     #drip interval calculations for Karst Store 1, which includes the bypass stalagmites 2 and 3.
     #Drip interval for these are
@@ -541,12 +537,16 @@ calculate_isotope_calcite=True):
         drip_interval_stal3=drip_interval
         drip_interval_stal2=drip_interval
     if calculate_isotope_calcite:
-        stal5d18o,stal5_growth_rate=isotope_calcite(drip_interval_ks1, cave_temp, drip_pco2, cave_pco2, h, v,
-        phi,kststor118o,tt)
-        stal3d18o,stal3_growth_rate=isotope_calcite(drip_interval_stal3, cave_temp, drip_pco2, cave_pco2, h, v,
-        phi,drip218o,tt)
-        stal2d18o,stal2_growth_rate=isotope_calcite(drip_interval_stal2, cave_temp, drip_pco2, cave_pco2, h, v,
-        phi,drip118o,tt)
+        #running the ISOLUTION part of the model, all five stalagmites share
+        #the same cave conditions so they are solved together
+        stal_d18o,stal_growth_rate=isotope_calcite_batch(
+            [drip_interval_ks2, drip_interval_epi, drip_interval_ks1, drip_interval_stal3, drip_interval_stal2],
+            cave_temp, drip_pco2, cave_pco2, h, v, phi,
+            [kststor218o, epx18o, kststor118o, drip218o, drip118o], tt,
+            solver=isolution_solver, rtol=isolution_rtol)
+        stal1d18o,stal4d18o,stal5d18o,stal3d18o,stal2d18o = stal_d18o
+        (stal1_growth_rate, stal4_growth_rate, stal5_growth_rate, stal3_growth_rate,
+        stal2_growth_rate) = stal_growth_rate
 
     #returning the values to karstolution1.1 module to  be written to output
     return [tt,mm,f1,f3,f4,f5,f6,f7,soilstor,epxstor,kststor1,kststor2,soil18o,epx18o,kststor118o,
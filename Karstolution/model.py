@@ -0,0 +1,287 @@
+from __future__ import division
+import warnings
+import numpy as np
+from . import karst_core, profiling, output as output_files
+
+#stateful interface to the model, for running long forcing series in chunks.
+#The model state (store levels and d18O, the diffuse flow history and the
+#surface temperature history) is carried from one chunk to the next, so the
+#output is the same as for a single run over the whole series.
+
+
+class KarstolutionModel(object):
+    """
+    Karstolution model which can be run forward a chunk of forcing at a time
+
+    Inputs
+    ------
+        - *config*
+            configuration dict, see README
+        - *calculate_drip*, *calculate_isotope_calcite*, *variables*, *n_workers*,
+          *calculate*, *profile*
+            as for `karstolution`
+        - *state*
+            karst_core.ModelState to start from, e.g. the end of a spin-up
+            run (it is copied, not modified).  Default is the initial state
+            from the configuration.
+
+    Attributes
+    ----------
+        - *state*
+            the model state after the last timestep run, see
+            karst_core.initial_state
+        - *n_steps*
+            number of timesteps run so far
+        - *profile*
+            profiling.RunProfile, with the timings and counters of all of the
+            chunks run so far (None unless `profile` is True)
+
+    The state can be saved with `save_state` and a run continued later from
+    the saved state with `load_state`.
+
+    With an `isolution_cadence` other than 1, each chunk except the last has
+    to end on an ISOLUTION block boundary (see karst_core.isolution_scheduled),
+    and `run` raises ValueError for a chunk which continues a block.
+
+    Usage example:
+    --------------
+    model = KarstolutionModel(config)
+    reader = pd.read_csv('input.csv', chunksize=12000)
+    for df_output in model.run_chunks(reader, output='output.parquet'):
+        print(df_output['stal1d18o'].mean())
+    """
+    def __init__(self, config, calculate_drip=True, calculate_isotope_calcite=True,
+                 variables=None, state=None, n_workers=1, calculate='all', profile=False):
+        if calculate not in karst_core.CALCULATE_OPTIONS:
+            raise ValueError("Unknown calculate option '{}', expected one of {}".format(
+                calculate, karst_core.CALCULATE_OPTIONS))
+        self.params = karst_core.resolve_parameters(config, calculate_drip)
+        self.variables, self._rows = karst_core.output_rows(variables)
+        self.calculate_isotope_calcite = karst_core.needs_isolution(
+            self.variables, calculate_isotope_calcite)
+        self.n_workers = n_workers
+        self.calculate = calculate
+        self.profile = profiling.RunProfile() if profile else None
+        self.state = karst_core.initial_state(config)
+        self.n_steps = 0
+        self._open_block = None
+        if state is not None:
+            self.set_state(state)
+
+    def set_state(self, state, n_steps=0):
+        """
+        Continue the run from a copy of `state`
+        """
+        karst_core.check_state(self.params, state)
+        self.state = karst_core.copy_state(state)
+        self.n_steps = n_steps
+        self._open_block = None
+
+    def save_state(self, filename):
+        """
+        Save the model state (and the number of timesteps run) to a file
+        """
+        karst_core.save_state(filename, self.state, self.n_steps)
+
+    def load_state(self, filename):
+        """
+        Continue the run from a state saved with `save_state`
+        """
+        state, n_steps = karst_core.load_state(filename)
+        self.set_state(state, n_steps)
+
+    def spin_up(self, df_climatology, tol=1e-6, max_cycles=10000):
+        """
+        Bring the model to a steady state by repeating a cycle of forcing
+
+        See `spin_up`.  The run then continues from the steady state, with
+        the timestep count reset to zero.
+
+        Returns
+        -------
+            - *n_cycles*
+                the number of cycles run
+        """
+        forcing = karst_core.prepare_forcing(
+            *[np.asarray(df_climatology[name]) for name in karst_core.INPUT_COLUMNS])
+        n_cycles, change = karst_core.spin_up_state(self.params, self.state, forcing,
+                                                    tol, max_cycles)
+        if not change < tol:
+            warnings.warn("Spin-up did not reach a steady state after {} cycles "
+                          "(last change {:g})".format(n_cycles, change))
+        self.n_steps = 0
+        self._open_block = None
+        return n_cycles
+
+    def _check_isolution_blocks(self, mm):
+        # ISOLUTION blocks (see karst_core.isolution_scheduled) do not extend
+        # across chunks, so a chunk which continues the last block of the
+        # previous chunk would give a different output from a single run
+        cadence = self.params.isolution_cadence
+        if (cadence == 1 or not self.calculate_isotope_calcite
+                or self.calculate == 'growth_rate' or len(mm) == 0):
+            return
+        if cadence == 'month':
+            split = self._open_block == mm[0]
+        else:
+            split = self._open_block is not None
+        if split:
+            raise ValueError("With isolution_cadence {!r}, each chunk (except the last) has to "
+                             "end on an ISOLUTION block boundary, the chunk ending at timestep "
+                             "{} does not".format(cadence, self.n_steps))
+        if cadence == 'month':
+            self._open_block = mm[-1]
+        else:
+            self._open_block = len(mm) % cadence or None
+
+    def run_arrays(self, tt, mm, evpt, prp, tempp, d18o, out=None):
+        """
+        Run the model forward over arrays of forcing
+
+        Inputs
+        ------
+            - *tt*, *mm*, *evpt*, *prp*, *tempp*, *d18o*
+                forcing arrays, see `karstolution_arrays`
+            - *out*
+                optional float64 array of shape (len(variables), number of
+                timesteps) to fill with the output
+
+        Returns
+        -------
+            - *out*
+                array of shape (len(variables), number of timesteps)
+        """
+        forcing = karst_core.prepare_forcing(tt, mm, evpt, prp, tempp, d18o)
+        n = len(forcing[0])
+        self._check_isolution_blocks(forcing[1])
+        all_rows = self._rows == list(range(len(karst_core.OUTPUT_COLUMNS)))
+        buffer = None
+        if out is not None:
+            karst_core.check_output_array(out, len(self.variables), n)
+            if all_rows and out.flags.c_contiguous:
+                # the model writes straight into `out`
+                buffer = out
+        result = karst_core.advance(self.params, self.state, forcing,
+                                    self.calculate_isotope_calcite, self.n_workers,
+                                    self.calculate, self.profile, out=buffer)
+        self.n_steps += n
+        if not all_rows:
+            result = result[self._rows]
+        if out is not None and result is not out:
+            out[...] = result
+            result = out
+        return result
+
+    def run(self, df_input):
+        """
+        Run the model forward over a chunk of forcing
+
+        Inputs
+        ------
+            - *df_input*
+                DataFrame (or dict of arrays) with the forcing, as for
+                `karstolution`
+
+        Returns
+        -------
+            - *output_dataframe*
+                as for `karstolution`, with the index counting timesteps
+                from the start of the run.  With profiling, the report for
+                the run so far is in `output_dataframe.attrs['profile']`.
+        """
+        import pandas as pd
+        start = self.n_steps
+        columns = [np.asarray(df_input[name]) for name in karst_core.INPUT_COLUMNS]
+        out = self.run_arrays(*columns)
+        with profiling.stage(self.profile, 'dataframe'):
+            # the DataFrame is a view of the output array, which holds one
+            # contiguous row for each output column
+            output_dataframe = pd.DataFrame(out.T, columns=self.variables, copy=False,
+                                            index=pd.RangeIndex(start, self.n_steps))
+            # step number and month are integers
+            for ii, name in enumerate(['tt', 'mm']):
+                if name in self.variables:
+                    output_dataframe[name] = columns[ii].astype(np.int64)
+        if self.profile is not None:
+            output_dataframe.attrs['profile'] = self.profile.report()
+        return output_dataframe
+
+    def open_output(self, path, **options):
+        """
+        Open an output file for this run, see output.open_sink
+
+        `options` (e.g. float32=True) are passed to open_sink.
+        """
+        return output_files.open_sink(path, self.variables, **options)
+
+    def run_chunks(self, chunks, output=None, **options):
+        """
+        Run the model over an iterable of forcing chunks, e.g. from
+        pd.read_csv(..., chunksize=n), yielding the output for each chunk
+
+        Inputs
+        ------
+            - *chunks*
+                iterable of forcing DataFrames, as for `run`
+            - *output*
+                optional output file name (see output.open_sink, the format
+                is given by the extension) or an open output.OutputSink.
+                The output of each chunk is written to it as the run
+                advances.  A file opened from a name is closed at the end
+                of the run, with `options` passed to open_sink.
+        """
+        if output is None or isinstance(output, output_files.OutputSink):
+            sink = output
+        else:
+            sink = self.open_output(output, **options)
+        try:
+            for df_input in chunks:
+                df_output = self.run(df_input)
+                if sink is not None:
+                    with profiling.stage(self.profile, 'output'):
+                        sink.write(df_output)
+                yield df_output
+        finally:
+            if sink is not None and sink is not output:
+                sink.close()
+
+
+def spin_up(config, df_climatology, tol=1e-6, max_cycles=10000, state=None):
+    """
+    Steady state of the karst stores under a repeated cycle of forcing
+
+    The forcing (e.g. a climatological year) is repeated through the
+    hydrology and tracer mixing only, which is much cheaper than running the
+    full model, until the store levels and d18O stop changing.  This
+    replaces prepending years of repeated forcing to the model input.
+
+    Inputs
+    ------
+        - *config*
+            configuration dict, see README
+        - *df_climatology*
+            forcing for one cycle, in the same format as for `karstolution`.
+            `tt` is offset by the length of the cycle on each repeat.
+        - *tol*
+            the steady state is reached when no store level (mm) or d18O
+            (permille) changes by more than `tol` from one cycle to the next
+        - *max_cycles*
+            maximum number of cycles, a warning is issued if the steady state
+            is not reached
+        - *state*
+            karst_core.ModelState to start from, default is the initial state
+            from the configuration
+
+    Returns
+    -------
+        - *(state, n_cycles)*
+            the steady state and the number of cycles run
+
+    Usage example:
+    --------------
+    state, n_cycles = spin_up(config, df_input.iloc[:12])
+    df_output = karstolution(config, df_input, state=state)
+    """
+    model = KarstolutionModel(config, calculate_isotope_calcite=False, state=state)
+    n_cycles = model.spin_up(df_climatology, tol=tol, max_cycles=max_cycles)
+    return model.state, n_cycles
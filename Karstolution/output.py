@@ -0,0 +1,370 @@
+from __future__ import division
+import os
+import json
+from collections import OrderedDict
+import numpy as np
+
+#output files for model runs and ensembles, written as the model advances.
+#The format is chosen from the file extension (see OUTPUT_FORMATS): Parquet,
+#NetCDF and Zarr store binary, compressed columns which can be read back one
+#variable (and one member) at a time.  CSV is kept for compatibility.
+#
+#All of the formats have the dimensions (member, time, variable).  In NetCDF
+#and Zarr each variable is an array of shape (member, time), chunked along
+#time, so that reading one variable for one member reads only its chunks.  In
+#Parquet each variable is a column, with `member` and `time` columns, and
+#each write is a row group of a single member.
+#
+#The libraries for the binary formats (pyarrow, netCDF4 and zarr) are only
+#imported when a file of that format is opened.
+
+# output columns which are stored as integers
+INTEGER_COLUMNS = ['tt', 'mm']
+
+
+def _json_default(x):
+    # numpy scalars and arrays in the metadata, e.g. ensemble parameters
+    if isinstance(x, np.generic):
+        return x.item()
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    raise TypeError("{!r} is not JSON serializable".format(x))
+
+
+class OutputSink(object):
+    """
+    Output file, written a chunk of timesteps at a time
+
+    Use `open_sink` to open a file of the format given by its extension.
+
+    Inputs
+    ------
+        - *path*
+            file name (a directory for Zarr)
+        - *variables*
+            names of the output columns (see karst_core.OUTPUT_COLUMNS)
+        - *n_members*
+            number of ensemble members (1 for a single run)
+        - *float32*
+            if True, store the floating point columns as 32 bit floats,
+            which halves the size of the file (default 64 bit)
+        - *compression*
+            if True (default), compress the data with the default codec of
+            the format
+        - *time_chunk*
+            number of timesteps in each chunk of the NetCDF and Zarr arrays
+        - *attrs*
+            dict of metadata stored with the output, e.g. the configuration.
+            It must be JSON serializable (numpy values are converted).
+
+    Usage example:
+    --------------
+    with open_sink('output.nc', model.variables) as sink:
+        for df_output in model.run_chunks(reader):
+            sink.write(df_output)
+    """
+    def __init__(self, path, variables, n_members=1, float32=False, compression=True,
+                 time_chunk=1024, attrs=None):
+        self.path = path
+        self.variables = list(variables)
+        self.n_members = n_members
+        self.float32 = float32
+        self.compression = compression
+        self.time_chunk = time_chunk
+        self.attrs = OrderedDict(attrs or {})
+        self.attrs['variables'] = self.variables
+        self.attrs['n_members'] = n_members
+        # number of timesteps written for each member
+        self.n_times = [0]*n_members
+        self.closed = False
+        self._open()
+
+    def dtype(self, name):
+        """
+        Storage type of the output column `name`
+        """
+        if name in INTEGER_COLUMNS:
+            return np.dtype(np.int64)
+        return np.dtype(np.float32 if self.float32 else np.float64)
+
+    def metadata(self):
+        """
+        `attrs` as a JSON string
+        """
+        return json.dumps(self.attrs, default=_json_default)
+
+    def write(self, data, member=0):
+        """
+        Append timesteps to the output of one member
+
+        Inputs
+        ------
+            - *data*
+                DataFrame with (at least) the columns `variables`, e.g. from
+                `karstolution` or KarstolutionModel.run, or an array of shape
+                (time, variable) with the columns in the order of `variables`
+            - *member*
+                index of the ensemble member
+        """
+        if self.closed:
+            raise ValueError("Output file '{}' is closed".format(self.path))
+        if not 0 <= member < self.n_members:
+            raise ValueError("Member {} is out of range for an output with {} members".format(
+                member, self.n_members))
+        if hasattr(data, 'columns'):
+            columns = [np.asarray(data[name]) for name in self.variables]
+        else:
+            data = np.asarray(data)
+            if data.ndim != 2 or data.shape[1] != len(self.variables):
+                raise ValueError("Expected an array of shape (time, {}), got {}".format(
+                    len(self.variables), data.shape))
+            columns = [data[:, ii] for ii in range(len(self.variables))]
+        columns = [x.astype(self.dtype(name), copy=False)
+                   for name, x in zip(self.variables, columns)]
+        start = self.n_times[member]
+        if len(columns) and len(columns[0]):
+            self._write(member, start, columns)
+            self.n_times[member] = start + len(columns[0])
+
+    def close(self):
+        """
+        Finish writing the file
+        """
+        if not self.closed:
+            self._close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ParquetSink(OutputSink):
+    """
+    Parquet output (requires pyarrow), see OutputSink
+    """
+    def _open(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        fields = [pa.field('member', pa.int32()), pa.field('time', pa.int64())]
+        fields += [pa.field(name, pa.from_numpy_dtype(self.dtype(name)))
+                   for name in self.variables]
+        self._schema = pa.schema(fields, metadata={'karstolution': self.metadata()})
+        self._writer = pq.ParquetWriter(self.path, self._schema,
+                                        compression='zstd' if self.compression else 'none')
+
+    def _write(self, member, start, columns):
+        import pyarrow as pa
+        n = len(columns[0])
+        arrays = [np.full(n, member, dtype=np.int32), np.arange(start, start + n)] + columns
+        # each write is one row group, so a member can be read without the others
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self._schema))
+
+    def _close(self):
+        self._writer.close()
+
+    @staticmethod
+    def read(path, variables, member):
+        import pyarrow.parquet as pq
+        columns = None if variables is None else ['time'] + list(variables)
+        table = pq.read_table(path, columns=columns, filters=[('member', '=', member)])
+        attrs = json.loads(table.schema.metadata[b'karstolution'].decode())
+        df = table.to_pandas().sort_values('time')
+        return df.drop(columns=[c for c in ('member', 'time') if c in df]), attrs
+
+
+class NetCDFSink(OutputSink):
+    """
+    NetCDF-4 output (requires netCDF4), see OutputSink
+    """
+    def _open(self):
+        import netCDF4
+        self._dataset = netCDF4.Dataset(self.path, 'w')
+        self._dataset.createDimension('member', self.n_members)
+        self._dataset.createDimension('time', None)
+        self._dataset.karstolution = self.metadata()
+        for name in self.variables:
+            dtype = self.dtype(name)
+            self._dataset.createVariable(
+                name, dtype, ('member', 'time'), zlib=bool(self.compression),
+                chunksizes=(1, self.time_chunk),
+                fill_value=np.nan if dtype.kind == 'f' else None)
+
+    def _write(self, member, start, columns):
+        for name, x in zip(self.variables, columns):
+            self._dataset[name][member, start:start + len(x)] = x
+
+    def _close(self):
+        self._dataset.close()
+
+    @staticmethod
+    def read(path, variables, member):
+        import netCDF4
+        import pandas as pd
+        with netCDF4.Dataset(path) as dataset:
+            dataset.set_auto_mask(False)
+            attrs = json.loads(dataset.karstolution)
+            if variables is None:
+                variables = attrs['variables']
+            df = pd.DataFrame(OrderedDict((name, dataset[name][member, :])
+                                          for name in variables))
+        return df, attrs
+
+
+class ZarrSink(OutputSink):
+    """
+    Zarr output (requires zarr), see OutputSink
+    """
+    def _open(self):
+        import zarr
+        self._group = zarr.open_group(self.path, mode='w')
+        self._group.attrs['karstolution'] = self.metadata()
+        self._arrays = []
+        for name in self.variables:
+            dtype = self.dtype(name)
+            kwargs = {} if self.compression else {'compressors': None}
+            self._arrays.append(self._group.create_array(
+                name=name, shape=(self.n_members, 0), chunks=(1, self.time_chunk),
+                dtype=dtype, fill_value=np.nan if dtype.kind == 'f' else 0, **kwargs))
+
+    def _write(self, member, start, columns):
+        stop = start + len(columns[0])
+        for array, x in zip(self._arrays, columns):
+            if array.shape[1] < stop:
+                array.resize((self.n_members, stop))
+            array[member, start:stop] = x
+
+    def _close(self):
+        pass
+
+    @staticmethod
+    def read(path, variables, member):
+        import zarr
+        import pandas as pd
+        group = zarr.open_group(path, mode='r')
+        attrs = json.loads(group.attrs['karstolution'])
+        if variables is None:
+            variables = attrs['variables']
+        df = pd.DataFrame(OrderedDict((name, group[name][member, :]) for name in variables))
+        return df, attrs
+
+
+class CSVSink(OutputSink):
+    """
+    CSV output, as written by `DataFrame.to_csv`, with a `member` column
+    for ensembles.  There is no compression and metadata is not stored.
+    """
+    def _open(self):
+        self._file = open(self.path, 'w')
+        header = self.variables if self.n_members == 1 else ['member'] + self.variables
+        self._file.write(','.join(header) + '\n')
+
+    def _write(self, member, start, columns):
+        import pandas as pd
+        df = pd.DataFrame(OrderedDict(zip(self.variables, columns)))
+        if self.n_members > 1:
+            df.insert(0, 'member', member)
+        df.to_csv(self._file, header=False, index=False)
+
+    def _close(self):
+        self._file.close()
+
+    @staticmethod
+    def read(path, variables, member):
+        import pandas as pd
+        df = pd.read_csv(path)
+        if 'member' in df:
+            df = df[df['member'] == member].drop(columns='member').reset_index(drop=True)
+        if variables is not None:
+            df = df[list(variables)]
+        return df, {}
+
+
+# output file formats, by file extension
+OUTPUT_FORMATS = OrderedDict([
+    ('.parquet', ParquetSink),
+    ('.nc', NetCDFSink),
+    ('.zarr', ZarrSink),
+    ('.csv', CSVSink),
+])
+
+
+def _sink_class(path):
+    ext = os.path.splitext(str(path).rstrip('/' + os.sep))[1].lower()
+    if ext not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output file extension '{}' for '{}', expected one of {}".format(
+            ext, path, list(OUTPUT_FORMATS)))
+    return OUTPUT_FORMATS[ext]
+
+
+def open_sink(path, variables, n_members=1, float32=False, compression=True,
+              time_chunk=1024, attrs=None):
+    """
+    Open an output file of the format given by the extension of `path`
+
+    Inputs
+    ------
+        - *path*
+            file name ending in one of OUTPUT_FORMATS: '.parquet', '.nc'
+            (NetCDF-4), '.zarr' (a directory) or '.csv'.  An existing file is
+            overwritten.
+        - *variables*, *n_members*, *float32*, *compression*, *time_chunk*, *attrs*
+            see OutputSink
+
+    Returns
+    -------
+        - *OutputSink*
+            call `write` with each chunk of output, and `close` at the end
+            (or use it in a `with` statement)
+
+    Usage example:
+    --------------
+    model = KarstolutionModel(config)
+    with open_sink('output.parquet', model.variables, float32=True) as sink:
+        for df_output in model.run_chunks(pd.read_csv('input.csv', chunksize=12000)):
+            sink.write(df_output)
+    """
+    return _sink_class(path)(path, variables, n_members=n_members, float32=float32,
+                             compression=compression, time_chunk=time_chunk, attrs=attrs)
+
+
+def read_output(path, variables=None, member=0):
+    """
+    Read the output of one member from a file written with `open_sink`
+
+    Only the requested variables are read (except from CSV files).
+
+    Inputs
+    ------
+        - *path*
+            output file name
+        - *variables*
+            list of output column names to read (default: all of them)
+        - *member*
+            index of the ensemble member (0 for a single run)
+
+    Returns
+    -------
+        - *output_dataframe*
+            one row per timestep.  The metadata stored with the file (the
+            `attrs` of the sink, with 'variables' and 'n_members') is in
+            `output_dataframe.attrs`.
+
+    Usage example:
+    --------------
+    stal1 = read_output('ensemble.nc', ['stal1d18o'], member=10)['stal1d18o']
+    """
+    if isinstance(variables, str):
+        variables = [variables]
+    df, attrs = _sink_class(path).read(path, variables, member)
+    df = df.reset_index(drop=True)
+    df.attrs.update(attrs)
+    return df
@@ -0,0 +1,123 @@
+from __future__ import division
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from . import isotope_calcite_batch
+
+#timings and counters for a model run, collected when karstolution is called
+#with profile=True (see RunProfile).  Without profiling, the model code only
+#checks that the profile is None, once per stage.
+
+# the stalagmites, in the order in which ISOLUTION solves them (see
+# karst_core._DRIP_ROWS)
+STALAGMITES = ['stal1', 'stal4', 'stal5', 'stal3', 'stal2']
+
+# counters for each stalagmite, see isotope_calcite_batch.fixed_point_info
+STALAGMITE_COUNTERS = ['drips', 'ode_steps', 'iterations', 'evaporated', 'no_precipitation']
+
+
+class RunProfile(object):
+    """
+    Wall time of each stage of a model run, and ISOLUTION counters for each
+    stalagmite
+
+    The stages are 'soil_epikarst', 'diffuse_flow' and 'karst_stores' (the
+    hydrology, each with its tracer mixing), 'isolution' (or 'growth_rate',
+    see karstolution's `calculate` option), 'dataframe' (building the
+    output DataFrame) and 'output' (writing to an output file).  For each
+    stalagmite the time spent in ISOLUTION is recorded, along with the
+    counters STALAGMITE_COUNTERS.  With the 'table' ISOLUTION engine, or
+    the growth rate only, no ODE is solved and only the stage times are
+    recorded.
+
+    Usage example:
+    --------------
+    df_output = karstolution(config, df_input, profile=True)
+    report = df_output.attrs['profile']
+    print(report['stages']['isolution']['time'], report['stalagmites']['stal1'])
+    """
+    def __init__(self):
+        self.months = 0
+        self.stages = OrderedDict()
+        self.stalagmites = OrderedDict(
+            (name, OrderedDict([('time', 0.0)] + [(c, 0) for c in STALAGMITE_COUNTERS]))
+            for name in STALAGMITES)
+
+    def add_stage(self, name, seconds, calls=1):
+        """
+        Add `seconds` of wall time to the stage `name`
+        """
+        stage = self.stages.setdefault(name, OrderedDict([('time', 0.0), ('calls', 0)]))
+        stage['time'] += seconds
+        stage['calls'] += calls
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager timing a stage of the run
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - t0)
+
+    def solve(self, ii, solve, *args, **kwargs):
+        """
+        Call the ISOLUTION function `solve` for stalagmite `ii` (in the
+        order of STALAGMITES), recording its time and counters
+        """
+        before = isotope_calcite_batch.fixed_point_info()
+        t0 = time.perf_counter()
+        result = solve(*args, **kwargs)
+        elapsed = time.perf_counter() - t0
+        after = isotope_calcite_batch.fixed_point_info()
+        counters = self.stalagmites[STALAGMITES[ii]]
+        counters['time'] += elapsed
+        for name in STALAGMITE_COUNTERS:
+            counters[name] += after[name] - before[name]
+        return result
+
+    def merge(self, other):
+        """
+        Add the timings and counters of `other` (e.g. from a worker process)
+        """
+        for name, stage in other.stages.items():
+            self.add_stage(name, stage['time'], stage['calls'])
+        for name, counters in other.stalagmites.items():
+            for key, value in counters.items():
+                self.stalagmites[name][key] += value
+
+    def report(self):
+        """
+        The profile as a dict of plain Python values
+
+        Returns
+        -------
+            - *dict*
+                'months' (number of timesteps run), 'stages' (dict of stage
+                name: {'time', 'calls'}), 'total_time' (sum of the stage
+                times) and 'stalagmites' (dict of stalagmite name: {'time',
+                and the STALAGMITE_COUNTERS})
+        """
+        return OrderedDict([
+            ('months', self.months),
+            ('stages', OrderedDict((name, dict(stage)) for name, stage in self.stages.items())),
+            ('total_time', sum(stage['time'] for stage in self.stages.values())),
+            ('stalagmites', OrderedDict((name, dict(counters))
+                                        for name, counters in self.stalagmites.items()))])
+
+
+@contextmanager
+def _no_stage():
+    yield
+
+
+def stage(profile, name):
+    """
+    `profile.stage(name)`, or a context manager doing nothing if `profile`
+    is None
+    """
+    if profile is None:
+        return _no_stage()
+    return profile.stage(name)
@@ -0,0 +1,280 @@
+from __future__ import division
+import numpy as np
+from . import karst_core, karst_ensemble
+from .karst_core import OUTPUT_COLUMNS
+from .isotope_calcite_batch import isotope_transfer_coefficients
+
+#transfer functions from rainfall d18O to the d18O of the stores, drip water
+#and stalagmites.  The hydrology does not depend on the isotopes, and for a
+#given hydrology the tracer mixing is linear in the rainfall d18O, with an
+#offset from the initial d18O of the stores and evaporative fractionation.
+#ISOLUTION is affine in the drip water d18O (see
+#isotope_calcite_batch.isotope_transfer_coefficients), so the whole chain is
+#
+#    d18O(t) = offset(t) + sum_s matrix(t, s) * rainfall_d18O(s)
+#
+#and a rainfall d18O scenario costs one matrix product.
+
+# d18O of the stores, rows of karst_core.OUTPUT_COLUMNS
+STORE_VARIABLES = ['soil18o', 'epx18o', 'kststor118o', 'kststor218o']
+
+# d18O of the drip water feeding stalagmites 2 and 3 (KS1 + bypass flow),
+# see karst_core.hydrology
+DRIP_VARIABLES = ['drip118o', 'drip218o']
+
+# stalagmite d18O, in the order of karst_core._STAL_ROWS, and the d18O of
+# the water feeding each of them
+STAL_VARIABLES = [OUTPUT_COLUMNS[ii] for ii in karst_core._STAL_ROWS]
+_STAL_SOURCES = ['kststor218o', 'epx18o', 'kststor118o', 'drip218o', 'drip118o']
+
+# entries of ModelState.stores which are d18O (see karst_core.STORE_NAMES)
+_D18O_STORES = [karst_core.STORE_NAMES.index(name) for name in
+                ['soil18o', 'epx18o', 'kststor118o', 'kststor218o', 'd18oxp']]
+
+
+class TransferFunction(object):
+    """
+    Affine map from a rainfall d18O series to model d18O, see
+    `transfer_function`
+
+    Attributes
+    ----------
+        - *matrices*
+            dict of variable name: array of shape (timesteps, timesteps),
+            with matrices[name][t, s] the response in month t to 1 permille
+            of rainfall d18O in month s (zero for s > t).  Sparse matrices
+            if `transfer_function` was called with tol > 0.
+        - *offsets*
+            dict of variable name: array of the d18O for rainfall d18O of
+            zero, from the initial conditions and evaporative fractionation
+        - *variables*
+            list of the variable names
+        - *tt*
+            timestep numbers
+
+    Stalagmite d18O is NaN in months with no calcite precipitation.
+    """
+    def __init__(self, matrices, offsets, tt):
+        self.matrices = matrices
+        self.offsets = offsets
+        self.variables = [name for name in STORE_VARIABLES + DRIP_VARIABLES + STAL_VARIABLES
+                          if name in matrices]
+        self.tt = tt
+
+    def predict(self, d18o, variables=None):
+        """
+        Model d18O for a rainfall d18O series
+
+        Inputs
+        ------
+            - *d18o*
+                rainfall d18O, array of shape (timesteps,), or (timesteps,
+                scenarios) for several scenarios at once
+            - *variables*
+                names of the variables to calculate (default: all)
+
+        Returns
+        -------
+            - dict of variable name: array of the same shape as `d18o`
+        """
+        d18o = np.asarray(d18o, dtype=float)
+        if variables is None:
+            variables = self.variables
+        result = {}
+        for name in variables:
+            offset = self.offsets[name]
+            if d18o.ndim == 2:
+                offset = offset[:, np.newaxis]
+            result[name] = offset + self.matrices[name].dot(d18o)
+        return result
+
+    def reconstruct(self, variable, target, damping=0.0, prior=0.0):
+        """
+        Rainfall d18O series which best reproduces a d18O record
+
+        Solves the linear least squares problem
+
+            min |matrix.d18o + offset - target|^2 + damping^2 |d18o - prior|^2
+
+        Inputs
+        ------
+            - *variable*
+                name of the variable of the record, e.g. 'stal1d18o'
+            - *target*
+                the record, one value per timestep.  Months where it (or the
+                model) is NaN are left out.
+            - *damping*
+                regularisation towards `prior`, needed where the record does
+                not constrain the rainfall d18O (e.g. months which drain out
+                of the karst before they reach the stalagmite)
+            - *prior*
+                rainfall d18O towards which the solution is pulled, scalar or
+                one value per timestep
+
+        Returns
+        -------
+            - *d18o*
+                the rainfall d18O, one value per timestep.  Without damping,
+                the solution of smallest norm is returned.
+        """
+        matrix = self.matrices[variable]
+        n = matrix.shape[1]
+        prior = np.broadcast_to(np.asarray(prior, dtype=float), (n,))
+        residual = np.asarray(target, dtype=float) - self.offsets[variable] - matrix.dot(prior)
+        ok = np.where(np.isfinite(residual))[0]
+        if hasattr(matrix, 'tocsr'):
+            from scipy.sparse.linalg import lsqr
+            x = lsqr(matrix.tocsr()[ok], residual[ok], damp=damping, atol=1e-12, btol=1e-12)[0]
+        else:
+            a = matrix[ok]
+            b = residual[ok]
+            if damping > 0:
+                a = np.vstack([a, damping*np.eye(n)])
+                b = np.concatenate([b, np.zeros(n)])
+            x = np.linalg.lstsq(a, b, rcond=None)[0]
+        return prior + x
+
+
+def transfer_function(config, df_input, calculate_drip=True, calculate_isotope_calcite=True,
+                      state=None, block_size=128, tol=0.0):
+    """
+    Transfer function from the rainfall d18O to the d18O of the stores, drip
+    water and stalagmites, for the hydrology of a run
+
+    The hydrology is run once, with the forcing in `df_input` (its `d18o`
+    column is not used).  The response to rainfall d18O in each month is
+    found by running the tracer mixing for unit impulses, with the impulses
+    for a block of months run together as an ensemble (see karst_ensemble).
+
+    Inputs
+    ------
+        - *config*, *calculate_drip*, *state*
+            as for `karstolution`.  The configuration must use the new tracer
+            mixing code (`use_new_tracer_mixing_code`, the default), as the
+            old code limits the soil d18O, which is not linear.
+        - *df_input*
+            forcing, as for `karstolution`
+        - *calculate_isotope_calcite*
+            if True, include the stalagmite d18O (using
+            `isotope_transfer_coefficients` for each month)
+        - *block_size*
+            number of impulses run together, which sets the memory used
+            (about 300*block_size*timesteps bytes)
+        - *tol*
+            if > 0, the matrices are built and stored as scipy.sparse
+            matrices, with entries smaller than `tol` (permille per
+            permille) left out.  With tol == 0 (the default) the matrices
+            are dense: 8*timesteps**2 bytes each for the four stores, the
+            two drip waters and (with calculate_isotope_calcite) the five
+            stalagmites, so about 8.8 GB for 10000 months.
+
+    Returns
+    -------
+        - *TransferFunction*
+
+    Usage example:
+    --------------
+    tf = transfer_function(config, df_input)
+    # rainfall d18O scenarios, shape (timesteps, scenarios)
+    stal1 = tf.predict(scenarios, variables=['stal1d18o'])['stal1d18o']
+    # rainfall d18O which would give a measured record
+    d18o = tf.reconstruct('stal1d18o', record, damping=0.1, prior=-5.)
+    """
+    p = karst_core.resolve_parameters(config, calculate_drip)
+    if not p.tracer_mixing_flag:
+        raise ValueError("transfer_function needs use_new_tracer_mixing_code, the old "
+                         "tracer mixing is not linear in the rainfall d18O")
+    if p.isolution_cadence != 1:
+        raise ValueError("transfer_function runs ISOLUTION every timestep, it does not "
+                         "support isolution_cadence")
+    if state is None:
+        state = karst_core.initial_state(config)
+    else:
+        karst_core.check_state(p, state)
+        state = karst_core.copy_state(state)
+    columns = [np.asarray(df_input[name]) for name in karst_core.INPUT_COLUMNS]
+    tt, mm, evpt, prp, tempp, d18o = karst_core.prepare_forcing(*columns)
+    n = len(tt)
+    nd = len(p.y)
+
+    # the run with zero rainfall d18O gives the offsets.  The hydrology
+    # state is kept at the start of each block of impulses.
+    out = np.empty((len(OUTPUT_COLUMNS), n))
+    drip_d18o = np.empty((2, n))
+    zeros = np.zeros(n)
+    starts = list(range(0, n, block_size))
+    block_states = []
+    for a, b in zip(starts, starts[1:] + [n]):
+        block_states.append(karst_core.copy_state(state))
+        karst_core.hydrology(p, *(tuple(state) + (tt[a:b], mm[a:b], evpt[a:b], prp[a:b],
+                                                  tempp[a:b], zeros[a:b], out[:, a:b],
+                                                  drip_d18o[:, a:b])))
+    offsets = dict((name, out[OUTPUT_COLUMNS.index(name)].copy()) for name in STORE_VARIABLES)
+    offsets.update(zip(DRIP_VARIABLES, drip_d18o))
+
+    # impulse responses: with no 18O in the stores and no evaporative
+    # fractionation, the tracer mixing is linear and homogeneous.  Months
+    # before an impulse have no response, so each block starts from the
+    # hydrology state at its first impulse.
+    p_linear = p._replace(k_e_evapf=0.0)
+    if tol > 0:
+        # the entries of each matrix as (rows, columns, values), one block
+        # of impulses at a time
+        from scipy import sparse
+        entries = dict((name, ([], [], [])) for name in STORE_VARIABLES + DRIP_VARIABLES)
+    else:
+        matrices = dict((name, np.zeros((n, n))) for name in STORE_VARIABLES + DRIP_VARIABLES)
+    store_rows = [OUTPUT_COLUMNS.index(name) for name in STORE_VARIABLES]
+    for a, block_state in zip(starts, block_states):
+        m = min(block_size, n - a)
+        block_state.stores[_D18O_STORES] = 0.0
+        block_state.epdf[:] = 0.0
+        ensemble_state = karst_ensemble.stack_states([block_state]*m)
+        impulses = np.zeros((n - a, m))
+        impulses[np.arange(m), np.arange(m)] = 1.0
+        forcing = karst_ensemble.prepare_forcing(tt[a:], mm[a:], evpt[a:], prp[a:], tempp[a:],
+                                                 impulses, m)
+        out_e = np.empty((len(OUTPUT_COLUMNS), n - a, m))
+        drip_e = np.empty((2, n - a, m))
+        pe = p_linear._replace(y=np.broadcast_to(p.y[:, np.newaxis], (nd, m)))
+        karst_ensemble.hydrology(pe, *(tuple(ensemble_state) + forcing + (out_e, drip_e)))
+        for name, response in zip(STORE_VARIABLES + DRIP_VARIABLES,
+                                  list(out_e[store_rows]) + list(drip_e)):
+            if tol > 0:
+                rows, cols = np.nonzero(np.abs(response) >= tol)
+                entries[name][0].append(rows + a)
+                entries[name][1].append(cols + a)
+                entries[name][2].append(response[rows, cols])
+            else:
+                matrices[name][a:, a:a + m] = response
+    if tol > 0:
+        matrices = {}
+        for name, (rows, cols, values) in entries.items():
+            matrices[name] = sparse.csr_matrix(
+                (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                shape=(n, n))
+
+    if calculate_isotope_calcite:
+        # calcite d18O = slope * drip water d18O + intercept
+        slope = np.empty((len(STAL_VARIABLES), n))
+        intercept = np.empty((len(STAL_VARIABLES), n))
+        for it in range(n):
+            mi = mm[it] - 1
+            slope[:, it], intercept[:, it], growth = isotope_transfer_coefficients(
+                out[karst_core._DRIP_ROWS, it], out[karst_core._CAVE_TEMP_ROW, it],
+                p.drip_pco2[mi], p.cave_pco2[mi], p.h[mi], p.v[mi], p.phi,
+                solver=p.isolution_solver, rtol=p.isolution_rtol)
+        for ii, name in enumerate(STAL_VARIABLES):
+            source = _STAL_SOURCES[ii]
+            if tol > 0:
+                # scale the rows of the sparse matrix, and drop the entries
+                # which fall below tol
+                matrix = sparse.diags(slope[ii]).dot(matrices[source]).tocsr()
+                matrix.data[np.abs(matrix.data) < tol] = 0.0
+                matrix.eliminate_zeros()
+                matrices[name] = matrix
+            else:
+                matrices[name] = slope[ii][:, np.newaxis]*matrices[source]
+            offsets[name] = slope[ii]*offsets[source] + intercept[ii]
+
+    return TransferFunction(matrices, offsets, tt)
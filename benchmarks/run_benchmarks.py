@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Karstolution benchmarks
+
+Times the hot kernels (constants, O18EVA, O18EVA_MEAN, isotope_calcite,
+calc_pco2, weibull_parameters_y) and complete karstolution() runs, with numba
+both on and off.  Every case runs in a fresh Python process, because numba
+is switched off with the NUMBA_DISABLE_JIT environment variable when the
+package is imported.  The results are written as JSON so that two runs
+(e.g. before and after a change) can be compared.
+
+Usage example:
+--------------
+python benchmarks/run_benchmarks.py -o before.json
+# ... change the code ...
+python benchmarks/run_benchmarks.py -o after.json
+python benchmarks/run_benchmarks.py --compare before.json after.json
+
+python benchmarks/run_benchmarks.py --list
+python benchmarks/run_benchmarks.py -k isotope_calcite -k O18EVA --jit on
+"""
+
+from __future__ import print_function, division
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import fnmatch
+import subprocess
+from collections import OrderedDict
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(benchmark_dir)
+example_dir = os.path.join(repo_dir, 'example')
+
+# drip intervals (s) for the ISOLUTION kernels, spanning the range of the model
+DRIP_INTERVALS = [10., 100., 1000., 9001.]
+
+# lengths (months) of the synthetic forcing for the end-to-end cases
+SYNTHETIC_MONTHS = [10000, 100000]
+
+# typical cave conditions
+TC = 10.
+PCO2 = 4000e-6
+PCO2CAVE = 1000e-6
+H = 0.95
+V = 0.1
+PHI = 0.7
+D18O = -4.
+
+# results file format
+RESULTS_VERSION = 1
+
+
+#
+# ... the cases
+#
+# Each case is a setup function which imports what it needs and returns the
+# function to be timed (with no arguments).  Setup is not timed.
+#
+
+CASES = OrderedDict()
+
+
+def case(name):
+    def register(setup):
+        CASES[name] = setup
+        return setup
+    return register
+
+
+def clear_caches():
+    # so that every call does all of its work, not just a cache lookup
+    from Karstolution import constants, cave_context, isotope_calcite_batch
+    constants.cache_clear()
+    cave_context.cache_clear()
+    isotope_calcite_batch.transfer_cache_clear()
+
+
+@case('constants')
+def setup_constants():
+    from Karstolution.constants import constants
+    return lambda: constants(TC, PCO2)
+
+
+def _drip_inputs():
+    # drip water arriving at the stalagmite, as in isotope_calcite
+    from Karstolution.cave_context import cave_context
+    ctx = cave_context(TC, PCO2, PCO2CAVE, H, V)
+    R18smow = 0.0020052
+    r_h2o18 = (D18O/1000. + 1)*R18smow
+    return (ctx.HCOSOIL, r_h2o18/(ctx.e18_hco_h2o + 1), r_h2o18, ctx.avl*r_h2o18)
+
+
+def _setup_O18EVA(d):
+    from Karstolution.O18EVA import O18EVA
+    HCOMIX, r_hco18, r_h2o18, R18v = _drip_inputs()
+    def run():
+        clear_caches()
+        O18EVA(d, TC, PCO2, PCO2CAVE, H, V, r_hco18, r_h2o18, R18v, HCOMIX, 0.1/18, 0)
+    return run
+
+
+def _setup_O18EVA_MEAN(d):
+    from Karstolution.O18EVA_MEAN import O18EVA_MEAN
+    HCOMIX, r_hco18, r_h2o18, R18v = _drip_inputs()
+    def run():
+        clear_caches()
+        O18EVA_MEAN(d, TC, PCO2, PCO2CAVE, H, V, r_hco18, r_h2o18, R18v, HCOMIX, 0.1/18, 0)
+    return run
+
+
+def _setup_isotope_calcite(d):
+    from Karstolution.isotope_calcite import isotope_calcite
+    def run():
+        clear_caches()
+        isotope_calcite(d, TC, PCO2, PCO2CAVE, H, V, PHI, D18O, 0)
+    return run
+
+
+for _d in DRIP_INTERVALS:
+    for _name, _setup in [('O18EVA', _setup_O18EVA), ('O18EVA_MEAN', _setup_O18EVA_MEAN),
+                          ('isotope_calcite', _setup_isotope_calcite)]:
+        case('{}[d={:g}]'.format(_name, _d))(lambda _setup=_setup, _d=_d: _setup(_d))
+
+
+@case('calc_pco2')
+def setup_calc_pco2():
+    from Karstolution.calcpco2 import calc_pco2
+    return lambda: calc_pco2(1.5e-3, TC)
+
+
+@case('weibull_parameters_y')
+def setup_weibull_parameters_y():
+    from Karstolution.karst_process import weibull_parameters_y
+    # a new cache each call, so that the distribution is calculated
+    return lambda: weibull_parameters_y(0.8, 1.5, 12, [None, None])
+
+
+def load_example():
+    import yaml
+    import pandas as pd
+    config = yaml.safe_load(open(os.path.join(example_dir, 'config.yaml')).read())
+    df_input = pd.read_csv(os.path.join(example_dir, 'input.csv'))
+    return config, df_input
+
+
+def synthetic_input(df_input, n_months):
+    """
+    Forcing of length `n_months`, repeating the example input
+    """
+    import numpy as np
+    import pandas as pd
+    reps = -(-n_months // len(df_input))
+    df = pd.concat([df_input]*reps, ignore_index=True).iloc[:n_months].copy()
+    df['tt'] = np.arange(1, n_months + 1)
+    df['mm'] = np.arange(n_months) % 12 + 1
+    return df
+
+
+def _setup_karstolution(n_months=None):
+    from Karstolution import karstolution
+    config, df_input = load_example()
+    if n_months is not None:
+        df_input = synthetic_input(df_input, n_months)
+    def run():
+        clear_caches()
+        karstolution(config, df_input)
+    return run
+
+
+case('karstolution[example]')(lambda: _setup_karstolution())
+for _n in SYNTHETIC_MONTHS:
+    case('karstolution[{}k]'.format(_n // 1000))(lambda _n=_n: _setup_karstolution(_n))
+
+
+#
+# ... timing
+#
+
+def time_case(name, min_time=0.2, repeat=5, max_time=60.):
+    """
+    Time a case in this process
+
+    The first call is timed on its own, as it includes numba compilation.
+    After that, each of `repeat` samples calls the function enough times to
+    take at least `min_time` seconds.  Sampling stops early once `max_time`
+    seconds have been spent, and slow cases whose first call takes longer
+    than `max_time` are not repeated at all.
+
+    Returns
+    -------
+        - *dict*
+            with the time of the first call and, per call, the best, median
+            and mean time over the samples (s)
+    """
+    func = CASES[name]()
+    t0 = time.perf_counter()
+    func()
+    first = time.perf_counter() - t0
+    if first > max_time:
+        samples, number = [first], 1
+    else:
+        number = max(1, int(min_time // max(first, 1e-9)))
+        samples = []
+        spent = 0.
+        while len(samples) < repeat and (not samples or spent < max_time):
+            t0 = time.perf_counter()
+            for ii in range(number):
+                func()
+            elapsed = time.perf_counter() - t0
+            spent += elapsed
+            samples.append(elapsed / number)
+    ordered = sorted(samples)
+    n = len(ordered)
+    median = (ordered[(n - 1) // 2] + ordered[n // 2]) / 2
+    return OrderedDict([('first_call', first), ('best', ordered[0]), ('median', median),
+                        ('mean', sum(samples) / n), ('samples', n), ('number', number)])
+
+
+def run_case(name, jit, **kwargs):
+    """
+    Time a case in a new Python process, with numba on (`jit=True`) or off
+    """
+    env = dict(os.environ)
+    env['NUMBA_DISABLE_JIT'] = '0' if jit else '1'
+    env['PYTHONPATH'] = os.pathsep.join([repo_dir] + [p for p in [env.get('PYTHONPATH')] if p])
+    options = json.dumps(kwargs)
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', name,
+                             '--worker-options', options],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        return OrderedDict([('error', stderr.decode(errors='replace').strip().splitlines()[-1:])])
+    return json.loads(stdout.decode().strip().splitlines()[-1])
+
+
+def _versions():
+    versions = OrderedDict([('python', platform.python_version())])
+    for module in ['numpy', 'scipy', 'pandas', 'numba']:
+        try:
+            versions[module] = __import__(module).__version__
+        except ImportError:
+            versions[module] = None
+    return versions
+
+
+def _git_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo_dir,
+                                      stderr=subprocess.STDOUT)
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                        cwd=repo_dir)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode().strip() + ('-dirty' if dirty.strip() else '')
+
+
+def select_cases(patterns=None):
+    """
+    Names of the cases matching any of the glob `patterns` (or containing
+    one of them), all cases if there are none
+    """
+    if not patterns:
+        return list(CASES)
+    # brackets in the case names are not character sets
+    globs = [p.replace('[', '[[]') for p in patterns]
+    return [name for name in CASES
+            if any(fnmatch.fnmatchcase(name, g) or p in name for p, g in zip(patterns, globs))]
+
+
+def run_benchmarks(names, jit_modes=(True, False), verbose=True, **kwargs):
+    """
+    Run the cases `names` with each of the numba settings `jit_modes`
+
+    Returns
+    -------
+        - *dict*
+            the machine, package versions, git commit and the timings, by
+            case name and then 'jit' or 'nojit'
+    """
+    results = OrderedDict()
+    for name in names:
+        results[name] = OrderedDict()
+        for jit in jit_modes:
+            mode = 'jit' if jit else 'nojit'
+            r = run_case(name, jit, **kwargs)
+            results[name][mode] = r
+            if verbose:
+                if 'error' in r:
+                    print('{:32s} {:6s} FAILED {}'.format(name, mode, ' '.join(r['error'])))
+                else:
+                    print('{:32s} {:6s} {:12.6g} s (first call {:.6g} s)'.format(
+                        name, mode, r['median'], r['first_call']))
+                sys.stdout.flush()
+    return OrderedDict([('version', RESULTS_VERSION),
+                        ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+                        ('commit', _git_commit()),
+                        ('machine', OrderedDict([('platform', platform.platform()),
+                                                 ('processor', platform.processor()),
+                                                 ('cpu_count', os.cpu_count())])),
+                        ('versions', _versions()),
+                        ('options', kwargs),
+                        ('results', results)])
+
+
+def compare_results(base, new, statistic='median'):
+    """
+    Ratio new/base of `statistic` for the cases and numba settings in both
+
+    Returns
+    -------
+        - *list of (case, mode, base time, new time, ratio)*
+            ratios below one are speed-ups
+    """
+    rows = []
+    for name, modes in new['results'].items():
+        for mode, r in modes.items():
+            b = base['results'].get(name, {}).get(mode)
+            if b is None or statistic not in b or statistic not in r:
+                continue
+            rows.append((name, mode, b[statistic], r[statistic], r[statistic] / b[statistic]))
+    return rows
+
+
+def print_comparison(rows, base_label, new_label):
+    print('{:32s} {:6s} {:>12s} {:>12s} {:>8s}'.format('case', 'numba', base_label[:12],
+                                                       new_label[:12], 'ratio'))
+    for name, mode, b, n, ratio in rows:
+        print('{:32s} {:6s} {:12.6g} {:12.6g} {:8.3f}'.format(name, mode, b, n, ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Karstolution benchmarks')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('-k', dest='patterns', action='append',
+                        help='only run cases matching this pattern (can be repeated)')
+    parser.add_argument('--jit', choices=['both', 'on', 'off'], default='both',
+                        help='run with numba on, off, or both (default)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum duration of each sample (s)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of samples')
+    parser.add_argument('--max-time', type=float, default=60.,
+                        help='time limit for the samples of each case (s)')
+    parser.add_argument('--list', action='store_true', help='list the cases and exit')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help='compare two results files and exit')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--worker-options', default='{}', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        result = time_case(args.worker, **json.loads(args.worker_options))
+        print(json.dumps(result))
+        return 0
+    if args.list:
+        for name in CASES:
+            print(name)
+        return 0
+    if args.compare:
+        with open(args.compare[0]) as f:
+            base = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        print_comparison(compare_results(base, new), os.path.basename(args.compare[0]),
+                         os.path.basename(args.compare[1]))
+        return 0
+
+    names = select_cases(args.patterns)
+    if not names:
+        parser.error('no cases match {}'.format(args.patterns))
+    jit_modes = {'both': (True, False), 'on': (True,), 'off': (False,)}[args.jit]
+    results = run_benchmarks(names, jit_modes, min_time=args.min_time, repeat=args.repeat,
+                             max_time=args.max_time)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    failed = [name for name, modes in results['results'].items()
+              if any('error' in r for r in modes.values())]
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the benchmark runner
+
+Run with pytest
+"""
+import os
+import sys
+import pytest
+
+# try and make this script run from more than one directory
+sys.path.append('.')
+sys.path.append('..')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+# disable numba for debugging purposes
+os.environ['NUMBA_DISABLE_JIT'] = '1'
+
+import run_benchmarks
+
+
+def test_select_cases():
+    assert run_benchmarks.select_cases() == list(run_benchmarks.CASES)
+    names = run_benchmarks.select_cases(['isotope_calcite'])
+    assert len(names) == len(run_benchmarks.DRIP_INTERVALS)
+    assert run_benchmarks.select_cases(['O18EVA*[d=10]']) == ['O18EVA[d=10]', 'O18EVA_MEAN[d=10]']
+
+def test_time_case():
+    for name in ['calc_pco2', 'isotope_calcite[d=100]']:
+        r = run_benchmarks.time_case(name, min_time=0.01, repeat=2)
+        assert r['samples'] == 2
+        assert 0 < r['best'] <= r['median']
+
+def test_compare_results():
+    r = run_benchmarks.run_benchmarks(['weibull_parameters_y'], jit_modes=(False,),
+                                      verbose=False, min_time=0.01, repeat=2)
+    timing = r['results']['weibull_parameters_y']['nojit']
+    assert 'error' not in timing
+    faster = dict(r, results={'weibull_parameters_y': {'nojit': dict(timing, median=timing['median']/2)}})
+    rows = run_benchmarks.compare_results(r, faster)
+    assert len(rows) == 1
+    assert rows[0][-1] == pytest.approx(0.5)
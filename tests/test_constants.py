@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the chemistry cache and interpolation table
+
+Run with pytest
+"""
+import os
+import sys
+import pytest
+import numpy as np
+
+# try and make this script run from more than one directory
+sys.path.append('.')
+sys.path.append('..')
+
+# disable numba for debugging purposes
+os.environ['NUMBA_DISABLE_JIT'] = '1'
+
+from Karstolution import constants
+from Karstolution.caching import LRUCache
+
+def test_lru_cache_eviction():
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    # 'b' is now the least recently used
+    cache.put('c', 3)
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.info() == (1, 1, 2, 2)
+
+def test_cached_constants():
+    constants.cache_clear()
+    for ii in range(3):
+        for TC in [5., 10., 15.]:
+            out = constants.cached_constants(TC, 4000e-6)
+    info = constants.cache_info()
+    assert (info.hits, info.misses) == (6, 3)
+    exact = constants.constants(10., 4000e-6)
+    out = constants.cached_constants(10., 4000e-6)
+    for a, b in zip(exact, out):
+        assert np.all(a == b)
+    # shared arrays must not be modified by callers
+    with pytest.raises(ValueError):
+        out[2][0] = 1.0
+
+def test_calcium():
+    TC = np.array([0., 10., 25.])
+    pCO2 = np.array([[0., 4e-4, 2e-2]]).T
+    Ca = constants.calcium(TC, pCO2)
+    assert Ca.shape == (3, 3)
+    for ii in range(3):
+        for jj in range(3):
+            exact = constants.constants(TC[jj], pCO2[ii, 0])[2][0]
+            # same calculation, up to rounding in numpy's vectorized power
+            assert abs(Ca[ii, jj] - exact) < 1e-14*exact
+
+def test_constants_table():
+    table = constants.ConstantsTable(TC_range=(5., 15.), pCO2_range=(1e-4, 1e-2),
+                                     n_TC=11, n_pCO2=13)
+    assert table.max_rel_error < 1e-2
+    exact = constants.constants(9.3, 2.1e-3)
+    approx = table.lookup(9.3, 2.1e-3)
+    err = np.abs(approx[2] - exact[2]) / exact[2]
+    assert np.all(err <= 1.01*table.rel_error[2])
+    # outside the table
+    assert table.lookup(20., 2.1e-3) is None
+    constants.use_table(table)
+    try:
+        out = constants.cached_constants(9.3, 2.1e-3)
+        assert np.all(out[2] == approx[2])
+        out = constants.cached_constants(20., 2.1e-3)
+        assert np.all(out[2] == constants.constants(20., 2.1e-3)[2])
+        assert (table.hits, table.misses) == (2, 2)
+    finally:
+        constants.use_table(None)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the ensemble runner
+
+Run with pytest
+"""
+import os
+import sys
+import pytest
+import numpy as np
+
+# try and make this script run from more than one directory
+sys.path.append('.')
+sys.path.append('..')
+
+# disable numba for debugging purposes
+os.environ['NUMBA_DISABLE_JIT'] = '1'
+
+pd = pytest.importorskip('pandas')
+yaml = pytest.importorskip('yaml')
+
+from Karstolution import karst_core
+from Karstolution.ensemble import (run_ensemble, run_ensemble_vectorized, grid_design,
+                                   latin_hypercube_design, member_config)
+
+example_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example')
+
+def load_example():
+    config = yaml.safe_load(open(os.path.join(example_dir, 'config.yaml')).read())
+    df_input = pd.read_csv(os.path.join(example_dir, 'input.csv'))
+    return config, df_input
+
+def test_designs():
+    members = grid_design({'f1':[0.1, 0.2, 0.3], 'initial_conditions.soil':[50., 100.]})
+    assert len(members) == 6
+    assert members[1] == {'f1':0.1, 'initial_conditions.soil':100.}
+    members = latin_hypercube_design({'f1':(0., 1.), 'f3':(10., 20.)}, 10, seed=1)
+    f1 = np.array([m['f1'] for m in members])
+    f3 = np.array([m['f3'] for m in members])
+    # one sample in each tenth of the range
+    assert np.all(np.sort(np.floor(f1*10)) == np.arange(10))
+    assert np.all(np.sort(np.floor(f3 - 10)) == np.arange(10))
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_run_ensemble(n_workers):
+    config, df_input = load_example()
+    df_input = df_input.iloc[:24]
+    members = [{'f1':0.1}, {'initial_conditions.soil':80.}, {'ks1':'not a number'}]
+    progress = []
+    result = run_ensemble(config, df_input, members, n_workers=n_workers,
+                          calculate_isotope_calcite=False,
+                          progress=lambda n_done, n_total: progress.append((n_done, n_total)))
+    assert result.data.shape == (3, 24, len(karst_core.OUTPUT_COLUMNS))
+    assert progress[-1] == (3, 3)
+    # the failing member does not affect the others
+    assert list(result.errors.keys()) == [2]
+    assert np.all(np.isnan(result.data[2]))
+    for ii in range(2):
+        out = karst_core.run(member_config(config, members[ii]),
+                             *[df_input[name].values for name in karst_core.INPUT_COLUMNS],
+                             calculate_isotope_calcite=False)
+        assert np.array_equal(result.data[ii], out.T, equal_nan=True)
+    assert result.sel('f1').shape == (3, 24)
+    df = result.to_dataframe(0)
+    assert list(df.columns) == karst_core.OUTPUT_COLUMNS
+
+@pytest.mark.parametrize('tracer_mixing, f8_routing', [(True, True), (False, False)])
+def test_run_ensemble_vectorized(tracer_mixing, f8_routing):
+    config, df_input = load_example()
+    config['use_new_tracer_mixing_code'] = tracer_mixing
+    config['use_new_f8_routing'] = f8_routing
+    # no drip from the stores for half of the year
+    config['monthly_forcing']['driprate_store_full'] = [0.01]*6 + [0.0]*6
+    members = latin_hypercube_design({'f1':(0.05, 0.5), 'k_diffuse':(0.001, 0.05),
+                                      'lambda_weibull':(0.5, 2.), 'ks1':(100., 300.),
+                                      'initial_conditions.soil':(0., 150.)}, 6, seed=2)
+    members[0]['monthly_forcing.cave_temp'] = [12.]*12
+    result = run_ensemble_vectorized(config, df_input, members,
+                                     calculate_isotope_calcite=False)
+    assert result.data.shape == (6, len(df_input), len(karst_core.OUTPUT_COLUMNS))
+    for ii in range(6):
+        out = karst_core.run(member_config(config, members[ii]),
+                             *[df_input[name].values for name in karst_core.INPUT_COLUMNS],
+                             calculate_isotope_calcite=False)
+        np.testing.assert_allclose(result.data[ii], out.T, rtol=1e-12, atol=1e-12)
+
+def test_run_ensemble_vectorized_lists():
+    config, df_input = load_example()
+    df_input = df_input.iloc[:12]
+    # parameters given as lists in the configuration
+    config['f1'] = [0.1, 0.2, 0.3]
+    config['monthly_forcing']['drip_pco2'] = [[4000.]*12, [5000.]*12, [6000.]*12]
+    result = run_ensemble_vectorized(config, df_input, variables=['tt', 'stal1d18o'])
+    assert result.members[2] == {'f1':0.3, 'monthly_forcing.drip_pco2':[6000.]*12}
+    expected = run_ensemble(config, df_input, [{'f1':0.3, 'monthly_forcing.drip_pco2':[6000.]*12}],
+                            n_workers=1, variables=['tt', 'stal1d18o'])
+    assert np.array_equal(result.data[2], expected.data[0])
+    # an ensemble of forcing
+    forcing = dict((name, df_input[name].values) for name in karst_core.INPUT_COLUMNS)
+    forcing['prp'] = forcing['prp'][:, np.newaxis] * np.array([0.5, 1., 2.])
+    result = run_ensemble_vectorized(config, forcing, calculate_isotope_calcite=False)
+    assert result.data.shape[0] == 3
+    config['f1'] = [0.1, 0.2]
+    with pytest.raises(ValueError):
+        run_ensemble_vectorized(config, df_input)
@@ -8,6 +8,7 @@ Run with pytest
 import os
 import sys
 import pytest
+import numpy as np
 
 # try and make this script run from more than one directory
 sys.path.append('.')
@@ -17,7 +18,12 @@ sys.path.append('..')
 os.environ['NUMBA_DISABLE_JIT'] = '1'
 
 from Karstolution.isotope_calcite import isotope_calcite
-from Karstolution.calcpco2 import calc_pco2
+from Karstolution.calcpco2 import calc_pco2, calc_pco2_array
+from Karstolution import constants
+from Karstolution import isotope_calcite_batch as icb
+from Karstolution.isotope_calcite_batch import isotope_calcite_batch
+from Karstolution import isolution_table
+from Karstolution import cave_context
 
 def test_zero_net_flux_case():
     # this case was blowing up (net calcite deposition --> zero)
@@ -81,6 +87,197 @@ def test_no_gradient_weak_evaporation():
           h=0.9999, V=0.0001, phi=1.0, d18Oini=0, tt=1) )
     print(ic,gr)
 
+def test_batch_matches_isotope_calcite():
+    # five stalagmites in the same cave, one with splashing
+    d = [401.2, 405.4, 154.1, 145.6, 9001.]
+    d18o = [-4.0, -4.0, -4.9, -4.5, -4.3]
+    for phi in [1.0, 0.7]:
+        ic, gr = isotope_calcite_batch(d, 10., 4000., 1000., 0.95, 0.1, phi, d18o, tt=1)
+        for ii in range(len(d)):
+            ic1, gr1 = isotope_calcite(d=d[ii], TC=10., pCO2=4000., pCO2cave=1000.,
+                  h=0.95, V=0.1, phi=phi, d18Oini=d18o[ii], tt=1)
+            assert abs(ic[ii] - ic1) < 1e-9
+            assert abs(gr[ii] - gr1) < 1e-12
+
+def test_drip_evaporates_completely():
+    # the drip evaporates completely after the splash mixing
+    args = dict(d=9001., TC=4., pCO2=2500e-6, pCO2cave=800e-6, h=0.8, V=0.3, phi=0.4,
+                d18Oini=-4.3, tt=1)
+    ic, gr = isotope_calcite(**args)
+    assert np.isnan(ic) and gr == 0.0
+    ic, gr = isotope_calcite_batch(**args)
+    assert np.isnan(ic[0]) and gr[0] == 0.0
+
+def test_fixed_point_iterations():
+    d = [20., 150., 900.]
+    for phi, max_iterations in [(1.0, 0), (0.7, 1)]:
+        icb.fixed_point_clear()
+        isotope_calcite_batch(d, 10., 4000e-6, 1000e-6, 0.95, 0.1, phi, -4., 0)
+        info = icb.fixed_point_info()
+        assert info['drips'] == 3
+        assert info['max_iterations'] == max_iterations
+    (ic, gr), data = isotope_calcite(d=150., TC=10., pCO2=4000e-6, pCO2cave=1000e-6, h=0.95,
+                                     V=0.1, phi=0.7, d18Oini=-4., tt=0, full_output=True)
+    assert data[0]['iterations'] == 1
+
+def test_cave_context_shared():
+    # the stalagmites of a cave share the context of the month
+    cave_context.cache_clear()
+    ic_b, gr_b = isotope_calcite_batch([20., 150.], 10., 4000e-6, 1000e-6, 0.95, 0.1, 0.7, -4., 0)
+    assert cave_context.cache_info().misses == 1
+    ic, gr = isotope_calcite(d=150., TC=10., pCO2=4000e-6, pCO2cave=1000e-6, h=0.95,
+                             V=0.1, phi=0.7, d18Oini=-4., tt=0)
+    info = cave_context.cache_info()
+    assert info.misses == 1 and info.hits >= 1
+    assert abs(ic - ic_b[1]) < 1e-9
+    assert abs(gr - gr_b[1]) < 1e-12
+
+# run in a separate process with numba enabled (see test_kernels_compile)
+_NOPYTHON_SCRIPT = """
+import sys, warnings
+warnings.simplefilter('ignore')
+from numba import njit
+from numba.core.registry import CPUDispatcher
+from Karstolution import O18EVA, O18EVA_MEAN, cave_context
+from Karstolution.isotope_calcite import isotope_calcite
+from Karstolution.isotope_calcite_batch import isotope_calcite_batch
+args = (100., 10., 3000., 1000., 0.95, 0.05, 0.9, -5., 0)
+isotope_calcite(*args, full_output=True)
+isotope_calcite(*args, solver='rk45')
+isotope_calcite_batch(*args)
+ctx = cave_context.cave_context(10., 3000., 1000., 0.95, 0.05)
+kernel_args = (100., ctx.eva, ctx.alpha, ctx.T, ctx.eps_m, ctx.abl, ctx.avl, 0.95, ctx.HCOCAVE,
+               0.002, 0.002, 0.002, 5e-3, 0.1/18)
+njit(O18EVA.O18EVA_kernel.py_func)(*kernel_args)
+njit(O18EVA_MEAN.O18EVA_MEAN_kernel.py_func)(*kernel_args)
+O18EVA.O18EVA(100., 10., 3000., 1000., 0.95, 0.05, 0.002, 0.002, 0.002, 5e-3, 0.1/18, 0)
+O18EVA_MEAN.O18EVA_MEAN(100., 10., 3000., 1000., 0.95, 0.05, 0.002, 0.002, 0.002, 5e-3, 0.1/18, 0)
+# every compiled function which has been called ran in nopython mode
+for name, module in list(sys.modules.items()):
+    if name.startswith('Karstolution'):
+        for key, f in vars(module).items():
+            if isinstance(f, CPUDispatcher):
+                assert len(f.signatures) == len(f.nopython_signatures), (name, key)
+"""
+
+def test_kernels_compile():
+    # the compiled kernels must not fall back to numba's object mode (which
+    # is an error from numba 0.59), e.g. by calling the Python caches
+    pytest.importorskip('numba')
+    import subprocess
+    env = dict(os.environ)
+    env.pop('NUMBA_DISABLE_JIT', None)
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    env['PYTHONPATH'] = os.pathsep.join([root, env.get('PYTHONPATH', '')])
+    result = subprocess.run([sys.executable, '-c', _NOPYTHON_SCRIPT], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    assert result.returncode == 0, result.stdout.decode()
+
+def test_rk45_solver_matches_euler():
+    # the adaptive solver should agree with the ~1 s Euler step to within
+    # the Euler discretisation error
+    d = [10., 100., 401.19, 3000., 9001.]
+    for V in [0.0, 1.0]:
+        ic_e, gr_e = isotope_calcite_batch(d, 10., 4000e-6, 1000e-6, 0.95, V, 1.0, -4.5, tt=1)
+        ic_r, gr_r = isotope_calcite_batch(d, 10., 4000e-6, 1000e-6, 0.95, V, 1.0, -4.5, tt=1,
+                                           solver='rk45', rtol=1e-8)
+        assert np.abs(ic_e - ic_r).max() < 1e-3
+        assert (gr_e == gr_r).all()
+    ic, gr = isotope_calcite(d=401.19, TC=10., pCO2=4000e-6, pCO2cave=1000e-6,
+          h=0.95, V=1.0, phi=1.0, d18Oini=-4.5, tt=1, solver='rk45')
+    assert abs(ic - ic_r[2]) < 1e-12
+    with pytest.raises(ValueError):
+        isotope_calcite_batch(d, 10., 4000e-6, 1000e-6, 0.95, V, 1.0, -4.5, tt=1, solver='rk4')
+
+def test_rk45_nan_input():
+    # NaN drip-water d18O gives NaN, as for the Euler solver, rather than
+    # the step size shrinking for ever
+    for solver in ['euler', 'rk45']:
+        ic, gr = isotope_calcite_batch([100.], 10., 4000e-6, 1000e-6, 0.95, 0.1, 1.0, [np.nan],
+                                       1, solver=solver)
+        assert np.isnan(ic[0]) and gr[0] == 0.0
+
+def test_hco_analytic_equal_rates():
+    # the HCO3- solution is continuous where the evaporation rate equals
+    # the precipitation rate constant, and solves its ODE there
+    from Karstolution.O18EVA_RK45 import _hco_analytic
+    hco_0, H2O_0, alpha_p, HCO_EQ = 2e-5, 1e-4, 1e-7, 0.05
+    hco = _hco_analytic(50., hco_0, H2O_0, alpha_p, alpha_p, HCO_EQ)
+    assert np.isfinite(hco)
+    for k in [alpha_p*(1 - 1e-9), alpha_p*(1 + 1e-9)]:
+        assert abs(_hco_analytic(50., hco_0, H2O_0, k, alpha_p, HCO_EQ) - hco) < 1e-8*hco
+    dt = 1e-3
+    dhco = (_hco_analytic(50. + dt, hco_0, H2O_0, alpha_p, alpha_p, HCO_EQ)
+            - _hco_analytic(50. - dt, hco_0, H2O_0, alpha_p, alpha_p, HCO_EQ))/(2*dt)
+    expected = -alpha_p*(hco/(H2O_0 - alpha_p*50.) - HCO_EQ)
+    assert abs(dhco - expected) < 1e-6*abs(expected)
+
+def test_batch_no_gradient():
+    ic, gr = isotope_calcite_batch([500., 100.], 10., 6000., 6000., 0.98, 0.1,
+          1.0, -5.0, tt=1)
+    assert np.isnan(ic).all()
+    assert (gr == 0).all()
+
+def test_transfer_coefficients():
+    # calcite d18O is affine in the drip-water d18O
+    d = [401.2, 405.4, 154.1, 9001.]
+    d18o = np.array([-4.0, -4.0, -4.9, -12.3])
+    icb.transfer_cache_clear()
+    for phi in [1.0, 0.7]:
+        ic, gr = isotope_calcite_batch(d, 10., 4000e-6, 1000e-6, 0.95, 0.1, phi, d18o, tt=1)
+        ic_a, gr_a = icb.isotope_calcite_affine(d, 10., 4000e-6, 1000e-6, 0.95, 0.1, phi,
+                                                d18o, tt=1)
+        assert np.abs(ic - ic_a).max() < 1e-9
+        assert np.array_equal(gr, gr_a)
+    assert icb.transfer_cache_info().currsize == 8
+    # the same conditions again are taken from the cache
+    icb.isotope_calcite_affine(d, 10., 4000e-6, 1000e-6, 0.95, 0.1, 0.7, d18o + 1., tt=1)
+    assert icb.transfer_cache_info().hits == 4
+    slope, intercept, gr = icb.isotope_transfer_coefficients([500., 100.], 10., 6000e-6,
+          6000e-6, 0.98, 0.1, 1.0)
+    assert np.isnan(slope).all() and np.isnan(intercept).all()
+    assert (gr == 0).all()
+
+def test_growth_rate():
+    d = np.array([20., 150., 900.])
+    for TC, pCO2, pCO2cave, h, V, phi in [(10., 4000e-6, 1000e-6, 0.95, 0.0, 1.0),
+                                          (4., 2500e-6, 800e-6, 0.9, 0.1, 0.4),
+                                          (15., 1000e-6, 1500e-6, 0.95, 0.0, 1.0)]:
+        expected = isotope_calcite_batch(d, TC, pCO2, pCO2cave, h, V, phi, -5., 0)[1]
+        result = icb.growth_rate(d, TC, pCO2, pCO2cave, phi)
+        assert np.allclose(result, expected, rtol=1e-12, atol=0)
+    # broadcasting over the cave conditions
+    result = icb.growth_rate(d[:, np.newaxis], [4., 10.], [2500e-6, 4000e-6], 1000e-6, 0.5)
+    assert result.shape == (3, 2)
+    expected = isotope_calcite_batch(d, 10., 4000e-6, 1000e-6, 0.95, 0.0, 0.5, -5., 0)[1]
+    assert np.allclose(result[:, 1], expected, rtol=1e-12, atol=0)
+
+def test_isolution_table(tmpdir):
+    grid = dict(d=np.geomspace(50., 500., 12), TC=[8., 10., 12.], pCO2=[3000e-6, 4000e-6],
+                pCO2cave=[1000e-6], h=[0.95], V=[0.0, 0.1], phi=[1.0])
+    path = str(tmpdir.join('table'))
+    table = isolution_table.build_table(path, grid, n_workers=1, n_check=20)
+    max_error = table.metadata['max_error']
+    assert max_error['intercept'] < 0.05
+    # interpolation reproduces the grid points, and the error estimate holds
+    # between them
+    table = isolution_table.load_table(path)
+    for d, TC, pCO2, V in [(50., 10., 3000e-6, 0.1), (123., 9.3, 3500e-6, 0.04)]:
+        d18Oini = np.array([-5., -6.])
+        expected = isotope_calcite_batch(d, TC, pCO2, 1000e-6, 0.95, V, 1.0, d18Oini, 0)
+        result = table.isotope_calcite(d, TC, pCO2, 1000e-6, 0.95, V, 1.0, d18Oini)
+        assert np.allclose(result[0], expected[0], rtol=0, atol=2*max_error['intercept'] + 1e-12)
+        assert np.allclose(result[1], expected[1], rtol=0, atol=2*max_error['growth_rate'] + 1e-12)
+    with pytest.raises(ValueError):
+        table.interpolate(1000., 10., 3000e-6, 1000e-6, 0.95, 0.0, 1.0)
+    with pytest.raises(ValueError):
+        table.interpolate(100., 10., 3000e-6, 1000e-6, 0.9, 0.0, 1.0)
+    # a table built with other model code is rejected
+    metadata = tmpdir.join('table', 'metadata.json')
+    metadata.write(metadata.read().replace(isolution_table.source_hash(), 'x'))
+    with pytest.raises(ValueError):
+        isolution_table.load_table(path)
+
 def test_calc_pco2():
     pco2 = calc_pco2(1e-3, 21.)
     print(pco2)
@@ -88,6 +285,21 @@ def test_calc_pco2():
 def test_calc_pco2_fail():
     with pytest.raises(ValueError):
       pco2 = calc_pco2(0, 21.)
+
+def test_calc_pco2_array():
+    ca = np.array([[5e-4, 1e-3, 2e-3], [1e-3, 0., 1.]])
+    TC = np.array([5., 21., 10.])
+    pco2 = calc_pco2_array(ca, TC)
+    assert pco2.shape == ca.shape
+    # out of range samples are NaN
+    assert np.all(np.isnan(pco2[1, 1:]))
+    ok = ~np.isnan(pco2)
+    TC = np.broadcast_to(TC, ca.shape)
+    # inverse of the equilibrium Ca2+ concentration to the requested tolerance
+    assert np.all(np.abs(constants.calcium(TC[ok], pco2[ok]*1e-6) - ca[ok]) < 1e-6*ca[ok])
+    assert pco2[0, 1] == calc_pco2(1e-3, 21.)
+    # value from the original bisection-by-tenths algorithm
+    assert abs(pco2[0, 1] - 2176.0800575521444) < 1e-5*2176.08
     
 
 if __name__ == "__main__":
@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the array based model loop
+
+Run with pytest
+"""
+import os
+import sys
+import pytest
+import numpy as np
+
+# try and make this script run from more than one directory
+sys.path.append('.')
+sys.path.append('..')
+
+# disable numba for debugging purposes
+os.environ['NUMBA_DISABLE_JIT'] = '1'
+
+pd = pytest.importorskip('pandas')
+yaml = pytest.importorskip('yaml')
+
+from Karstolution import karstolution, karst_core, karst_process, isolution_table
+from Karstolution.isotope_calcite import isotope_calcite
+
+example_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example')
+
+def load_example():
+    config = yaml.safe_load(open(os.path.join(example_dir, 'config.yaml')).read())
+    df_input = pd.read_csv(os.path.join(example_dir, 'input.csv'))
+    return config, df_input
+
+def run_reference(config, df_input, calculate_drip=True):
+    # the original model loop, one karst_process call per timestep
+    ic = config['initial_conditions']
+    nd = int(config.get('weibull_delay_months', 12))
+    state = dict(epx18oxp=ic['d18o_epikarst'], epxstorxp=ic['epikarst'],
+                 soilstorxp=ic['soil'], soil18oxp=ic['d18o_soil'],
+                 kststor1xp=ic['ks1'], kststor2xp=ic['ks2'],
+                 kststor118oxp=ic['d18o_ks1'], kststor218oxp=ic['d18o_ks2'],
+                 d18oxp=ic['d18o_prevrain'], prpxp=0)
+    dpdf = [ic['diffuse']]*nd
+    epdf = [ic['d18o_diffuse']]*nd
+    tempp = list(range(36))
+    avr_cave = np.mean(config['monthly_forcing']['cave_temp'])
+    difference = 10
+    rows = []
+    for index, row in df_input.iterrows():
+        tt, mm = int(row['tt']), int(row['mm'])
+        tempp[0] = float(row['tempp'])
+        if tt == 1:
+            tempp = [tempp[0]]*36
+            difference = tempp[0] - avr_cave
+        seasonality = config['monthly_forcing']['cave_temp'][mm-1] - avr_cave
+        cave_temp = sum(tempp)/len(tempp) - difference + seasonality
+        out = karst_process.karst_process(tt, mm, float(row['evpt']), float(row['prp']),
+                state['prpxp'], tempp, float(row['d18o']), state['d18oxp'], dpdf, epdf,
+                state['soilstorxp'], state['soil18oxp'], state['epxstorxp'], state['epx18oxp'],
+                state['kststor1xp'], state['kststor118oxp'], state['kststor2xp'],
+                state['kststor218oxp'], config, calculate_drip, cave_temp,
+                calculate_isotope_calcite=False)
+        rows.append(out)
+        state.update(epx18oxp=out[13], epxstorxp=out[9], soilstorxp=out[8],
+                     soil18oxp=out[12], kststor1xp=out[10], kststor2xp=out[11],
+                     kststor118oxp=out[14], kststor218oxp=out[15],
+                     d18oxp=float(row['d18o']), prpxp=float(row['prp']))
+        epdf[1:] = epdf[:-1]
+        epdf[0] = out[13]
+        dpdf[1:] = dpdf[:-1]
+        dpdf[0] = out[9]
+        tempp[1:36] = tempp[0:35]
+    return np.array(rows, dtype=float).T
+
+@pytest.mark.parametrize('tracer_mixing, f8_routing, weibull', [
+    (True, True, True), (False, False, False), (True, False, True), (False, True, False)])
+def test_hydrology_matches_karst_process(tracer_mixing, f8_routing, weibull):
+    config, df_input = load_example()
+    config['use_new_tracer_mixing_code'] = tracer_mixing
+    config['use_new_f8_routing'] = f8_routing
+    config['use_new_weibull_definition'] = weibull
+    config['area_ratio'] = 0.7
+    # no drip from the stores for half of the year
+    config['monthly_forcing']['driprate_store_full'] = [0.01]*6 + [0.0]*6
+    columns = [df_input[name].values for name in karst_core.INPUT_COLUMNS]
+    out = karst_core.run(config, *columns, calculate_isotope_calcite=False)
+    expected = run_reference(config, df_input)
+    assert out.shape == expected.shape
+    np.testing.assert_allclose(out, expected, rtol=1e-12, atol=1e-12)
+    assert np.any(out[karst_core.OUTPUT_COLUMNS.index('stal5d18o')] == -99.99)
+
+def run_hydrology(p, state, columns):
+    n = len(columns[0])
+    out = np.empty((len(karst_core.OUTPUT_COLUMNS), n))
+    drip_d18o = np.empty((2, n))
+    stores, dpdf, epdf, tempp = state
+    karst_core.hydrology(p, stores, dpdf, epdf, tempp, *(list(columns) + [out, drip_d18o]))
+    return out
+
+def test_state_is_carried_between_calls():
+    config, df_input = load_example()
+    columns = [df_input[name].values for name in karst_core.INPUT_COLUMNS]
+    p = karst_core.resolve_parameters(config)
+    full = run_hydrology(p, karst_core.initial_state(config), columns)
+    # the same run, in two parts
+    state = karst_core.initial_state(config)
+    first = run_hydrology(p, state, [c[:40] for c in columns])
+    second = run_hydrology(p, state, [c[40:] for c in columns])
+    assert np.array_equal(np.hstack([first, second]), full, equal_nan=True)
+
+def test_karstolution_output():
+    config, df_input = load_example()
+    df_input = df_input.iloc[:3]
+    df = karstolution(config, df_input)
+    assert list(df.columns) == karst_core.OUTPUT_COLUMNS
+    assert df['tt'].dtype == np.int64
+    assert not df.isnull().any().any()
+    df = karstolution(config, df_input, calculate_drip=False,
+                      calculate_isotope_calcite=False)
+    assert np.all(df['drip_int_stal1'] == 100.0)
+    assert df['stal1d18o'].isnull().all()
+
+def test_karstolution_variables():
+    config, df_input = load_example()
+    df_input = df_input.iloc[:3]
+    full = karstolution(config, df_input)
+    df = karstolution(config, df_input, variables=['stal2d18o', 'tt', 'kststor1'])
+    assert list(df.columns) == ['stal2d18o', 'tt', 'kststor1']
+    assert df['tt'].dtype == np.int64
+    for name in df.columns:
+        assert np.all(df[name] == full[name])
+    with pytest.raises(ValueError):
+        karstolution(config, df_input, variables=['not_a_variable'])
+
+def test_chunked_model():
+    from Karstolution import KarstolutionModel
+    config, df_input = load_example()
+    full = karstolution(config, df_input, calculate_isotope_calcite=False)
+    model = KarstolutionModel(config, calculate_isotope_calcite=False)
+    reader = pd.read_csv(os.path.join(example_dir, 'input.csv'), chunksize=17)
+    chunks = list(model.run_chunks(reader))
+    assert len(chunks) == 6
+    assert model.n_steps == len(df_input)
+    pd.testing.assert_frame_equal(pd.concat(chunks), full)
+
+def test_karstolution_arrays(tmpdir):
+    from Karstolution import karstolution_arrays
+    config, df_input = load_example()
+    full = karstolution(config, df_input, calculate_isotope_calcite=False)
+    # memory-mapped forcing is used without copying
+    columns = []
+    for name in karst_core.INPUT_COLUMNS:
+        filename = str(tmpdir.join(name + '.npy'))
+        np.save(filename, np.asarray(df_input[name], dtype=full[name].dtype
+                                     if name in ('tt', 'mm') else float))
+        columns.append(np.load(filename, mmap_mode='r'))
+    forcing = karst_core.prepare_forcing(*columns)
+    assert all(np.shares_memory(x, y) for x, y in zip(columns, forcing))
+    # the output buffer is filled (and can be reused)
+    out = np.empty((len(karst_core.OUTPUT_COLUMNS), len(df_input)))
+    for ii in range(2):
+        out.fill(123.)
+        result = karstolution_arrays(config, *columns, out=out, calculate_isotope_calcite=False)
+        assert result is out
+        assert np.array_equal(out.T, full.values, equal_nan=True)
+    out = np.empty((2, len(df_input)))
+    karstolution_arrays(config, *columns, out=out, variables=['kststor1', 'tt'],
+                        calculate_isotope_calcite=False)
+    assert np.array_equal(out.T, full[['kststor1', 'tt']].values)
+    with pytest.raises(ValueError):
+        karstolution_arrays(config, *columns, out=np.empty((3, len(df_input))),
+                            variables=['kststor1', 'tt'])
+
+def test_checkpoint_restart(tmpdir):
+    from Karstolution import KarstolutionModel, load_state
+    config, df_input = load_example()
+    full = karstolution(config, df_input, calculate_isotope_calcite=False)
+    model = KarstolutionModel(config, calculate_isotope_calcite=False)
+    model.run(df_input.iloc[:60])
+    filename = str(tmpdir.join('state.npz'))
+    model.save_state(filename)
+    state, n_steps = load_state(filename)
+    assert n_steps == 60
+    # the saved state is not modified by runs which start from it
+    for ii in range(2):
+        df = karstolution(config, df_input.iloc[60:], calculate_isotope_calcite=False,
+                          state=state)
+        assert np.array_equal(df.values, full.iloc[60:].values, equal_nan=True)
+    restarted = KarstolutionModel(config, calculate_isotope_calcite=False)
+    restarted.load_state(filename)
+    pd.testing.assert_frame_equal(restarted.run(df_input.iloc[60:]), full.iloc[60:])
+    # the state has to match the length of the diffuse flow history
+    config['weibull_delay_months'] = 24
+    with pytest.raises(ValueError):
+        KarstolutionModel(config, state=state)
+
+def test_spin_up():
+    from Karstolution import KarstolutionModel, spin_up
+    config, df_input = load_example()
+    climatology = df_input.iloc[:12]
+    state, n_cycles = spin_up(config, climatology, tol=1e-4)
+    assert 1 < n_cycles < 10000
+    # the same as running the repeated forcing
+    repeated = pd.concat([climatology]*n_cycles, ignore_index=True)
+    repeated['tt'] = np.arange(1, len(repeated) + 1)
+    model = KarstolutionModel(config, calculate_isotope_calcite=False)
+    model.run(repeated)
+    for a, b in zip(state, model.state):
+        np.testing.assert_allclose(a, b, rtol=1e-12)
+    # and in a steady state
+    model.run(repeated.iloc[:12].assign(tt=repeated['tt'].iloc[:12] + len(repeated)))
+    assert np.max(np.abs(model.state.stores[:8] - state.stores[:8])) < 1e-4
+    with pytest.warns(UserWarning):
+        spin_up(config, climatology, max_cycles=2)
+
+def test_isolution_affine():
+    config, df_input = load_example()
+    df_input = df_input.iloc[:24]
+    full = karstolution(config, df_input)
+    config['isolution_affine'] = True
+    df = karstolution(config, df_input)
+    np.testing.assert_allclose(df.values, full.values, rtol=0, atol=1e-9)
+
+def test_isolution_table_engine(tmpdir):
+    config, df_input = load_example()
+    df_input = df_input.iloc[:24]
+    full = karstolution(config, df_input)
+    drip = full[[name for name in full.columns if name.startswith('drip_int')]].values
+    grid = dict(d=np.geomspace(drip.min(), drip.max(), 20),
+                TC=np.linspace(full.cave_temp.min(), full.cave_temp.max(), 5), pCO2=[4000e-6],
+                pCO2cave=[1000e-6], h=[0.95], V=[0.0], phi=[config['mixing_parameter_phi']])
+    path = str(tmpdir.join('table'))
+    max_error = isolution_table.build_table(path, grid, n_workers=1).metadata['max_error']
+    config['isolution_engine'] = 'table'
+    config['isolution_table'] = path
+    df = karstolution(config, df_input)
+    stal = [name for name in df.columns if name.startswith('stal')]
+    other = [name for name in df.columns if name not in stal]
+    pd.testing.assert_frame_equal(df[other], full[other], check_exact=True)
+    d18o = [name for name in stal if name.endswith('d18o')]
+    assert np.abs(df[d18o].values - full[d18o].values).max() <= 2*max_error['intercept']
+    # the cave conditions have to be within the table
+    config['monthly_forcing']['rel_humidity'] = [0.9]*12
+    with pytest.raises(ValueError):
+        karstolution(config, df_input)
+
+def test_calculate_growth_rate():
+    config, df_input = load_example()
+    df_input = df_input.iloc[:24]
+    full = karstolution(config, df_input)
+    df = karstolution(config, df_input, calculate='growth_rate')
+    d18o = [name for name in karst_core.ISOLUTION_COLUMNS if name.endswith('d18o')]
+    assert df[d18o].isnull().values.all()
+    other = [name for name in df.columns if name not in d18o]
+    pd.testing.assert_frame_equal(df[other], full[other], check_exact=False, rtol=1e-12)
+    with pytest.raises(ValueError):
+        karstolution(config, df_input, calculate='d18o')
+
+def test_profile():
+    config, df_input = load_example()
+    df_input = df_input.iloc[:24]
+    plain = karstolution(config, df_input)
+    assert 'profile' not in plain.attrs
+    for n_workers in [1, 2]:
+        df = karstolution(config, df_input, profile=True, n_workers=n_workers)
+        pd.testing.assert_frame_equal(df, plain, check_exact=True)
+        report = df.attrs['profile']
+        assert report['months'] == 24
+        assert set(report['stages']) == set(['soil_epikarst', 'diffuse_flow', 'karst_stores',
+                                             'isolution', 'dataframe'])
+        assert report['total_time'] > 0
+        for counters in report['stalagmites'].values():
+            assert counters['drips'] == 24
+            assert counters['ode_steps'] > 0
+    config['mixing_parameter_phi'] = 0.5
+    report = karstolution(config, df_input, profile=True).attrs['profile']
+    assert all(c['iterations'] >= 24 for c in report['stalagmites'].values())
+    # no ISOLUTION counters when only the growth rate is calculated
+    report = karstolution(config, df_input, profile=True, calculate='growth_rate').attrs['profile']
+    assert 'growth_rate' in report['stages']
+    assert all(c['drips'] == 0 for c in report['stalagmites'].values())
+
+def daily_input(df_input):
+    # the monthly forcing spread evenly over the days of each month
+    days = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])[df_input['mm'].values - 1]
+    df = df_input.loc[df_input.index.repeat(days)].reset_index(drop=True)
+    for name in ['evpt', 'prp']:
+        df[name] = df[name]/np.repeat(days, days)
+    df['tt'] = np.arange(1, len(df) + 1)
+    return df, days
+
+def test_daily_timestep():
+    config, df_input = load_example()
+    df_input = df_input.iloc[:36]
+    monthly = karstolution(config, df_input, calculate_isotope_calcite=False)
+    df_daily, days = daily_input(df_input)
+    config['timestep_days'] = 1.0
+    p = karst_core.resolve_parameters(config)
+    state = karst_core.initial_state(config)
+    assert len(state.dpdf) == len(p.y) == round(12*karst_core.MONTH_DAYS)
+    assert len(state.tempp) == p.n_tempp == round(36*karst_core.MONTH_DAYS)
+    # a month of daily drainage removes the same fraction as one monthly step
+    assert (1 - p.k_f5)**karst_core.MONTH_DAYS == pytest.approx(1 - config['f5'])
+    daily = karstolution(config, df_daily, calculate_isotope_calcite=False)
+    assert len(daily) == days.sum()
+    month = np.repeat(np.arange(len(df_input)), days)
+    for name in ['kststor1', 'epxstor', 'cave_temp']:
+        monthly_mean = daily[name].groupby(month).mean().values
+        assert np.allclose(monthly_mean[12:], monthly[name].values[12:], rtol=0.1)
+    with pytest.raises(ValueError):
+        karst_core.resolve_parameters(dict(config, timestep_days=0))
+
+def test_isolution_cadence():
+    config, df_input = load_example()
+    df_daily, days = daily_input(df_input.iloc[:3])
+    config['timestep_days'] = 1.0
+    every_day = karstolution(config, df_daily)
+    for cadence in [1, np.int64(1)]:
+        config['isolution_cadence'] = cadence
+        pd.testing.assert_frame_equal(karstolution(config, df_daily), every_day, check_exact=True)
+    config['isolution_cadence'] = np.int64(3)
+    assert karst_core.resolve_parameters(config).isolution_cadence == 3
+    config['isolution_cadence'] = 'month'
+    df = karstolution(config, df_daily, profile=True)
+    assert df.attrs['profile']['stalagmites']['stal1']['drips'] == 3
+    hydrology = [name for name in df.columns if name not in karst_core.ISOLUTION_COLUMNS]
+    pd.testing.assert_frame_equal(df[hydrology], every_day[hydrology], check_exact=True)
+    # one ISOLUTION solution per month, from the aggregated drips
+    starts = np.r_[0, np.cumsum(days)[:-1]]
+    drip_interval = days[0]/np.sum(1/df['drip_int_stal1'].values[:days[0]])
+    d18o = np.sum(df['kststor218o'].values[:days[0]]/df['drip_int_stal1'].values[:days[0]]) \
+        / np.sum(1/df['drip_int_stal1'].values[:days[0]])
+    ic, gr = isotope_calcite(drip_interval, df['cave_temp'].values[:days[0]].mean(), 4000e-6,
+                             1000e-6, 0.95, 0.0, 1.0, d18o, 1)
+    assert np.allclose(df['stal1d18o'].values[:days[0]], ic, rtol=0, atol=1e-9)
+    assert np.allclose(df['stal1_growth_rate'].values[:days[0]], gr)
+    for a, b in zip(starts, np.r_[starts[1:], len(df)]):
+        assert (df['stal2d18o'].values[a:b] == df['stal2d18o'].values[a]).all()
+    for cadence in [0, 1.5, 'year', True, np.int64(0)]:
+        config['isolution_cadence'] = cadence
+        with pytest.raises(ValueError):
+            karstolution(config, df_daily)
+
+def test_isolution_cadence_chunks():
+    from Karstolution import KarstolutionModel
+    config, df_input = load_example()
+    df_daily, days = daily_input(df_input.iloc[:2])
+    config['timestep_days'] = 1.0
+    for cadence, size in [(3, 9), ('month', days[0])]:
+        config['isolution_cadence'] = cadence
+        full = karstolution(config, df_daily)
+        # chunks of whole blocks, and a partial block at the end
+        model = KarstolutionModel(config)
+        chunks = [df_daily.iloc[a:a + size] for a in range(0, len(df_daily), size)]
+        pd.testing.assert_frame_equal(pd.concat(model.run_chunks(chunks)), full, rtol=1e-10)
+        # a chunk which continues the last block of the previous chunk
+        model = KarstolutionModel(config)
+        model.run(df_daily.iloc[:size - 1])
+        with pytest.raises(ValueError):
+            model.run(df_daily.iloc[size - 1:])
+
+def test_parallel_isolution():
+    config, df_input = load_example()
+    df_input = df_input.iloc[:30]
+    serial = karstolution(config, df_input)
+    df = karstolution(config, df_input, n_workers=3)
+    pd.testing.assert_frame_equal(df, serial, check_exact=True)
+
+def test_long_weibull_delay():
+    config, df_input = load_example()
+    config['weibull_delay_months'] = 600
+    columns = [df_input[name].values for name in karst_core.INPUT_COLUMNS]
+    results = []
+    for method in karst_core.DIFFUSE_METHODS:
+        config['diffuse_flow_method'] = method
+        p = karst_core.resolve_parameters(config)
+        assert p.diffuse_method == method
+        # state carried between calls
+        state = karst_core.initial_state(config)
+        first = run_hydrology(p, state, [c[:40] for c in columns])
+        second = run_hydrology(p, state, [c[40:] for c in columns])
+        results.append((np.hstack([first, second]), state))
+    (direct, state_direct), (fft, state_fft) = results
+    np.testing.assert_allclose(fft, direct, rtol=1e-10, atol=1e-10)
+    for a, b in zip(state_fft, state_direct):
+        np.testing.assert_allclose(a, b, rtol=1e-10, atol=1e-10)
+    config['diffuse_flow_method'] = 'auto'
+    assert karst_core.resolve_parameters(config).diffuse_method == 'fft'
+    with pytest.raises(ValueError):
+        karst_core.resolve_parameters(dict(config, diffuse_flow_method='recursive'))
+
+def test_weibull_weights_are_cached():
+    y = karst_process.weibull_parameters_y(1.5, 1.0, 24)
+    assert karst_process.weibull_parameters_y(1.5, 1.0, 24) is y
+    assert len(karst_process.weibull_parameters_y(1.5, 1.0, 36)) == 36
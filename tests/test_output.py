@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the output files
+
+Run with pytest
+"""
+import os
+import sys
+import pytest
+import numpy as np
+
+# try and make this script run from more than one directory
+sys.path.append('.')
+sys.path.append('..')
+
+# disable numba for debugging purposes
+os.environ['NUMBA_DISABLE_JIT'] = '1'
+
+pd = pytest.importorskip('pandas')
+yaml = pytest.importorskip('yaml')
+
+from Karstolution import KarstolutionModel, karstolution, open_sink, read_output
+from Karstolution.ensemble import run_ensemble, run_ensemble_vectorized
+
+example_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example')
+
+def load_example():
+    config = yaml.safe_load(open(os.path.join(example_dir, 'config.yaml')).read())
+    df_input = pd.read_csv(os.path.join(example_dir, 'input.csv'))
+    return config, df_input
+
+# file extension: library needed for the format
+FORMATS = [('.parquet', 'pyarrow'), ('.nc', 'netCDF4'), ('.zarr', 'zarr'), ('.csv', None)]
+
+@pytest.mark.parametrize('ext,module', FORMATS)
+def test_chunked_output(tmpdir, ext, module):
+    if module is not None:
+        pytest.importorskip(module)
+    config, df_input = load_example()
+    df_ref = karstolution(config, df_input, calculate_isotope_calcite=False)
+    path = str(tmpdir.join('output' + ext))
+    model = KarstolutionModel(config, calculate_isotope_calcite=False)
+    chunks = [df_input.iloc[ii:ii+40] for ii in range(0, len(df_input), 40)]
+    for df_output in model.run_chunks(chunks, output=path, time_chunk=16):
+        pass
+    df = read_output(path)
+    assert list(df.columns) == list(df_ref.columns)
+    assert df['tt'].dtype == np.int64
+    assert np.allclose(df.values, df_ref.values, equal_nan=True)
+    # one variable, stored as float32
+    with open_sink(path, ['tt', 'kststor1'], float32=True) as sink:
+        sink.write(df_ref)
+    df = read_output(path, 'kststor1')
+    assert list(df.columns) == ['kststor1']
+    assert np.allclose(df['kststor1'], df_ref['kststor1'], rtol=1e-6)
+
+@pytest.mark.parametrize('ext,module', FORMATS)
+def test_ensemble_output(tmpdir, ext, module):
+    if module is not None:
+        pytest.importorskip(module)
+    config, df_input = load_example()
+    path = str(tmpdir.join('ensemble' + ext))
+    members = [{'f1': 0.1}, {'f1': 0.2}, {'f1': 0.3}]
+    result = run_ensemble(config, df_input, members, n_workers=1,
+                          variables=['tt', 'kststor1', 'soilstor'], output=path)
+    for member in [2, 0]:
+        df = read_output(path, ['kststor1'], member=member)
+        assert np.allclose(df['kststor1'], result.sel('kststor1')[member])
+    if ext != '.csv':
+        assert df.attrs['members'] == members
+        assert df.attrs['variables'] == ['tt', 'kststor1', 'soilstor']
+    result = run_ensemble_vectorized(config, df_input, members, calculate_isotope_calcite=False,
+                                     output=path)
+    df = read_output(path, member=1)
+    assert np.allclose(df.values, result.data[1], equal_nan=True)
+
+def test_output_errors(tmpdir):
+    with pytest.raises(ValueError):
+        open_sink(str(tmpdir.join('output.txt')), ['tt'])
+    with open_sink(str(tmpdir.join('output.csv')), ['tt', 'mm']) as sink:
+        with pytest.raises(ValueError):
+            sink.write(np.zeros((10, 3)))
+        with pytest.raises(ValueError):
+            sink.write(np.zeros((10, 2)), member=1)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the rainfall d18O transfer functions
+
+Run with pytest
+"""
+import os
+import sys
+import pytest
+import numpy as np
+
+# try and make this script run from more than one directory
+sys.path.append('.')
+sys.path.append('..')
+
+# disable numba for debugging purposes
+os.environ['NUMBA_DISABLE_JIT'] = '1'
+
+pd = pytest.importorskip('pandas')
+yaml = pytest.importorskip('yaml')
+
+from Karstolution import karstolution
+from Karstolution.transfer import transfer_function
+
+example_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example')
+
+def load_example():
+    config = yaml.safe_load(open(os.path.join(example_dir, 'config.yaml')).read())
+    df_input = pd.read_csv(os.path.join(example_dir, 'input.csv'))
+    return config, df_input
+
+def test_transfer_function_matches_model():
+    config, df_input = load_example()
+    df_input = df_input.iloc[:18]
+    config['k_d18o_epi'] = 0.01
+    config['monthly_forcing']['driprate_store_full'] = [0.01]*6 + [0.0]*6
+    tf = transfer_function(config, df_input, block_size=7)
+    # a scenario, and the rainfall d18O in the input
+    scenarios = np.stack([df_input['d18o'].values,
+                          np.random.RandomState(0).normal(-6., 2., len(df_input))], axis=1)
+    predicted = tf.predict(scenarios)
+    for ii in range(2):
+        df = karstolution(config, df_input.assign(d18o=scenarios[:, ii]))
+        for name in ['soil18o', 'epx18o', 'kststor118o', 'kststor218o', 'stal2d18o']:
+            np.testing.assert_allclose(predicted[name][:, ii], df[name].values, rtol=0, atol=1e-8)
+    # causal
+    assert np.all(np.triu(tf.matrices['kststor118o'], 1) == 0)
+    # sparse matrices, built without the dense ones
+    sparse = transfer_function(config, df_input, block_size=7, tol=1e-6)
+    for name in tf.variables:
+        dense = tf.matrices[name]
+        np.testing.assert_array_equal(sparse.matrices[name].toarray(),
+                                      np.where(np.abs(dense) < 1e-6, 0.0, dense))
+    sparse = transfer_function(config, df_input, calculate_isotope_calcite=False, tol=1e-12)
+    np.testing.assert_allclose(sparse.predict(scenarios[:, 1])['kststor118o'],
+                               predicted['kststor118o'][:, 1], atol=1e-9)
+
+def test_reconstruct():
+    config, df_input = load_example()
+    df_input = df_input.iloc[:24]
+    tf = transfer_function(config, df_input, calculate_isotope_calcite=False)
+    record = tf.predict(df_input['d18o'].values)['soil18o']
+    d18o = tf.reconstruct('soil18o', record)
+    np.testing.assert_allclose(tf.predict(d18o)['soil18o'], record, atol=1e-8)
+    sparse = transfer_function(config, df_input, calculate_isotope_calcite=False, tol=1e-14)
+    d18o = sparse.reconstruct('soil18o', record, damping=1e-6, prior=-5.)
+    np.testing.assert_allclose(sparse.predict(d18o)['soil18o'], record, atol=1e-4)
+
+def test_transfer_function_needs_linear_mixing():
+    config, df_input = load_example()
+    config['use_new_tracer_mixing_code'] = False
+    with pytest.raises(ValueError):
+        transfer_function(config, df_input)